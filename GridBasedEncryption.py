@@ -4,8 +4,11 @@ from typing import List, Tuple, Optional, Set
 import re
 
 class EncryptionGrid:
-    def __init__(self, num_columns: int, num_rows: int):
-        self._grid: List[List[str]] = self._fillGridRandomly(num_columns, num_rows)
+    def __init__(self, num_columns: int, num_rows: int, rng: Optional[random.Random] = None):
+        """
+        :param rng: Random generator to fill the grid with. Pass a seeded one to get the same grid every time.
+        """
+        self._grid: List[List[str]] = self._fillGridRandomly(num_columns, num_rows, rng)
         self._locked_fields:  Set[Tuple[int, int]]= set()  # Stores locked positions as (row, column)
 
     def getRawGrid(self) -> List[List[str]]:
@@ -15,7 +18,11 @@ class EncryptionGrid:
         return self._locked_fields
 
     @staticmethod
-    def _formatMessage(message: str) -> str:
+    def formatMessage(message: str) -> str:
+        """
+        The message as it's written in the grid; Only uppercase letters, with dots instead of spaces (and one at the end
+        if there are multiple words). Use its length to see how many fields a message takes.
+        """
         formated_message = message.upper()
 
         # Strip out anything that isn't a space or uppercase
@@ -25,6 +32,82 @@ class EncryptionGrid:
         formated_message = formated_message.replace(" ", ".")
         return formated_message
 
+    @staticmethod
+    def getFootprint(method: str, key: List[int], message_length: int, num_columns: int) -> List[Tuple[int, int]]:
+        """
+        Get the fields (row, column) that a message would be encoded in with the given key, in order. This only depends
+        on the key and the length of the (formatted) message, not on what is in the grid (or how high it is), so it can
+        be figured out before there is a grid.
+        :param message_length: Length of the message *after* formatting it
+        :return: The fields. If the key can't encode anything (eg; a row key of only zeroes), an empty list.
+        """
+        footprint: List[Tuple[int, int]] = []
+        if not key or message_length == 0:
+            return footprint
+
+        if method in ("row", "row-plow"):
+            if not any(key):
+                return footprint  # Every row is skipped
+            row_idx = 0
+            while len(footprint) < message_length:
+                col_idx = key[row_idx % len(key)]
+                if col_idx != 0:
+                    if method == "row-plow" and row_idx % 2 == 1:  # Odd row, reverse direction
+                        col_idx = num_columns - col_idx + 1
+                    footprint.append((row_idx, col_idx - 1))
+                row_idx += 1
+        elif method in ("skip", "skip-plow"):
+            position = -1
+            for char_idx in range(message_length):
+                position += key[char_idx % len(key)] + 1
+                row_idx, col_idx = divmod(position, num_columns)
+                if method == "skip-plow" and row_idx % 2 == 1:  # Odd row, reverse direction
+                    col_idx = num_columns - col_idx - 1
+                footprint.append((row_idx, col_idx))
+        return footprint
+
+    @staticmethod
+    def getRowsNeeded(method: str, key: List[int], message_length: int, num_columns: int) -> Optional[int]:
+        """
+        The exact number of rows a grid needs to fit a message with the given key.
+        :param message_length: Length of the message *after* formatting it
+        :return: Number of rows, or None if the key can't encode the message at all.
+        """
+        if message_length == 0:
+            return 0
+        footprint = EncryptionGrid.getFootprint(method, key, message_length, num_columns)
+        if not footprint:
+            return None
+        return max(row_idx for row_idx, _ in footprint) + 1
+
+    @staticmethod
+    def canShareGrid(first_method: str, first_key: List[int], first_message: str, second_method: str,
+                     second_key: List[int], second_message: str, num_columns: int) -> bool:
+        """
+        Check if two messages can be put in the same grid, without needing a grid. That is the case if every field
+        that both messages need, needs the same letter for both.
+        """
+        first_message = EncryptionGrid.formatMessage(first_message)
+        second_message = EncryptionGrid.formatMessage(second_message)
+        first_fields = dict(zip(EncryptionGrid.getFootprint(first_method, first_key, len(first_message), num_columns),
+                                first_message))
+        for field, char in zip(EncryptionGrid.getFootprint(second_method, second_key, len(second_message), num_columns),
+                               second_message):
+            if first_fields.get(field, char) != char:
+                return False
+        return True
+
+    @staticmethod
+    def getFootprintMask(method: str, key: List[int], message_length: int, num_columns: int) -> int:
+        """
+        Same as getFootprint, but as a bitset (bit row * num_columns + column is set for every field). Two keys
+        collide if their masks have any bits in common.
+        """
+        mask = 0
+        for row_idx, col_idx in EncryptionGrid.getFootprint(method, key, message_length, num_columns):
+            mask |= 1 << (row_idx * num_columns + col_idx)
+        return mask
+
     def decodeMethod(self, method: str, key: List[int]) -> str:
         if method == "row":
             return self.decodeRowMethod(key)
@@ -68,21 +151,7 @@ class EncryptionGrid:
         Checks if the given message can be encoded into the grid using the Row Method with the provided key.
         Supports looping keys.
         """
-        if not key:
-            return False  # An empty key cannot encode anything
-
-        for row_idx, char in enumerate(message):
-            col_idx = key[row_idx % len(key)]  # Loop over the key
-            if col_idx == 0:
-                continue  # Skip this row as per the key
-            col_idx -= 1  # Convert 1-based index to 0-based
-
-            if (row_idx % len(self._grid), col_idx) in self._locked_fields:
-                # Field is locked: Check if it already contains the required character
-                if self._grid[row_idx % len(self._grid)][col_idx] != char:
-                    return False  # Conflict with locked field
-
-        return True  # All characters can be encoded
+        return self._canEncodeInFootprint("row", message, key)
 
     def canEncodeRowPlowMethod(self, message: str, key: List[int]) -> bool:
         """
@@ -90,23 +159,24 @@ class EncryptionGrid:
         with the provided key. Alternates row traversal direction (left-to-right for even rows,
         right-to-left for odd rows). Supports looping keys.
         """
+        return self._canEncodeInFootprint("row-plow", message, key)
+
+    def _canEncodeInFootprint(self, method: str, message: str, key: List[int]) -> bool:
+        """
+        Rows with a 0 in the key are skipped, so the n-th character doesn't always end up in the n-th row. Use the
+        footprint to get the fields that the characters actually end up in.
+        """
         if not key:
             return False  # An empty key cannot encode anything
-
-        for row_idx, char in enumerate(message):
-            col_idx = key[row_idx % len(key)]  # Loop over the key
-            if col_idx == 0:
-                continue  # Skip this row as per the key
-
-            # Adjust the column index based on the zig-zag pattern
-            if row_idx % len(self._grid) % 2 == 1:  # Odd row, reverse direction
-                col_idx = len(self._grid[row_idx % len(self._grid)]) - col_idx + 1
-            col_idx -= 1  # Convert 1-based index to 0-based
-
-            target_row = row_idx % len(self._grid)
-            if (target_row, col_idx) in self._locked_fields:
+        footprint = self.getFootprint(method, key, len(message), len(self._grid[0]) if self._grid else 0)
+        if len(footprint) < len(message):
+            return False  # The key skips every row
+        for (row_idx, col_idx), char in zip(footprint, message):
+            if row_idx >= len(self._grid):
+                return False  # Not enough rows
+            if (row_idx, col_idx) in self._locked_fields:
                 # Field is locked: Check if it already contains the required character
-                if self._grid[target_row][col_idx] != char:
+                if self._grid[row_idx][col_idx] != char:
                     return False  # Conflict with locked field
 
         return True  # All characters can be encoded
@@ -186,7 +256,7 @@ class EncryptionGrid:
         :param preset_key: If left to None, a key will be generated. Otherwise, the provided key will be used.
         :return: The key (if it was provided, it's the same key, otherwise it returns whatever was generated)
         """
-        message = self._formatMessage(message_to_encode)
+        message = self.formatMessage(message_to_encode)
         if preset_key is not None:
             if not self.canEncodeRowMethod(message, preset_key):
                 raise Exception(f"Could not encode message with the given key '{preset_key}' and row method")
@@ -252,7 +322,7 @@ class EncryptionGrid:
         :param preset_key: If left to None, a key will be generated. Otherwise, the provided key will be used.
         :return: The key (if it was provided, it's the same key; otherwise, it returns the dynamically generated key).
         """
-        message = self._formatMessage(message_to_encode)
+        message = self.formatMessage(message_to_encode)
         if preset_key is not None:
             # If a preset key is provided, verify if the message can be encoded
             if not self.canEncodeRowPlowMethod(message, preset_key):
@@ -351,7 +421,7 @@ class EncryptionGrid:
         Alternates row traversal direction (left-to-right for even rows, right-to-left for odd rows).
         Returns the key used for encoding the message.
         """
-        message = self._formatMessage(message_to_encode)
+        message = self.formatMessage(message_to_encode)
         if preset_key is not None:
             # If a preset key is provided, verify if the message can be encoded
             if not self.canEncodeSkipPlowMethod(message, preset_key):
@@ -427,7 +497,7 @@ class EncryptionGrid:
         :param preset_key: If left to None, a key will be generated. Otherwise, the provided key will be used.
         :return: The key (if it was provided, it's the same key, otherwise it returns whatever was generated)
         """
-        message = self._formatMessage(message_to_encode)
+        message = self.formatMessage(message_to_encode)
         if preset_key is not None:
             if not self.canEncodeSkipMethod(message, preset_key):
                 raise Exception(f"Could not encode message with key {preset_key} using skip method")
@@ -479,7 +549,7 @@ class EncryptionGrid:
         return key
 
     @staticmethod
-    def _fillGridRandomly(num_columns: int, num_rows: int) -> List[List[str]]:
+    def _fillGridRandomly(num_columns: int, num_rows: int, rng: Optional[random.Random] = None) -> List[List[str]]:
         """
         Generates a random grid of letters, including spaces represented by '.'.
         Spaces appear with a "natural" frequency.
@@ -488,7 +558,8 @@ class EncryptionGrid:
         characters = string.ascii_uppercase + "."  # Include the space character
         weights = [1] * 26 + [5]  # Weight of 5 for spaces, 1 for each letter
 
-        return  [random.choices(characters, weights=weights, k=num_columns) for _ in range(num_rows)]
+        rng = rng if rng is not None else random
+        return  [rng.choices(characters, weights=weights, k=num_columns) for _ in range(num_rows)]
 
 
     def decodeRowPlowMethod(self, key: List[int]) -> str:
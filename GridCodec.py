@@ -0,0 +1,105 @@
+import string
+from typing import List, Set, Tuple
+
+from GridBasedEncryption import EncryptionGrid
+
+# Every character that can be in a grid. A cell is stored as its index in here, which fits in 5 bits.
+ALPHABET = string.ascii_uppercase + "."
+BITS_PER_CELL = 5
+
+FORMAT_VERSION = 1
+HEADER_SIZE = 4
+
+
+class GridCodec:
+    """
+    Packs a grid into bytes and back. The layout is:
+    - 1 byte format version
+    - 1 byte number of columns
+    - 2 bytes number of rows (big endian)
+    - 5 bits per cell, row by row, padded to a whole byte
+    - 1 bit per cell that is set if the cell is locked (ie; part of a message), padded to a whole byte
+
+    That is about a third of the size of the grid as text, and doesn't need any parsing to get to a cell.
+    """
+
+    @staticmethod
+    def encode(grid: EncryptionGrid) -> bytes:
+        rows = grid.getRawGrid()
+        num_rows = len(rows)
+        num_columns = len(rows[0]) if rows else 0
+        num_cells = num_rows * num_columns
+
+        cells = 0
+        for row in rows:
+            for char in row:
+                cells = cells << BITS_PER_CELL | ALPHABET.index(char)
+
+        locked = 0
+        for row_idx, col_idx in grid.getLockedFields():
+            locked |= 1 << (num_cells - 1 - (row_idx * num_columns + col_idx))
+
+        cells_size = GridCodec._getCellsSize(num_cells)
+        locked_size = GridCodec._getLockedSize(num_cells)
+        return (bytes([FORMAT_VERSION, num_columns]) + num_rows.to_bytes(2, "big")
+                + (cells << (cells_size * 8 - num_cells * BITS_PER_CELL)).to_bytes(cells_size, "big")
+                + (locked << (locked_size * 8 - num_cells)).to_bytes(locked_size, "big"))
+
+    @staticmethod
+    def getSize(data: bytes) -> Tuple[int, int]:
+        """
+        :return: The number of columns and rows, without unpacking the grid
+        :raise ValueError: If the data isn't a packed grid
+        """
+        if len(data) < HEADER_SIZE or data[0] != FORMAT_VERSION:
+            raise ValueError("Not a packed grid (or of an unknown version)")
+        return data[1], int.from_bytes(data[2:HEADER_SIZE], "big")
+
+    @staticmethod
+    def decodeRows(data: bytes) -> Tuple[List[List[str]], Set[Tuple[int, int]]]:
+        """
+        :return: The rows of the grid and the locked fields (row, column)
+        :raise ValueError: If the data isn't a packed grid
+        """
+        num_columns, num_rows = GridCodec.getSize(data)
+        num_cells = num_rows * num_columns
+        cells_size = GridCodec._getCellsSize(num_cells)
+        locked_size = GridCodec._getLockedSize(num_cells)
+        if len(data) != HEADER_SIZE + cells_size + locked_size:
+            raise ValueError(f"A packed grid of {num_columns}x{num_rows} can't be {len(data)} bytes")
+
+        cells = int.from_bytes(data[HEADER_SIZE:HEADER_SIZE + cells_size], "big")
+        cells >>= cells_size * 8 - num_cells * BITS_PER_CELL
+        locked = int.from_bytes(data[HEADER_SIZE + cells_size:], "big") >> (locked_size * 8 - num_cells)
+
+        mask = (1 << BITS_PER_CELL) - 1
+        chars = [ALPHABET[(cells >> (BITS_PER_CELL * (num_cells - 1 - cell_idx))) & mask]
+                 for cell_idx in range(num_cells)]
+        rows = [chars[row_idx * num_columns:(row_idx + 1) * num_columns] for row_idx in range(num_rows)]
+        locked_fields = {divmod(cell_idx, num_columns) for cell_idx in range(num_cells)
+                         if locked >> (num_cells - 1 - cell_idx) & 1}
+        return rows, locked_fields
+
+    @staticmethod
+    def decode(data: bytes) -> EncryptionGrid:
+        rows, locked_fields = GridCodec.decodeRows(data)
+        grid = EncryptionGrid(len(rows[0]) if rows else 0, len(rows))
+        grid.getRawGrid()[:] = rows
+        grid.getLockedFields().update(locked_fields)
+        return grid
+
+    @staticmethod
+    def toText(data: bytes) -> str:
+        """
+        The grid as text, the way grid messages used to be stored: A line per row, cells separated by a space.
+        """
+        rows, _ = GridCodec.decodeRows(data)
+        return "\n".join(" ".join(row) for row in rows)
+
+    @staticmethod
+    def _getCellsSize(num_cells: int) -> int:
+        return -(-num_cells * BITS_PER_CELL // 8)
+
+    @staticmethod
+    def _getLockedSize(num_cells: int) -> int:
+        return -(-num_cells // 8)
@@ -0,0 +1,69 @@
+"""
+Compose the grid of a stored grid profile (see sql_app/grid_profiler.py) again, with the same seed, keys and message,
+and profile it. Composing is deterministic given those, so this gives the same grid as the server did, without
+needing the server (or its database).
+
+Usage: python GridProfileReplay.py grid_profiles/grid_20240101_120000_000000.json
+"""
+import argparse
+import base64
+import cProfile
+import logging
+import pstats
+import random
+import sys
+import time
+from typing import Optional
+
+from GridCodec import GridCodec
+from sql_app import grid_composer, grid_profiler, schemas
+
+
+def replay(path: str, sort: str = "cumulative", num_lines: int = 25, output: Optional[str] = None) -> bool:
+    """
+    :return: If the replay gave the same grid as the stored one
+    """
+    details = grid_profiler.loadDetails(path)
+    grid_msg = schemas.GridMessage(**details["message"])
+    key_rings = grid_profiler.createKeyRings(details)
+    secondary_key_ring = key_rings.get(grid_msg.secondary_group) if grid_msg.secondary_group else None
+
+    profiler = cProfile.Profile()
+    start_time = time.perf_counter()
+    composed = profiler.runcall(grid_composer.composeGrid, grid_msg, key_rings[grid_msg.primary_group],
+                                secondary_key_ring, random.Random(details["seed"]))
+    duration = time.perf_counter() - start_time
+
+    stored_duration = details["durations"].get("composition")
+    print(f"Replayed {details['profile_id']} in {duration:.3f} s"
+          + (f" (stored: {stored_duration:.3f} s)" if stored_duration is not None else ""))
+    stats = pstats.Stats(profiler)
+    stats.sort_stats(sort).print_stats(num_lines)
+    if output:
+        stats.dump_stats(output)
+
+    stored_grid = details["grid"]
+    if composed is None:
+        same = stored_grid["packed"] is None
+        print("No combination worked out" + ("" if same else ", but the stored profile has a grid"))
+        return same
+
+    grid, grid_keys = composed
+    same = (stored_grid["packed"] is not None
+            and GridCodec.encode(grid) == base64.b64decode(stored_grid["packed"]) and grid_keys == stored_grid["keys"])
+    print(f"Composed a {stored_grid['num_columns']}x{len(grid.getRawGrid())} grid with keys "
+          f"{[grid_key['key_id'] for grid_key in grid_keys]}: {'same as' if same else 'DIFFERENT from'} the stored one")
+    return same
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a stored grid profile")
+    parser.add_argument("profile", help="The .json file of the profile")
+    parser.add_argument("--sort", default="cumulative", help="Sort order of the profile (see pstats)")
+    parser.add_argument("--lines", type=int, default=25, help="How many functions of the profile to show")
+    parser.add_argument("--output", default=None, help="File to write the profile of the replay to")
+    args = parser.parse_args()
+
+    # The debug output of composing a grid is only in the way here
+    logging.getLogger('uvicorn.error').setLevel(logging.WARNING)
+    sys.exit(0 if replay(args.profile, args.sort, args.lines, args.output) else 1)
@@ -0,0 +1,103 @@
+import logging
+import random
+from typing import List, Sequence, Tuple
+
+from GridBasedEncryption import EncryptionGrid
+
+# (encryption_type, key)
+MethodAndKey = Tuple[str, Sequence[int]]
+
+# Two messages can share a field if it happens to need the same letter for both. Roughly one in 27 (letters and '.')
+MATCHING_LETTER_PROBABILITY = 1 / 27
+
+
+class KeyGenerator:
+    def __init__(self, num_columns: int = 10, min_key_length: int = 6, max_key_length: int = 10, max_skip: int = 9,
+                 reference_message_length: int = 20, max_rows_per_character: float = 1.25,
+                 max_zero_fraction: float = 0.34, min_success_rate: float = 0.25, max_candidates: int = 500) -> None:
+        """
+        Generates keys that are actually useful for grid messages. Random keys are drawn and scored on how well they
+        would work out, and only keys that score well enough are handed out.
+
+        :param num_columns: Width of the grids the keys are used for
+        :param reference_message_length: Length of a typical (formatted) message. Used to compare keys on.
+        :param max_rows_per_character: How many rows a key may use up per character of a message. Keys that skip a lot
+        of rows make for grids that are too high to print.
+        :param max_zero_fraction: How much of the key is allowed to be zero. For row keys a zero skips a row (so uses
+        up grid without encoding anything), for skip keys it puts letters right next to each other (so bits of the
+        message can just be read from the grid)
+        :param min_success_rate: Minimum chance (on average over the other keys of the group) that a message with this
+        key can share a grid with a message with one of the other keys
+        :param max_candidates: How many keys are tried before settling for the best one that was found. Most of the
+        time one of the first few is good enough, but for groups with a lot of keys it can take hundreds.
+        """
+        self._num_columns = num_columns
+        self._min_key_length = min_key_length
+        self._max_key_length = max_key_length
+        self._max_skip = max_skip
+        self._reference_message_length = reference_message_length
+        self._max_rows_per_character = max_rows_per_character
+        self._max_zero_fraction = max_zero_fraction
+        self._min_success_rate = min_success_rate
+        self._max_candidates = max_candidates
+
+    def generateRandomKey(self, encryption_type: str) -> List[int]:
+        key_length = random.randint(self._min_key_length, self._max_key_length)
+        if "row" in encryption_type:
+            return [random.randint(0, self._num_columns) for _ in range(key_length)]
+        # Skip encryption!
+        return [random.randint(0, self._max_skip) for _ in range(key_length)]
+
+    def getRowsPerCharacter(self, encryption_type: str, key: Sequence[int]) -> float:
+        footprint = EncryptionGrid.getFootprint(encryption_type, list(key), self._reference_message_length,
+                                                self._num_columns)
+        if not footprint:
+            return float("inf")
+        return (footprint[-1][0] + 1) / self._reference_message_length
+
+    @staticmethod
+    def getZeroFraction(key: Sequence[int]) -> float:
+        return key.count(0) / len(key)
+
+    def getSuccessRate(self, encryption_type: str, key: Sequence[int], other_keys: List[MethodAndKey]) -> float:
+        """
+        The chance that two messages (one with this key, one with one of the other keys) fit in the same grid, on
+        average over the other keys. Every field that both messages need must happen to need the same letter.
+        """
+        if not other_keys:
+            return 1
+        mask = self._getMask(encryption_type, key)
+        total = 0.0
+        for other_type, other_key in other_keys:
+            num_overlapping = bin(mask & self._getMask(other_type, other_key)).count("1")
+            total += MATCHING_LETTER_PROBABILITY ** num_overlapping
+        return total / len(other_keys)
+
+    def generateKey(self, encryption_type: str, other_keys: List[MethodAndKey]) -> List[int]:
+        """
+        :param other_keys: The keys that the group already has
+        :return: The first random key that is good enough. If none of the candidates was, the best of them. That only
+        happens for groups that have so many keys already that no key works well with all of them (eg; about 10 skip
+        keys), which is logged.
+        """
+        best_key: List[int] = []
+        best_score: Tuple[bool, float, float] = (False, -1, 0)
+        for _ in range(self._max_candidates):
+            key = self.generateRandomKey(encryption_type)
+            rows_per_character = self.getRowsPerCharacter(encryption_type, key)
+            fits = (rows_per_character <= self._max_rows_per_character
+                    and self.getZeroFraction(key) <= self._max_zero_fraction)
+            success_rate = self.getSuccessRate(encryption_type, key, other_keys)
+            if fits and success_rate >= self._min_success_rate:
+                return key
+            score = (fits, success_rate, -rows_per_character)
+            if score > best_score:
+                best_key, best_score = key, score
+        logging.warning(f"None of {self._max_candidates} {encryption_type} keys is good enough for a group with "
+                        f"{len(other_keys)} keys (best success rate {best_score[1]:.2f}, needs "
+                        f"{self._min_success_rate:.2f}), using the best one anyway")
+        return best_key
+
+    def _getMask(self, encryption_type: str, key: Sequence[int]) -> int:
+        return EncryptionGrid.getFootprintMask(encryption_type, list(key), self._reference_message_length,
+                                               self._num_columns)
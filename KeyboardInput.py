@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import string
+import sys
+from typing import Callable, Dict, Optional, Tuple
+
+import contextlib
+
+with contextlib.redirect_stdout(None):
+    import pygame
+
+try:
+    import evdev
+    from evdev import ecodes
+except ImportError:
+    evdev = None
+    ecodes = None
+
+# Called with (pygame key code, unicode) for every key that is pressed.
+KeyCallback = Callable[[int, str], None]
+
+
+class StdinKeyboard:
+    def __init__(self, on_key: KeyCallback) -> None:
+        """
+        Reads lines from stdin and replays them as key presses (followed by a return). Mostly useful when testing
+        the headless mode over ssh, as there is no keyboard attached to the terminal that way.
+        """
+        self._on_key = on_key
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        loop.add_reader(sys.stdin.fileno(), self._onReadable)
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            self._loop.remove_reader(sys.stdin.fileno())
+            self._loop = None
+
+    def _onReadable(self) -> None:
+        line = sys.stdin.readline()
+        if not line:
+            # Stdin was closed (eg; running as a service without a tty). Nothing more to read.
+            logging.info("Stdin was closed, no longer listening for typed messages")
+            self.stop()
+            return
+        for char in line.rstrip("\n"):
+            self._on_key(0, char)
+        self._on_key(pygame.K_RETURN, "\r")
+
+
+class EvdevKeyboard:
+    def __init__(self, on_key: KeyCallback, device: "evdev.InputDevice") -> None:
+        """
+        Reads key presses straight from the input device. This is what is used on the actual telegraph, since there
+        is no X session (and thus no pygame window) to get the keyboard events from.
+        """
+        self._on_key = on_key
+        self._device = device
+        self._task: Optional[asyncio.Task] = None
+        self._shift_pressed = False
+        self._key_map: Dict[int, Tuple[int, str, str]] = self._createKeyMap()
+
+    @staticmethod
+    def _createKeyMap() -> Dict[int, Tuple[int, str, str]]:
+        """
+        Map evdev key codes to (pygame key, unicode, unicode with shift)
+        """
+        key_map = {
+            ecodes.KEY_BACKSPACE: (pygame.K_BACKSPACE, "\b", "\b"),
+            ecodes.KEY_ENTER: (pygame.K_RETURN, "\r", "\r"),
+            ecodes.KEY_KPENTER: (pygame.K_RETURN, "\r", "\r"),
+            ecodes.KEY_SPACE: (pygame.K_SPACE, " ", " "),
+            ecodes.KEY_DOT: (pygame.K_PERIOD, ".", ">"),
+            ecodes.KEY_COMMA: (pygame.K_COMMA, ",", "<"),
+            ecodes.KEY_SLASH: (pygame.K_SLASH, "/", "?"),
+            ecodes.KEY_MINUS: (pygame.K_MINUS, "-", "_"),
+        }
+        for letter in string.ascii_uppercase:
+            key_map[getattr(ecodes, f"KEY_{letter}")] = (getattr(pygame, f"K_{letter.lower()}"), letter.lower(), letter)
+        for digit, shifted in zip("1234567890", "!@#$%^&*()"):
+            key_map[getattr(ecodes, f"KEY_{digit}")] = (getattr(pygame, f"K_{digit}"), digit, shifted)
+        return key_map
+
+    @classmethod
+    def findKeyboard(cls, on_key: KeyCallback, device_path: Optional[str] = None) -> Optional["EvdevKeyboard"]:
+        if evdev is None:
+            return None
+        try:
+            if device_path:
+                return cls(on_key, evdev.InputDevice(device_path))
+            for path in evdev.list_devices():
+                device = evdev.InputDevice(path)
+                # Anything that can type an A is considered to be a keyboard.
+                if ecodes.KEY_A in device.capabilities().get(ecodes.EV_KEY, []):
+                    logging.info(f"Using keyboard {device.name} at {path}")
+                    return cls(on_key, device)
+                device.close()
+        except OSError as e:
+            logging.warning(f"Unable to open keyboard: {e}")
+        return None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._task = loop.create_task(self._readEvents())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._device.close()
+
+    async def _readEvents(self) -> None:
+        try:
+            async for event in self._device.async_read_loop():
+                if event.type != ecodes.EV_KEY:
+                    continue
+                if event.code in (ecodes.KEY_LEFTSHIFT, ecodes.KEY_RIGHTSHIFT):
+                    self._shift_pressed = event.value != 0
+                    continue
+                if event.value == 0:
+                    continue  # Key release, we only care about key down (1) and repeat (2)
+                if event.code not in self._key_map:
+                    continue
+                key, unicode, shifted_unicode = self._key_map[event.code]
+                self._on_key(key, shifted_unicode if self._shift_pressed else unicode)
+        except OSError as e:
+            logging.error(f"Keyboard was disconnected: {e}")
+
+
+def createHeadlessKeyboard(on_key: KeyCallback, device_path: Optional[str] = None):
+    """
+    Prefer reading the keyboard device directly, but fall back to stdin if evdev isn't available (or no keyboard
+    could be found)
+    """
+    keyboard = EvdevKeyboard.findKeyboard(on_key, device_path)
+    if keyboard is None:
+        logging.info("No evdev keyboard found, reading typed messages from stdin")
+        return StdinKeyboard(on_key)
+    return keyboard
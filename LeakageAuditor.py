@@ -0,0 +1,176 @@
+import os
+import string
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Set
+
+import numpy
+
+from GridBasedEncryption import EncryptionGrid
+
+DEFAULT_WORD_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Assets", "Words.txt")
+
+# Characters of a grid are turned into numbers (their index in here). Decoded texts that are shorter than the longest
+# one are padded with len(ALPHABET), which is never part of a word.
+ALPHABET = string.ascii_uppercase + "."
+PADDING = len(ALPHABET)
+_NUM_CODES = PADDING + 1
+
+# How many index matrices (one per grid height) are kept around
+MAX_INDEX_MATRICES = 64
+
+
+class AuditedKey(NamedTuple):
+    key_id: int
+    group_name: str
+    encryption_type: str
+    key: Sequence[int]
+
+
+class LeakageAuditor:
+    def __init__(self, keys: List[AuditedKey], words: Iterable[str], num_columns: int = 10, min_word_length: int = 4,
+                 min_score: int = 8) -> None:
+        """
+        Checks if any of the issued keys decodes something readable from a grid. Decoding a grid with every key one by
+        one is too slow to do for every message, so all keys are decoded at once: For every key (and grid height) the
+        fields it reads are worked out once, after which decoding a grid is a single lookup in the grid for all keys.
+
+        :param keys: All keys to check
+        :param words: Words that count as readable
+        :param min_word_length: Shorter words are ignored. Random grids are full of short words.
+        :param min_score: How many characters of a decoded text must be part of a word for the key to be reported
+        """
+        self._keys = keys
+        self._num_columns = num_columns
+        self._min_word_length = min_word_length
+        self._min_score = min_score
+        self._words = {word for word in (self._formatWord(word) for word in words) if len(word) >= min_word_length}
+        self._index_matrices: Dict[int, numpy.ndarray] = {}
+
+    @staticmethod
+    def loadWords(path: str = DEFAULT_WORD_LIST) -> List[str]:
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    @staticmethod
+    def _formatWord(word: str) -> str:
+        return "".join(char for char in word.upper() if char in string.ascii_uppercase)
+
+    def getIndexMatrix(self, num_rows: int) -> numpy.ndarray:
+        """
+        :return: For every key (a row of the matrix) the index of every field it reads in the flattened grid, in order.
+        Keys that read fewer fields are padded with the index right after the grid.
+        """
+        index_matrix = self._index_matrices.get(num_rows)
+        if index_matrix is not None:
+            return index_matrix
+
+        num_fields = num_rows * self._num_columns
+        all_indices = []
+        for audited_key in self._keys:
+            # Row keys read at most one field per row, skip keys at most every field
+            max_length = num_rows if audited_key.encryption_type in ("row", "row-plow") else num_fields
+            footprint = EncryptionGrid.getFootprint(audited_key.encryption_type, list(audited_key.key), max_length,
+                                                    self._num_columns)
+            indices = []
+            # Decoding stops at the first field that is outside of the grid
+            for row_idx, col_idx in footprint:
+                if not 0 <= row_idx < num_rows:
+                    break
+                indices.append(row_idx * self._num_columns + col_idx)
+            all_indices.append(indices)
+
+        index_matrix = numpy.full((len(all_indices), max((len(indices) for indices in all_indices), default=0)),
+                                  num_fields, dtype=numpy.intp)
+        for key_index, indices in enumerate(all_indices):
+            index_matrix[key_index, :len(indices)] = indices
+
+        if len(self._index_matrices) >= MAX_INDEX_MATRICES:
+            self._index_matrices.clear()
+        self._index_matrices[num_rows] = index_matrix
+        return index_matrix
+
+    def decodeAll(self, grid: EncryptionGrid) -> numpy.ndarray:
+        """
+        :return: The grid decoded with every key, as character codes (see ALPHABET).
+        """
+        raw_grid = grid.getRawGrid()
+        codes = numpy.array([ALPHABET.index(char) for row in raw_grid for char in row] + [PADDING], dtype=numpy.int64)
+        return codes[self.getIndexMatrix(len(raw_grid))]
+
+    def decodeAllAsText(self, grid: EncryptionGrid) -> List[str]:
+        return [self._toText(decoded) for decoded in self.decodeAll(grid)]
+
+    def audit(self, grid: EncryptionGrid, messages: Iterable[Optional[str]] = (),
+              skip_key_ids: Iterable[int] = ()) -> dict:
+        """
+        Decode the grid with every key and look for words in the results.
+        :param messages: The messages in the grid. Their words are looked for too, since finding (part of) the actual
+        message is the worst case.
+        :param skip_key_ids: The keys that the messages were encoded with.
+        :return: The number of keys checked and the keys that decoded something readable (best scoring first).
+        """
+        words = set(self._words)
+        for message in messages:
+            if message:
+                words.update(word for word in EncryptionGrid.formatMessage(message).split(".")
+                             if len(word) >= self._min_word_length)
+
+        skip_key_ids = set(skip_key_ids)
+        decoded = self.decodeAll(grid)
+        leaks = []
+        if decoded.shape[0] and decoded.shape[1] >= self._min_word_length and words:
+            # Every word starts with one of these; Find all the places in all the decoded texts where one starts.
+            words_by_prefix: Dict[int, List[str]] = {}
+            for word in words:
+                words_by_prefix.setdefault(self._hashPrefix(word), []).append(word)
+            prefixes = self._getPrefixHashes(decoded)
+            key_indices, positions = numpy.nonzero(numpy.isin(prefixes, list(words_by_prefix)))
+
+            found: Dict[int, Dict[int, str]] = {}  # key index -> position -> longest word starting there
+            texts: Dict[int, str] = {}
+            for key_index, position, prefix in zip(key_indices.tolist(), positions.tolist(),
+                                                   prefixes[key_indices, positions].tolist()):
+                if self._keys[key_index].key_id in skip_key_ids:
+                    continue
+                text = texts.get(key_index)
+                if text is None:
+                    text = texts[key_index] = self._toText(decoded[key_index])
+                matching = [word for word in words_by_prefix[prefix] if text.startswith(word, position)]
+                if matching:
+                    found.setdefault(key_index, {})[position] = max(matching, key=len)
+
+            for key_index, words_found in found.items():
+                covered: Set[int] = set()
+                for position, word in words_found.items():
+                    covered.update(range(position, position + len(word)))
+                if len(covered) < self._min_score:
+                    continue
+                audited_key = self._keys[key_index]
+                leaks.append({
+                    "key_id": audited_key.key_id,
+                    "group": audited_key.group_name,
+                    "encryption_type": audited_key.encryption_type,
+                    "score": len(covered),
+                    "words": sorted(set(words_found.values())),
+                })
+        leaks.sort(key=lambda leak: -leak["score"])
+        return {"keys_checked": len([key for key in self._keys if key.key_id not in skip_key_ids]), "leaks": leaks}
+
+    def _hashPrefix(self, word: str) -> int:
+        prefix_hash = 0
+        for char in word[:self._min_word_length]:
+            prefix_hash = prefix_hash * _NUM_CODES + ALPHABET.index(char)
+        return prefix_hash
+
+    def _getPrefixHashes(self, decoded: numpy.ndarray) -> numpy.ndarray:
+        """
+        Same as _hashPrefix, but for every position in every decoded text at once.
+        """
+        num_positions = decoded.shape[1] - self._min_word_length + 1
+        prefix_hashes = numpy.zeros((decoded.shape[0], num_positions), dtype=numpy.int64)
+        for offset in range(self._min_word_length):
+            prefix_hashes = prefix_hashes * _NUM_CODES + decoded[:, offset:offset + num_positions]
+        return prefix_hashes
+
+    @staticmethod
+    def _toText(decoded: numpy.ndarray) -> str:
+        return "".join(ALPHABET[code] for code in decoded.tolist() if code != PADDING)
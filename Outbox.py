@@ -0,0 +1,89 @@
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from typing import Any, Dict, List, Set, Tuple
+
+
+class Outbox:
+    MESSAGE = "message"
+    PRINT_ACK = "print_ack"
+
+    def __init__(self, path: str = "telegraph_outbox.db") -> None:
+        """
+        On-device journal of everything the telegraph still has to tell the server (typed messages and print
+        acknowledgements). Entries are written (and synced) as soon as they happen, and only removed once the server
+        has accepted them. That way nothing is lost if the server is down or the telegraph restarts in the meantime.
+        :param path: Location of the sqlite file. Use ":memory:" for an outbox that doesn't survive restarts.
+        """
+        self._connection = sqlite3.connect(path, isolation_level=None)
+        # WAL keeps appending cheap; synchronous=FULL so an entry survives pulling the plug right after adding it.
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=FULL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                time_created REAL NOT NULL
+            )
+        """)
+        self._pending_acks: Set[int] = {message_id for _, message_id in self._getAll(self.PRINT_ACK)}
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def addMessage(self, text: str, target: str) -> None:
+        # The server recognises the message by its client_id if it's sent more than once
+        self._add(self.MESSAGE, {"text": text, "target": target, "client_id": uuid.uuid4().hex})
+
+    def addPrintAck(self, message_id: int) -> None:
+        self._add(self.PRINT_ACK, message_id)
+        self._pending_acks.add(message_id)
+
+    def hasPendingPrintAck(self, message_id: int) -> bool:
+        """
+        Has the message been printed, but the server doesn't know it yet? (If so, it shouldn't be printed again)
+        """
+        return message_id in self._pending_acks
+
+    def getPendingMessages(self, limit: int) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        :return: List of (entry id, message) in the order they were typed
+        """
+        return self._getAll(self.MESSAGE, limit)
+
+    def getPendingPrintAcks(self, limit: int) -> List[Tuple[int, int]]:
+        """
+        :return: List of (entry id, message id) in the order they were printed
+        """
+        return self._getAll(self.PRINT_ACK, limit)
+
+    def getNumPendingPrintAcks(self) -> int:
+        return len(self._pending_acks)
+
+    def getNumPending(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def remove(self, entry_ids: List[int]) -> None:
+        if not entry_ids:
+            return
+        placeholders = ",".join("?" * len(entry_ids))
+        # No DELETE ... RETURNING, the sqlite version on the pi is too old for that.
+        removed = self._connection.execute(
+            f"SELECT kind, payload FROM outbox WHERE id IN ({placeholders})", entry_ids).fetchall()
+        self._connection.execute(f"DELETE FROM outbox WHERE id IN ({placeholders})", entry_ids)
+        for kind, payload in removed:
+            if kind == self.PRINT_ACK:
+                self._pending_acks.discard(json.loads(payload))
+
+    def _add(self, kind: str, payload: Any) -> None:
+        self._connection.execute("INSERT INTO outbox (kind, payload, time_created) VALUES (?, ?, ?)",
+                                 (kind, json.dumps(payload), time.time()))
+        logging.debug(f"Added {kind} to the outbox")
+
+    def _getAll(self, kind: str, limit: int = -1) -> List[Tuple[int, Any]]:
+        rows = self._connection.execute("SELECT id, payload FROM outbox WHERE kind = ? ORDER BY id LIMIT ?",
+                                        (kind, limit)).fetchall()
+        return [(entry_id, json.loads(payload)) for entry_id, payload in rows]
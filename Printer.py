@@ -6,6 +6,9 @@ import subprocess
 import struct
 import fcntl
 import os
+from typing import Optional
+
+from Tracer import Tracer
 
 USBLP_GET_STATUS = 0x060b
 
@@ -15,13 +18,15 @@ def runningAsRoot() -> bool:
 
 
 class Printer:
-    def __init__(self) -> None:
+    def __init__(self, tracer: Optional[Tracer] = None) -> None:
         """
         Wrapper around the USB thermal printer. Handles things like being disabled and re-creating the device
         if the connection was lost.
+        :param tracer: If set, the paper checks are traced (they reload a kernel module, so they take a while)
         """
         self._printer: printer.Usb = self._createPrinter()
         self._should_print: bool = True
+        self._tracer = tracer
 
     def setEnabled(self, enabled: bool) -> None:
         self._should_print = enabled
@@ -108,6 +113,9 @@ class Printer:
             return False
 
     def printGridTextLine(self, line: str) -> bool:
+        """
+        :param line: The characters of a single row of the grid
+        """
         if not self._should_print:
             return True
         if not self.hasPaper():
@@ -115,7 +123,7 @@ class Printer:
         try:
             self._printer.set(bold=True)
             # Ensure we use double spaces
-            text_to_print = line.replace(" ", "  ")
+            text_to_print = "  ".join(line)
             # And print with 2 spaces in front of if (for spacing)
             self._printer.text(f"  {text_to_print}")
             self._printer.control("LF")
@@ -127,6 +135,12 @@ class Printer:
 
 
     def hasPaper(self):
+        if self._tracer is None:
+            return self._checkPaper()
+        with self._tracer.span("printer.hasPaper"):
+            return self._checkPaper()
+
+    def _checkPaper(self):
         if not runningAsRoot():
             # This check will only work if you are running as root.
             logging.warning("Unable to check paper status, not running as root")
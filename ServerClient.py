@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import random
+import time
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+
+class RequestStatistics:
+    def __init__(self) -> None:
+        """
+        Counters for a single kind of request to the server.
+        """
+        self.num_requests: int = 0
+        self.num_failures: int = 0  # Requests that failed, even after retrying
+        self.num_retries: int = 0
+        self.num_responses: int = 0  # Every attempt that got a response (including error responses)
+        self.total_latency: float = 0  # Seconds, only of the attempts that got a response
+        self.max_latency: float = 0
+
+    def getAverageLatency(self) -> float:
+        if self.num_responses == 0:
+            return 0
+        return self.total_latency / self.num_responses
+
+    def __str__(self) -> str:
+        return (f"{self.num_requests} requests, {self.num_failures} failed, {self.num_retries} retries, "
+                f"avg {self.getAverageLatency() * 1000:.1f} ms, max {self.max_latency * 1000:.1f} ms")
+
+
+class SendResult(Enum):
+    SENT = "sent"
+    FAILED = "failed"  # The server couldn't be reached (in time), sending it again later might work
+    REJECTED = "rejected"  # The server refused the message (eg; an unknown target), it will never be accepted
+
+
+class ServerClient:
+    def __init__(self, server_url: str, connect_timeout: float = 2.0, read_timeout: float = 5.0,
+                 max_retries: int = 3, retry_backoff: float = 0.5) -> None:
+        """
+        Handles all communication of the telegraph with the server. A single connection pool is kept for the
+        lifetime of the client, so the connection to the server is re-used instead of re-opened for every request.
+
+        :param server_url: Base url of the server (eg; http://127.0.0.1:8000)
+        :param connect_timeout: How long (in seconds) to wait for a connection to the server
+        :param read_timeout: How long (in seconds) to wait for the server to respond
+        :param max_retries: How often a failed request is retried (for requests that allow retrying)
+        :param retry_backoff: Time (in seconds) to wait before the first retry. Doubles for every next attempt
+        """
+        self._server_url = server_url
+        self._timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._client: Optional[httpx.AsyncClient] = None
+        self._statistics: Dict[str, RequestStatistics] = {}
+
+    async def __aenter__(self) -> "ServerClient":
+        # Only a single request is in flight most of the time, so there is no need for a big pool.
+        limits = httpx.Limits(max_connections=4, max_keepalive_connections=2)
+        self._client = httpx.AsyncClient(base_url=self._server_url, timeout=self._timeout, limits=limits)
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self._client.aclose()
+        self._client = None
+
+    def getStatistics(self) -> Dict[str, RequestStatistics]:
+        return self._statistics
+
+    def logStatistics(self) -> None:
+        for name, statistics in self._statistics.items():
+            logging.info(f"Server requests [{name}]: {statistics}")
+
+    async def claimMessages(self, station: str, count: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Reserve the next unprinted messages for this station, so that no other telegraph prints them.
+        """
+        # No retries; The next poll is the retry.
+        response = await self._request("claim", "POST", "/messages/claim", retries=0,
+                                       json={"station": station, "count": count})
+        if response is None:
+            return None
+        return response.json()
+
+    async def registerStation(self, station: str, targets: List[str]) -> bool:
+        """
+        From now on, messages for these targets are only handed out to this station.
+        """
+        response = await self._request("register", "POST", "/stations/", retries=0,
+                                       json={"name": station, "targets": targets})
+        return response is not None
+
+    async def getUnprintedMessages(self, etag: Optional[str] = None, station: Optional[str] = None
+                                   ) -> Optional[Tuple[Optional[str], Optional[List[Dict[str, Any]]]]]:
+        """
+        :param etag: The ETag of a previous response. If nothing changed since, the server doesn't send the messages.
+        :param station: Only get the messages that this station can print
+        :return: The ETag and the messages (None if they didn't change since the given ETag), or None if the request
+        failed.
+        """
+        headers = {"If-None-Match": etag} if etag is not None else {}
+        params = {"station": station} if station is not None else {}
+        response = await self._request("unprinted", "GET", "/messages/unprinted/", retries=0, headers=headers,
+                                       params=params)
+        if response is None:
+            return None
+        if response.status_code == 304:
+            return etag, None
+        return response.headers.get("ETag"), response.json()
+
+    async def sendMessage(self, text: str, target: str, client_id: Optional[str] = None) -> SendResult:
+        """
+        :param client_id: Unique id of the message. The server only stores a message with the same id once, so the
+                          message can safely be sent again if it's unknown if the server got it.
+        """
+        # Without a client_id, every retry that reaches the server would store the message again.
+        response = await self._request("send_message", "POST", "/messages/", idempotent=client_id is not None,
+                                       return_client_errors=True,
+                                       json={"text": text, "direction": "Outgoing", "target": target,
+                                             "client_id": client_id})
+        if response is None:
+            return SendResult.FAILED
+        if response.is_client_error:
+            return SendResult.REJECTED
+        return SendResult.SENT
+
+    async def acknowledgePrinted(self, message_ids: List[int]) -> bool:
+        response = await self._request("ack", "POST", "/messages/ack", json={"ids": message_ids})
+        return response is not None
+
+    async def _request(self, name: str, method: str, url: str, retries: Optional[int] = None,
+                       idempotent: bool = True, return_client_errors: bool = False,
+                       **kwargs) -> Optional[httpx.Response]:
+        """
+        Do a request to the server. Connection problems, timeouts and server errors (5xx) are retried with an
+        exponential backoff. Other error responses (4xx) are not going to change by retrying, so they fail directly.
+        :param idempotent: False for requests that must not be done twice. Those are only retried if the connection
+        couldn't be made, as the server might have handled the request in all other cases.
+        :param return_client_errors: Return error responses (4xx) as well, so the caller can tell a request that the
+        server refused apart from one that didn't get through.
+        :return: The response if it was successful, None otherwise.
+        """
+        statistics = self._statistics.setdefault(name, RequestStatistics())
+        statistics.num_requests += 1
+        if retries is None:
+            retries = self._max_retries
+
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                statistics.num_retries += 1
+                # Add a bit of jitter so that retries don't end up in lockstep with the polling
+                await asyncio.sleep(self._retry_backoff * 2 ** (attempt - 1) * random.uniform(0.8, 1.2))
+            start_time = time.monotonic()
+            try:
+                response = await self._client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                logging.warning(f"Request {method} {url} failed (attempt {attempt + 1}/{retries + 1}): {e}")
+                if not idempotent and not isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+                    break
+                continue
+            latency = time.monotonic() - start_time
+            statistics.num_responses += 1
+            statistics.total_latency += latency
+            statistics.max_latency = max(statistics.max_latency, latency)
+
+            if response.status_code >= 500:
+                logging.warning(f"Request {method} {url} got status code {response.status_code} "
+                                f"(attempt {attempt + 1}/{retries + 1})")
+                if not idempotent:
+                    break
+                continue
+            if response.is_error:
+                logging.error(f"Request {method} {url} got status code {response.status_code}: {response.text}")
+                if return_client_errors:
+                    statistics.num_failures += 1
+                    return response
+                break
+            return response
+
+        statistics.num_failures += 1
+        return None
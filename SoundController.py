@@ -8,9 +8,12 @@ with contextlib.redirect_stdout(None):
 class SoundController:
     sound_completed_event = pygame.USEREVENT + 1
 
-    def __init__(self):
+    def __init__(self, use_end_event: bool = True):
         """
         Simple wrapper around chanel setup and handling playing of sounds.
+        :param use_end_event: Post the sound_completed_event on the pygame event queue when a click is done. This only
+                              works if there is a display (and thus an event queue). Without one, hasClickCompleted
+                              should be polled instead.
         """
         # Setup all the sound stuff
         pygame.mixer.init()
@@ -22,7 +25,9 @@ class SoundController:
         self._bell_double = pygame.mixer.Sound("Sounds/final_bell_double.mp3")
 
         self._click_sound_channel = pygame.mixer.Channel(0)
-        self._click_sound_channel.set_endevent(self.sound_completed_event)
+        if use_end_event:
+            self._click_sound_channel.set_endevent(self.sound_completed_event)
+        self._click_pending = False
 
         # As we don't want a complete event for the bell, we use a separate channel
         self._bell_sound_channel = pygame.mixer.Channel(1)
@@ -38,9 +43,20 @@ class SoundController:
 
     def playLongClick(self):
         self._click_sound_channel.queue(random.choice(self._clicks_long))
+        self._click_pending = True
 
     def playShortClick(self):
         self._click_sound_channel.queue(random.choice(self._clicks_short))
+        self._click_pending = True
+
+    def hasClickCompleted(self) -> bool:
+        """
+        Returns True (once) when the last queued click has finished playing.
+        """
+        if self._click_pending and not self._click_sound_channel.get_busy():
+            self._click_pending = False
+            return True
+        return False
 
     def playBell(self):
         self._bell_sound_channel.queue(self._final_bell)
@@ -0,0 +1,57 @@
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from Tracer import Tracer
+
+
+class StartupTimer:
+    def __init__(self) -> None:
+        """
+        Measures how long the telegraph takes to start; Every import and piece of hardware that is set up is timed, up
+        to the moment the server is asked for messages for the first time. Components can be measured from any thread,
+        as the hardware is set up in the background.
+        """
+        self._start_time = Tracer.now()
+        self._spans: List[Tuple[str, int, int]] = []
+        self._lock = threading.Lock()
+        self._finished = False
+
+    @contextmanager
+    def measure(self, name: str) -> Iterator[None]:
+        start_time = Tracer.now()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._spans.append((name, start_time, Tracer.now()))
+
+    def isFinished(self) -> bool:
+        return self._finished
+
+    def finish(self, name: str, tracer: Optional[Tracer] = None) -> Optional[Dict[str, float]]:
+        """
+        Log how long startup took, until now. Components that are still being set up are left out.
+        :param name: What startup is finished with (eg; the first poll)
+        :param tracer: If set, the measured components are added to it as startup.<component> spans
+        :return: The duration (in seconds) of startup and of every component measured, or None if startup was finished
+        before
+        """
+        end_time = Tracer.now()
+        with self._lock:
+            if self._finished:
+                return None
+            self._finished = True
+            spans = list(self._spans)
+
+        durations = {name: (end_time - self._start_time) / 1e9}
+        durations.update((span_name, (span_end_time - span_start_time) / 1e9)
+                         for span_name, span_start_time, span_end_time in spans)
+        if tracer is not None:
+            tracer.addSpan(f"startup.{name}", self._start_time, end_time)
+            for span_name, span_start_time, span_end_time in spans:
+                tracer.addSpan(f"startup.{span_name}", span_start_time, span_end_time)
+        components = ", ".join(f"{span_name} {duration:.2f} s" for span_name, duration in list(durations.items())[1:])
+        logging.info(f"Startup took {durations[name]:.2f} s until the {name}: {components}")
+        return durations
@@ -0,0 +1,20 @@
+from typing import Tuple
+
+
+class Targets:
+    """
+    The targets a message can be for, in the order of the LEDs on the telegraph. Same as sql_app.schemas.Target, but
+    without having to import pydantic (and the rest of the server) on the telegraph.
+    """
+    NAMES: Tuple[str, ...] = ("FireControl", "University", "CentralIntelligence", "Relay", "Logistics",
+                              "LocalCivilian", "LongRange")
+
+    @staticmethod
+    def getIndex(name: str) -> int:
+        """
+        :return: The index of the LED of the target, or -1 (all LEDs off) for an unknown target
+        """
+        try:
+            return Targets.NAMES.index(name)
+        except ValueError:
+            return -1
@@ -0,0 +1,123 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+
+class Tracer:
+    def __init__(self, path: Optional[str] = None, max_events: int = 20000) -> None:
+        """
+        Keeps track of how long every stage of handling a message takes (fetching it from the server, printer calls,
+        sounds, pauses, ...). Spans are timed with the monotonic clock and kept in memory; The last `max_events` of them
+        can be written to `path` in the Chrome trace format (open it in chrome://tracing or https://ui.perfetto.dev).
+        A summary per message is logged as well.
+
+        Spans can be added from any thread (eg; the printer thread).
+        :param path: Where to write the trace. If None, nothing is written (but the summaries are still logged)
+        :param max_events: How many spans to keep. Older ones are dropped.
+        """
+        self._path = path
+        self._start_time = self.now()
+        self._events: Deque[Dict[str, Any]] = collections.deque(maxlen=max_events)
+        self._thread_names: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+        self._current_message_id: Optional[int] = None
+        self._message_start_time: Optional[int] = None
+        # Span name -> [count, total duration (ns)], of the current message
+        self._stage_totals: Dict[str, List[int]] = {}
+
+    @staticmethod
+    def now() -> int:
+        return time.monotonic_ns()
+
+    def startMessage(self, message_id: int, start_time: Optional[int] = None) -> None:
+        """
+        Spans that are added from now on (without a message id of their own) belong to this message.
+        :param start_time: When handling the message started (see now). Defaults to now.
+        """
+        with self._lock:
+            self._current_message_id = message_id
+            self._message_start_time = start_time if start_time is not None else self.now()
+            self._stage_totals = {}
+
+    def addSpan(self, name: str, start_time: int, end_time: Optional[int] = None, **args: Any) -> None:
+        """
+        :param start_time: See now
+        :param end_time: See now. Defaults to now.
+        """
+        if end_time is None:
+            end_time = self.now()
+        thread_id = threading.get_ident()
+        with self._lock:
+            if thread_id not in self._thread_names:
+                self._thread_names[thread_id] = threading.current_thread().name
+            if self._current_message_id is not None:
+                args.setdefault("message_id", self._current_message_id)
+                stage_total = self._stage_totals.setdefault(name, [0, 0])
+                stage_total[0] += 1
+                stage_total[1] += end_time - start_time
+            self._events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": thread_id,
+                                 "ts": (start_time - self._start_time) / 1000, "dur": (end_time - start_time) / 1000,
+                                 "args": args})
+
+    @contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[None]:
+        start_time = self.now()
+        try:
+            yield
+        finally:
+            self.addSpan(name, start_time, **args)
+
+    def finishMessage(self) -> Optional[Dict[str, Any]]:
+        """
+        Log the summary of the current message. Writing the trace file is left to the caller (see write), as that is
+        better not done on the event loop.
+        :return: The summary, or None if no message was started
+        """
+        with self._lock:
+            if self._current_message_id is None:
+                return None
+            message_id = self._current_message_id
+            start_time = self._message_start_time
+            stage_totals = self._stage_totals
+            self._current_message_id = None
+            self._message_start_time = None
+            self._stage_totals = {}
+
+        end_time = self.now()
+        self.addSpan("message", start_time, end_time, message_id=message_id)
+        summary = {
+            "message_id": message_id,
+            "duration": (end_time - start_time) / 1e9,
+            "stages": {name: {"count": count, "duration": total / 1e9}
+                       for name, (count, total) in sorted(stage_totals.items(), key=lambda item: -item[1][1])}
+        }
+        stages = ", ".join(f"{name} {stage['duration']:.2f} s ({stage['count']}x)"
+                           for name, stage in summary["stages"].items())
+        logging.info(f"Message {message_id} took {summary['duration']:.2f} s: {stages}")
+        return summary
+
+    def getEvents(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            thread_names = dict(self._thread_names)
+            events = list(self._events)
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread_id, "args": {"name": name}}
+                    for thread_id, name in thread_names.items()]
+        return metadata + events
+
+    def write(self) -> None:
+        if self._path is None:
+            return
+        # Write to a temporary file first, so there is never a half written trace
+        temporary_path = self._path + ".tmp"
+        try:
+            with open(temporary_path, "w") as f:
+                json.dump({"traceEvents": self.getEvents(), "displayTimeUnit": "ms"}, f)
+            os.replace(temporary_path, self._path)
+        except OSError as e:
+            logging.warning(f"Failed to write the trace to {self._path}: {e}")
@@ -1,23 +1,42 @@
+from StartupTimer import StartupTimer
+
+# Created before anything else is imported, so the imports are measured as well
+startup_timer = StartupTimer()
+
 import argparse
+import asyncio
+import base64
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
 import sys
 import random
-import threading
-from typing import Optional
-import requests
+import signal
+import socket
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
 
 import contextlib
 
-from pygame.event import Event
+with startup_timer.measure("import.pygame"), contextlib.redirect_stdout(None):
+    import pygame
+    from pygame.event import Event
 
-from PeripheralSerialController import PeripheralSerialController
-from Printer import Printer
+from GridCodec import GridCodec
+from Outbox import Outbox
 from SoundController import SoundController
-from sql_app.schemas import Target
+from Targets import Targets
+from Tracer import Tracer
 
-with contextlib.redirect_stdout(None):
-    import pygame
+with startup_timer.measure("import.ServerClient"):
+    from ServerClient import SendResult, ServerClient
+with startup_timer.measure("import.KeyboardInput"):
+    from KeyboardInput import createHeadlessKeyboard
+with startup_timer.measure("import.PeripheralSerialController"):
+    from PeripheralSerialController import PeripheralSerialController
+
+if TYPE_CHECKING:
+    # Importing escpos takes a while, so the printer is only imported once it's set up (see _initHardware)
+    from Printer import Printer
 
 from Config import Config
 
@@ -50,49 +69,119 @@ class PygameWrapper:
     MAX_ROW_PAUSE = 500
 
     REQUEST_UPDATE_TIME = 2000  # 2 sec
-    MIN_TIME_BETWEEN_MESSAGES = 10000  # 10 seconds
+    # Priority of messages that are printed right after the one that is printing. Mirrors sql_app.schemas.Priority.urgent,
+    # which isn't imported to keep pydantic (and the rest of the server) off the telegraph.
+    URGENT_PRIORITY = 2
+    MIN_TIME_BETWEEN_MESSAGES = 10000  # 10 seconds, urgent messages don't wait for this
     RETRY_PRINTER_NOT_FOUND_TIME = 2000  # 2 seconds
     MESSAGE_TYPING_TIMEOUT_TIME = 30000  # 30 secs
 
+    LOOP_TICK_TIME = 0.01  # 10 ms, how often the pygame events are fetched (only when there is a display)
+    # Without a display the mixer doesn't post an end event, so while a click plays it's checked this often if it's done
+    CLICK_CHECK_TIME = 0.01  # 10 ms
+
+    SERVER_STATISTICS_LOG_INTERVAL = 300  # 5 minutes
+    OUTBOX_FLUSH_INTERVAL = 5  # seconds, how long to wait before trying again if the server couldn't be reached
+    OUTBOX_BATCH_SIZE = 20
+    # Checking for paper reloads the usb printer kernel module, so printer calls can take a while.
+    PRINTER_TIMEOUT = 30.0  # seconds
+
     SCREEN_SIZE = (1280, 720)
     SERVER_URL: str = "http://127.0.0.1:8000"
 
-    def __init__(self, fullscreen: bool = True) -> None:
+    def __init__(self, fullscreen: bool = True, headless: bool = False, keyboard_device: Optional[str] = None,
+                 server_client: Optional[ServerClient] = None, outbox: Optional[Outbox] = None,
+                 station: Optional[str] = None, targets: Optional[List[str]] = None, tracer: Optional[Tracer] = None,
+                 startup_timer: Optional[StartupTimer] = None) -> None:
         """
         We are using a wrapper for a few reasons:
         1. We want to handle keyboard inputs from the user (which is suprisingly hard without a simple game engine)
         2. We want to play sounds at certain moments.
 
-        Note that the screen isn't even enabled on the actual device.
+        Note that the screen isn't even enabled on the actual device. In headless mode no display is created at all;
+        only the mixer is used and keyboard input is read from evdev (or stdin).
+
+        Everything runs on a single asyncio loop; Events (timers, keys, sounds) are handled one at a time by a
+        dispatcher task, server requests run as tasks on a shared server client and the (blocking) printer calls are
+        handed off to a dedicated thread.
         :param fullscreen:
+        :param headless: Run without a display surface.
+        :param keyboard_device: Path of the evdev keyboard to use in headless mode. If not set, the first one found is used
+        :param server_client: Client to talk to the server with. If not set, one with the default settings is created.
+        :param outbox: Journal for everything that still needs to be sent to the server. If not set, the default
+                       outbox file is used.
+        :param station: Name under which this telegraph claims messages from the server. Defaults to the hostname.
+        :param targets: The targets of which this telegraph prints the messages. It registers itself for them with the
+                        server before asking for messages, after which no other telegraph gets those. If not set, it
+                        only prints the messages that aren't for any registered telegraph.
+        :param tracer: Keeps track of how long every stage of printing a message takes. If not set, the trace is only
+                       kept in memory (and summarised in the log).
+        :param startup_timer: Measures how long it takes until the server is asked for messages for the first time. The
+                              printer, the sounds and the serial connection aren't needed for that, so they are set up
+                              in the background once the telegraph runs (see _initHardware).
         """
         self._setupLogging()
-        pygame.init()
+        self._headless = headless
+        self._keyboard_device = keyboard_device
+        self._startup_timer = startup_timer if startup_timer is not None else StartupTimer()
 
-        if fullscreen:
-            self._screen = pygame.display.set_mode(self.SCREEN_SIZE, pygame.FULLSCREEN)
+        if headless:
+            self._screen = None
+            self._clock = None
         else:
-            self._screen = pygame.display.set_mode(self.SCREEN_SIZE)
+            with self._startup_timer.measure("init.display"):
+                pygame.init()
+                if fullscreen:
+                    self._screen = pygame.display.set_mode(self.SCREEN_SIZE, pygame.FULLSCREEN)
+                else:
+                    self._screen = pygame.display.set_mode(self.SCREEN_SIZE)
 
-        self._clock = pygame.time.Clock()
+            self._clock = pygame.time.Clock()
         self._is_running = False  # Is the application still running (used for the main loop)
+        self._stopped: Optional[asyncio.Event] = None  # Set once the application should stop
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        self._event_queue: Optional[asyncio.Queue] = None
 
-        self._sound = SoundController()
+        self._server = server_client if server_client is not None else ServerClient(self.SERVER_URL)
+        # Typed messages and print acknowledgements are stored here first, and sent to the server from there.
+        self._outbox = outbox if outbox is not None else Outbox()
+        self._outbox_changed: Optional[asyncio.Event] = None
+        self._station = station if station is not None else socket.gethostname()
+        self._targets = targets
+        self._is_registered = not targets
 
-        self._start_playing_message = False
+        # A single worker also ensures that the printer is only ever doing one thing at a time.
+        self._printer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="printer")
+
+        # Set up in the background (see _initHardware). Nothing is claimed from the server before they are.
+        self._sound: Optional[SoundController] = None
+        self._printer: Optional["Printer"] = None
+        self._hardware_ready: Optional[asyncio.Event] = None
 
         self._message_queue: Queue = Queue()
         self._printing_morse = True
 
-        self._request_message_to_be_printed_thread: Optional[threading.Thread] = None
+        self._server_request_task: Optional[asyncio.Task] = None
         self._request_message_pending = False
         self._last_printed_message_id = None
+        # Loop time (see asyncio.AbstractEventLoop.time) until which only urgent messages are claimed
+        self._cooldown_end_time: Optional[float] = None
+        # ETag of the unprinted messages, the last time there weren't any
+        self._empty_queue_etag: Optional[str] = None
 
         self._peripheral_controller = PeripheralSerialController()
 
         self._typed_text = ""  # The text that is locally typed
 
-        self._printer = Printer()
+        self._tracer = tracer if tracer is not None else Tracer()
+        # When the current sound and pause started (see Tracer.now), or None if there is no sound / pause running
+        self._sound_start_time: Optional[int] = None
+        self._pause_start_time: Optional[int] = None
+        # Checks if the click that is playing is done (only without a display)
+        self._click_check: Optional[asyncio.TimerHandle] = None
+
         self._arm_pos = "Relay"
 
         self._target = ""
@@ -100,71 +189,128 @@ class PygameWrapper:
 
     def _requestUnprintedMessagesFromServer(self) -> None:
         """
-        This will start a thread that will handle the request to the server to ask for unprinted messages.
+        This will start a task that will handle the request to the server to ask for unprinted messages.
         :return:
         """
-        try:
-            if self._request_message_to_be_printed_thread is not None:
-                self._request_message_to_be_printed_thread.join()
-        except Exception:
-            pass
-        self._request_message_to_be_printed_thread = threading.Thread(target=self._doServerRequest)
-        self._request_message_to_be_printed_thread.start()
-
-    def _doServerRequest(self) -> None:
-        try:
-            r = requests.get(f"{self.SERVER_URL}/messages/unprinted/")
-        except requests.exceptions.ConnectionError:
-            logging.error("Failed to connect to the server")
-            self._request_message_pending = False
+        if self._server_request_task is not None and not self._server_request_task.done():
+            # The previous request is still running. It has a timeout, so it will schedule the next one when it's done
             return
-        if r.status_code == 200:
-            data = r.json()
-            if data:
-                logging.info("Message from server obtained")
+        self._server_request_task = self._loop.create_task(self._doServerRequest())
 
-                self._last_printed_message_id = data[0]["id"]
+    async def _getWaitingPriority(self) -> Optional[int]:
+        """
+        Ask the server if there is anything to claim. As long as the queue is empty this is a conditional GET, which
+        the server answers without looking at its database.
+        :return: The highest priority of the waiting messages, or None if there are none
+        """
+        result = await self._server.getUnprintedMessages(self._empty_queue_etag, self._station)
+        if result is None:
+            return 0  # No idea, so just try to claim
+        etag, messages = result
+        if messages is None:
+            return None  # Still empty
+        # Only keep the tag if the queue is empty. Messages claimed by another telegraph become available again once
+        # their claim runs out, without the queue changing.
+        self._empty_queue_etag = etag if not messages else None
+        return max((message.get("priority", 0) for message in messages), default=None)
+
+    def _isCoolingDown(self) -> bool:
+        """
+        :return: If the pause after the last printed message is still running
+        """
+        return self._cooldown_end_time is not None and self._loop.time() < self._cooldown_end_time
 
-                if data[0]["direction"] == "Outgoing":
-                    self._sound.playBellDouble()
-                    self.markMessageAsPrinted(self._last_printed_message_id)
-                    self._request_message_pending = False
+    async def _doServerRequest(self) -> None:
+        try:
+            await self._claimNextMessage()
+        except Exception:
+            logging.exception("Failed to get a message from the server")
+            # Don't print half a message
+            self._message_queue.queue.clear()
+            self._finishRequest()
+
+    async def _claimNextMessage(self) -> None:
+        start_time = Tracer.now()
+        if not self._is_registered:
+            self._is_registered = await self._server.registerStation(self._station, self._targets)
+            if not self._is_registered:
+                logging.error("Failed to register with the server")
+                self._finishRequest()
+                return
+            logging.info(f"Registered as station {self._station} for {', '.join(self._targets)}")
+        waiting_priority = await self._getWaitingPriority()
+        self._startup_timer.finish("first poll", self._tracer)
+        if waiting_priority is None:
+            self._finishRequest()
+            return
+        if waiting_priority < self.URGENT_PRIORITY and self._isCoolingDown():
+            # Only urgent messages are printed right after the previous one
+            self._finishRequest()
+            return
+        # Don't claim anything that can't be printed yet
+        await self._hardware_ready.wait()
+        # Messages that have been printed, but of which the server didn't get the acknowledgement yet, are still
+        # claimed by us. Claim enough to get at least one new message, and skip those.
+        data = await self._server.claimMessages(self._station, 1 + self._outbox.getNumPendingPrintAcks())
+        if data is None:
+            logging.error("Failed to claim messages from the server")
+            self._finishRequest()
+            return
+        data = [message for message in data if not self._outbox.hasPendingPrintAck(message["id"])]
+        if data:
+            logging.info("Message from server obtained")
+
+            self._last_printed_message_id = data[0]["id"]
+            self._tracer.startMessage(self._last_printed_message_id, start_time)
+            self._tracer.addSpan("server_fetch", start_time)
+
+            if data[0]["direction"] == "Outgoing":
+                self._sound.playBellDouble()
+                self.markMessageAsPrinted(self._last_printed_message_id)
+                self._finishTrace()
+                self._finishRequest()
+            else:
+                if data[0]["type"] == "morse":
+                    logging.info("Got a morse message ")
+                    for char in data[0]["encoded_text"]:
+                        self._message_queue.put(char)
+                    self._printing_morse = True
                 else:
-                    if data[0]["type"] == "morse":
-                        logging.info("Got a morse message ")
-                        for char in data[0]["encoded_text"]:
-                            self._message_queue.put(char)
-                        self._printing_morse = True
+                    logging.info("Got a grid message ")
+                    self._message_queue.put("--header--")
+                    self._target = data[0]["target"]
+                    #self._message_queue.put("--intro--")
+                    #self._message_queue.put("--intro2--")
+
+                    if data[0].get("grid") is not None:
+                        rows, _ = GridCodec.decodeRows(base64.b64decode(data[0]["grid"]))
+                        for row in rows:
+                            self._message_queue.put("".join(row))
                     else:
-                        logging.info("Got a grid message ")
-                        self._message_queue.put("--header--")
-                        self._target = data[0]["target"]
-                        #self._message_queue.put("--intro--")
-                        #self._message_queue.put("--intro2--")
-
+                        # Grid messages from before the grids were packed
                         for line in data[0]["encoded_text"].split("\n"):
-                            self._message_queue.put(line)
-                        self._message_queue.put("--footer--")
-                        self._printing_morse = False
-
-                    self._peripheral_controller.setActiveLed(Target.getIndex(data[0]["target"]))
-                    self._peripheral_controller.setVoltMeterActive(True)
-                    self._start_playing_message = True
-                    # If we got a message from the server that was typed by the players, we only want to play the
-                    # sounds. We don't want to print the message.
-                    self._printer.setEnabled(data[0]["direction"] == "Incoming")
-            else:
-                self._request_message_pending = False
+                            self._message_queue.put(line.replace(" ", ""))
+                    self._message_queue.put("--footer--")
+                    self._printing_morse = False
+
+                self._peripheral_controller.setActiveLed(Targets.getIndex(data[0]["target"]))
+                self._peripheral_controller.setVoltMeterActive(True)
+                # If we got a message from the server that was typed by the players, we only want to play the
+                # sounds. We don't want to print the message.
+                self._printer.setEnabled(data[0]["direction"] == "Incoming")
+                # Start the sounds
+                self._postEvent(sound_completed_event)
         else:
-            logging.error(f"Got non OK status code from server: {r.status_code}")
-            self._request_message_pending = False
+            self._finishRequest()
 
     @staticmethod
     def _setupLogging() -> None:
         root = logging.getLogger()
 
-        # Kick out the default handler
-        root.removeHandler(root.handlers[0])
+        # Kick out the default handler (which used to be installed as a side effect of importing escpos, before the
+        # printer was imported lazily)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
 
         root.setLevel(logging.DEBUG)
 
@@ -186,26 +332,118 @@ class PygameWrapper:
             if len(self._typed_text) > 0:
                 self._typed_text = self._typed_text[:-1]
         elif event.key == pygame.K_RETURN:  # Enter was pressed, send the message to the server
-            logging.info(f"Attempting to send the message: {self._typed_text}")
-            r = requests.post(f"{self.SERVER_URL}/messages/", json={"text": self._typed_text, "direction": "Outgoing",
-                                                                    "target": self._peripheral_controller.getArmPosition()})
-            logging.info(f"Sent message with status code {r.status_code}")
-            self._request_message_pending = False
+            logging.info(f"Queueing the message to be sent: {self._typed_text}")
+            self._outbox.addMessage(self._typed_text, self._peripheral_controller.getArmPosition())
+            self._outbox_changed.set()
+            self._finishRequest()
             self._typed_text = ""
         else:
             self._typed_text += event.unicode
 
-    @staticmethod
-    def _cancelEvent(event_type):
-        pygame.time.set_timer(event_type, 0)
+    def _cancelEvent(self, event_type) -> None:
+        timer = self._timers.pop(event_type, None)
+        if timer is not None:
+            timer.cancel()
 
-    def markMessageAsPrinted(self, message_id):
-        requests.post(f"{self.SERVER_URL}/messages/{message_id}/mark_as_printed")
+    def _postEvent(self, event_type) -> None:
+        self._event_queue.put_nowait(pygame.event.Event(event_type))
 
-    @staticmethod
-    def _triggerEvent(event_type, min_time: int, max_time: int = 0) -> None:
+    def _onTimerExpired(self, event_type) -> None:
+        self._timers.pop(event_type, None)
+        self._postEvent(event_type)
+
+    def _onHeadlessKeyPressed(self, key: int, unicode: str) -> None:
+        self._event_queue.put_nowait(pygame.event.Event(pygame.KEYDOWN, key=key, unicode=unicode))
+
+    def markMessageAsPrinted(self, message_id) -> None:
+        self._outbox.addPrintAck(message_id)
+        self._outbox_changed.set()
+
+    async def _flushOutbox(self) -> None:
+        """
+        Send everything in the outbox to the server, in the order it was added. If the server can't be reached, the
+        entries stay where they are and are tried again a bit later.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._outbox_changed.wait(), self.OUTBOX_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._outbox_changed.clear()
+
+            while await self._flushOutboxBatch():
+                pass
+
+    async def _flushOutboxBatch(self) -> bool:
+        """
+        :return: True if a full batch was sent (and there might be more to send)
         """
-        Trigger an event for the pygame loop
+        handled_entries = []
+        messages = self._outbox.getPendingMessages(self.OUTBOX_BATCH_SIZE)
+        for entry_id, message in messages:
+            # Entries from before the outbox gave messages an id don't have one
+            result = await self._server.sendMessage(message["text"], message["target"], message.get("client_id"))
+            if result == SendResult.FAILED:
+                break
+            if result == SendResult.REJECTED:
+                # Sending it again won't change that, and it would hold up everything that's queued behind it
+                logging.error(f"Server rejected message, dropping it: {message['text']} (to {message['target']})")
+            else:
+                logging.info(f"Sent message: {message['text']}")
+            handled_entries.append(entry_id)
+        self._outbox.remove(handled_entries)
+        if len(handled_entries) != len(messages):
+            return False  # Server is unreachable, no use in trying the acknowledgements now
+
+        print_acks = self._outbox.getPendingPrintAcks(self.OUTBOX_BATCH_SIZE)
+        if print_acks:
+            if not await self._server.acknowledgePrinted([message_id for _, message_id in print_acks]):
+                return False
+            self._outbox.remove([entry_id for entry_id, _ in print_acks])
+        return len(messages) == self.OUTBOX_BATCH_SIZE or len(print_acks) == self.OUTBOX_BATCH_SIZE
+
+    async def _logServerStatistics(self) -> None:
+        while True:
+            await asyncio.sleep(self.SERVER_STATISTICS_LOG_INTERVAL)
+            self._server.logStatistics()
+
+    async def _runOnPrinter(self, printer_function: Callable[..., bool], *args) -> bool:
+        """
+        Run a (blocking) printer call on the printer thread so that the loop keeps handling input in the meantime.
+        If the printer doesn't respond in time, it's handled like any other print failure.
+        """
+        start_time = Tracer.now()
+        try:
+            return await asyncio.wait_for(
+                self._loop.run_in_executor(self._printer_executor, printer_function, *args), self.PRINTER_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"Printer didn't respond within {self.PRINTER_TIMEOUT} seconds")
+            return False
+        finally:
+            # Includes the paper check (which is traced on its own as well) and waiting for the printer thread
+            self._tracer.addSpan(f"printer.{printer_function.__name__}", start_time)
+
+    def _finishTrace(self) -> None:
+        self._tracer.finishMessage()
+        # Writing the trace takes a bit, so don't do it on the loop
+        self._loop.run_in_executor(None, self._tracer.write)
+
+    def _startSound(self) -> None:
+        self._sound_start_time = Tracer.now()
+        if self._headless and self._click_check is None:
+            self._click_check = self._loop.call_later(self.CLICK_CHECK_TIME, self._checkClickCompleted)
+
+    def _checkClickCompleted(self) -> None:
+        if self._sound.hasClickCompleted():
+            self._click_check = None
+            self._postEvent(sound_completed_event)
+        else:
+            self._click_check = self._loop.call_later(self.CLICK_CHECK_TIME, self._checkClickCompleted)
+
+    def _triggerEvent(self, event_type, min_time: int, max_time: int = 0) -> None:
+        """
+        Trigger an event for the event loop. Like the pygame timers, setting a timer for an event that is already
+        pending replaces it
         :param event_type:
         :param min_time: The minimum time it should take for this to be triggered.
         :param max_time: The max time that this event should be triggered in. If left to 0, no randomness is aplied and
@@ -213,131 +451,270 @@ class PygameWrapper:
         :return:
         """
         time_to_use = random.randint(min_time, max_time) if max_time != 0 else min_time
-        pygame.time.set_timer(event_type, time_to_use, loops=1)
+        self._cancelEvent(event_type)
+        self._timers[event_type] = self._loop.call_later(time_to_use / 1000, self._onTimerExpired, event_type)
 
     def run(self) -> None:
-        logging.info("Display has started")
+        asyncio.run(self._run())
+        quit()
+
+    async def _initHardware(self) -> None:
+        """
+        Set up the printer, the sounds and the serial connection. Each takes a while (importing escpos, loading all the
+        sounds, trying every serial port), so they are set up in parallel, while the server is already being polled.
+        If any of them fails, the telegraph stops; It is restarted by its service, just like when it failed on startup.
+        """
+        try:
+            await asyncio.gather(
+                # The printer is only ever used from the printer thread, so create it there as well
+                self._loop.run_in_executor(self._printer_executor, self._initPrinter),
+                self._loop.run_in_executor(None, self._initSound),
+                self._loop.run_in_executor(None, self._initPeripherals),
+            )
+        except Exception:
+            logging.exception("Failed to set up the hardware")
+            self._stopRunning()
+            return
+        self._hardware_ready.set()
+
+    def _initPrinter(self) -> None:
+        with self._startup_timer.measure("init.printer"):
+            from Printer import Printer
+            self._printer = Printer(self._tracer)
+
+    def _initSound(self) -> None:
+        with self._startup_timer.measure("init.sound"):
+            self._sound = SoundController(use_end_event=not self._headless)
+
+    def _initPeripherals(self) -> None:
+        with self._startup_timer.measure("init.peripherals"):
+            self._peripheral_controller.start()
+
+    async def _run(self) -> None:
+        logging.info("Display has started" if not self._headless else "Telegraph has started without a display")
+        self._loop = asyncio.get_running_loop()
+        self._event_queue = asyncio.Queue()
+        self._outbox_changed = asyncio.Event()
+        self._hardware_ready = asyncio.Event()
+        self._stopped = asyncio.Event()
+        if self._outbox.getNumPending():
+            # Left over from a previous run
+            self._outbox_changed.set()
         self._is_running = True
-        self._peripheral_controller.start()
-        while self._is_running:
-            if self._start_playing_message:  # Flag that we flip if we want to start the sounds
-                pygame.event.post(pygame.event.Event(sound_completed_event))
-                self._start_playing_message = False
-
-            if not self._request_message_pending:  # We're not waiting for an update from the server
-                self._triggerEvent(request_update_server_event, self.REQUEST_UPDATE_TIME)
-                self._request_message_pending = True
-
-            for event in pygame.event.get():
-                if event.type == pygame.KEYDOWN:
-                    self._handleKeyDownEvent(event)
-
-                if event.type == pygame.QUIT:
-                    self._is_running = False
-                    break
-
-                if event.type == sound_completed_event or event.type == retry_printer_not_found_event:
-                    # The sound that was running has completed or the timeout for failure was hit.
-                    if not self._message_queue.queue:
-                        logging.info("Queue is empty")
-
-                        if self._printer.feedPaper():
-                            logging.info("Message has been printed!")
-                            # Notify the server that the message has been printed
-                            self.markMessageAsPrinted(self._last_printed_message_id)
-                            self._sound.playBell()
-                            # Disable the LED again!
-                            self._peripheral_controller.setActiveLed(-1)
-                            self._peripheral_controller.setVoltMeterActive(False)
-                            # Only start requesting new messages again after a certain time.
-                            # This will ensure that messages don't get mushed together.
-                            self._triggerEvent(request_update_server_event, self.MIN_TIME_BETWEEN_MESSAGES)
-                        else:
-                            # Set an event to try again after some time
-                            self._triggerEvent(retry_printer_not_found_event, self.RETRY_PRINTER_NOT_FOUND_TIME)
-                        continue
-                    if self._message_queue.queue[0] == " ":
-                        self._triggerEvent(pause_between_tick_event, self.MIN_SPACE_PAUSE, self.MAX_SPACE_PAUSE)
+        if self._headless:
+            # SDL grabs the termination signals and turns them into pygame.QUIT, but there is no event queue to get
+            # it from.
+            for signal_number in (signal.SIGINT, signal.SIGTERM):
+                self._loop.add_signal_handler(signal_number, self._stopRunning)
+
+        async with self._server:
+            hardware_initializer = self._loop.create_task(self._initHardware())
+            # Don't wait for the first timer to ask the server for messages
+            self._request_message_pending = True
+            self._requestUnprintedMessagesFromServer()
+            keyboard = None
+            if self._headless:
+                keyboard = createHeadlessKeyboard(self._onHeadlessKeyPressed, self._keyboard_device)
+                keyboard.start(self._loop)
+            dispatcher = self._loop.create_task(self._dispatchEvents())
+            statistics_logger = self._loop.create_task(self._logServerStatistics())
+            outbox_flusher = self._loop.create_task(self._flushOutbox())
+            try:
+                if self._headless:
+                    # Everything comes in through the keyboard, the timers and the click checks, nothing to poll
+                    await self._stopped.wait()
+                else:
+                    while self._is_running:
+                        for event in pygame.event.get():
+                            self._event_queue.put_nowait(event)
+                        await asyncio.sleep(self.LOOP_TICK_TIME)
+            finally:
+                if keyboard is not None:
+                    keyboard.stop()
+                for timer in self._timers.values():
+                    timer.cancel()
+                self._timers.clear()
+                if self._click_check is not None:
+                    self._click_check.cancel()
+                hardware_initializer.cancel()
+                dispatcher.cancel()
+                statistics_logger.cancel()
+                outbox_flusher.cancel()
+                if self._outbox.getNumPending():
+                    logging.info(f"{self._outbox.getNumPending()} entries left in the outbox, sending them after restart")
+                self._outbox.close()
+                self._server.logStatistics()
+                self._tracer.write()
+                self._peripheral_controller.stop()
+                self._printer_executor.shutdown(wait=False)
+
+    async def _dispatchEvents(self) -> None:
+        """
+        Handle the events one by one. While an event is being handled (eg; waiting for the printer) other events are
+        queued up, so the message state is never touched by two events at the same time.
+        """
+        while True:
+            event = await self._event_queue.get()
+            try:
+                await self._handleEvent(event)
+            except Exception:
+                logging.exception(f"Failed to handle event {event}")
+
+    def _stopRunning(self) -> None:
+        self._is_running = False
+        self._stopped.set()
+
+    def _finishRequest(self) -> None:
+        """
+        Done with the current message (or with typing), ask the server for the next one in a bit.
+        """
+        self._request_message_pending = False
+        self._checkMessageFlags()
+
+    def _checkMessageFlags(self) -> None:
+        if not self._request_message_pending:  # We're not waiting for an update from the server
+            self._triggerEvent(request_update_server_event, self.REQUEST_UPDATE_TIME)
+            self._request_message_pending = True
+
+    async def _handleEvent(self, event: Event) -> None:
+        if event.type == pygame.KEYDOWN:
+            self._handleKeyDownEvent(event)
+
+        if event.type == pygame.QUIT:
+            self._stopRunning()
+            return
+
+        if event.type == sound_completed_event or event.type == retry_printer_not_found_event:
+            # The sound that was running has completed or the timeout for failure was hit.
+            if event.type == sound_completed_event and self._sound_start_time is not None:
+                self._tracer.addSpan("sound", self._sound_start_time)
+                self._sound_start_time = None
+            if not self._message_queue.queue:
+                logging.info("Queue is empty")
+
+                if await self._runOnPrinter(self._printer.feedPaper):
+                    logging.info("Message has been printed!")
+                    # Notify the server that the message has been printed
+                    self.markMessageAsPrinted(self._last_printed_message_id)
+                    self._finishTrace()
+                    self._sound.playBell()
+                    # Disable the LED again!
+                    self._peripheral_controller.setActiveLed(-1)
+                    self._peripheral_controller.setVoltMeterActive(False)
+                    # Only start printing new messages again after a certain time (unless they are urgent).
+                    # This will ensure that messages don't get mushed together.
+                    self._cooldown_end_time = self._loop.time() + self.MIN_TIME_BETWEEN_MESSAGES / 1000
+                    self._triggerEvent(request_update_server_event, self.REQUEST_UPDATE_TIME)
+                else:
+                    # Set an event to try again after some time
+                    self._triggerEvent(retry_printer_not_found_event, self.RETRY_PRINTER_NOT_FOUND_TIME)
+                return
+            self._pause_start_time = Tracer.now()
+            if self._message_queue.queue[0] == " ":
+                self._triggerEvent(pause_between_tick_event, self.MIN_SPACE_PAUSE, self.MAX_SPACE_PAUSE)
+            else:
+                # Set a new event to put some pause between the ticks
+                if self._printing_morse:
+                    self._triggerEvent(pause_between_tick_event, self.MIN_CHAR_PAUSE, self.MAX_CHAR_PAUSE)
+                else:
+                    self._triggerEvent(pause_between_tick_event, self.MIN_ROW_PAUSE, self.MAX_ROW_PAUSE)
+
+        elif event.type == pause_between_tick_event: # The pause between sounds has completed. What is the next sound that we have to play?
+            if self._pause_start_time is not None:
+                self._tracer.addSpan("pause", self._pause_start_time)
+                self._pause_start_time = None
+            failed_to_print = False
+            text_to_print = self._message_queue.get()
+            if self._printing_morse:
+                # We're printing char by char
+
+                if text_to_print == " ":
+                    # Print the message (although we might want to start that when we get the message tho?
+                    if await self._runOnPrinter(self._printer.printSpace):
+                        # Post a "fake" sound completed event, this will trigger the next sound to be played.
+                        self._postEvent(sound_completed_event)
+                        return  # We already did the pause, move on!
                     else:
-                        # Set a new event to put some pause between the ticks
-                        if self._printing_morse:
-                            self._triggerEvent(pause_between_tick_event, self.MIN_CHAR_PAUSE, self.MAX_CHAR_PAUSE)
-                        else:
-                            self._triggerEvent(pause_between_tick_event, self.MIN_ROW_PAUSE, self.MAX_ROW_PAUSE)
-
-                elif event.type == pause_between_tick_event: # The pause between sounds has completed. What is the next sound that we have to play?
-                    failed_to_print = False
-                    text_to_print = self._message_queue.get()
-                    if self._printing_morse:
-                        # We're printing char by char
-
-                        if text_to_print == " ":
-                            # Print the message (although we might want to start that when we get the message tho?
-                            if self._printer.printSpace():
-                                # Post a "fake" sound completed event, this will trigger the next sound to be played.
-                                pygame.event.post(pygame.event.Event(sound_completed_event))
-                                continue  # We already did the pause, move on!
-                            else:
-                                failed_to_print = True
-
-                        if text_to_print == "-":
-                            if self._printer.printImage("dash.png"):
-                                self._sound.playLongClick()
-                            else:
-                                failed_to_print = True
-                        else:
-                            if self._printer.printImage("dot.png"):
-                                self._sound.playShortClick()
-                            else:
-                                failed_to_print = True
-                    else: # We're printing grids
-                        if text_to_print.startswith("--") and text_to_print.endswith("--"):
-                            logging.info("Printing special instruction")
-                            if "header" in text_to_print:
-                                self._printer.printImage("Divider.png")
-                                self._printer.feedSingle()
-                                self._printer.feedSingle()
-                            elif "footer" in text_to_print:
-                                self._printer.feedSingle()
-                                self._printer.printImage("DividerFlipped.png")
-                            elif "--intro--" in text_to_print:
-
-                                self._printer.printSingleLineText(f"Origin: {self._target}")
-                            elif "--intro2--" in text_to_print:
-                                self._printer.printSingleLineText(f"Encoded message follows")
-                            self._sound.playLongClick()
-                            pass
-
-                        else:
-                            # Printing normal characters
-                            if self._printer.printGridTextLine(text_to_print):
-                                self._sound.playLongClick()
-                                # Maye we should randomly play either? idk..
-                            else:
-                                failed_to_print = True
-
-                    if failed_to_print:
-                        logging.warning("Failed to print, scheduling again until printer is back")
-                        self._message_queue.queue.insert(0, text_to_print)
-                        # Set an event to try again after some time
-                        self._triggerEvent(retry_printer_not_found_event, self.RETRY_PRINTER_NOT_FOUND_TIME)
-
-                elif event.type == request_update_server_event:
-                    self._requestUnprintedMessagesFromServer()
-                elif event.type == message_typing_timeout_event:
-                    logging.info("Typing timeout.")
-                    self._typed_text = ""
-                    self._request_message_pending = False
-        self._peripheral_controller.stop()
-        quit()
+                        failed_to_print = True
+
+                if text_to_print == "-":
+                    if await self._runOnPrinter(self._printer.printImage, "dash.png"):
+                        self._sound.playLongClick()
+                        self._startSound()
+                    else:
+                        failed_to_print = True
+                else:
+                    if await self._runOnPrinter(self._printer.printImage, "dot.png"):
+                        self._sound.playShortClick()
+                        self._startSound()
+                    else:
+                        failed_to_print = True
+            else: # We're printing grids
+                if text_to_print.startswith("--") and text_to_print.endswith("--"):
+                    logging.info("Printing special instruction")
+                    if "header" in text_to_print:
+                        await self._runOnPrinter(self._printer.printImage, "Divider.png")
+                        await self._runOnPrinter(self._printer.feedSingle)
+                        await self._runOnPrinter(self._printer.feedSingle)
+                    elif "footer" in text_to_print:
+                        await self._runOnPrinter(self._printer.feedSingle)
+                        await self._runOnPrinter(self._printer.printImage, "DividerFlipped.png")
+                    elif "--intro--" in text_to_print:
+
+                        await self._runOnPrinter(self._printer.printSingleLineText, f"Origin: {self._target}")
+                    elif "--intro2--" in text_to_print:
+                        await self._runOnPrinter(self._printer.printSingleLineText, f"Encoded message follows")
+                    self._sound.playLongClick()
+                    self._startSound()
+
+                else:
+                    # Printing normal characters
+                    if await self._runOnPrinter(self._printer.printGridTextLine, text_to_print):
+                        self._sound.playLongClick()
+                        self._startSound()
+                        # Maye we should randomly play either? idk..
+                    else:
+                        failed_to_print = True
+
+            if failed_to_print:
+                logging.warning("Failed to print, scheduling again until printer is back")
+                self._message_queue.queue.insert(0, text_to_print)
+                # Set an event to try again after some time
+                self._triggerEvent(retry_printer_not_found_event, self.RETRY_PRINTER_NOT_FOUND_TIME)
+
+        elif event.type == request_update_server_event:
+            self._requestUnprintedMessagesFromServer()
+        elif event.type == message_typing_timeout_event:
+            logging.info("Typing timeout.")
+            self._typed_text = ""
+            self._finishRequest()
 
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-w", "--windowed", action="store_true")
+    parser.add_argument("--headless", action="store_true", help="Run without a display, only using the mixer")
+    parser.add_argument("--keyboard", default=None, help="evdev device to read the keyboard from in headless mode")
+    parser.add_argument("--server", default=PygameWrapper.SERVER_URL, help="Url of the message server")
+    parser.add_argument("--connect-timeout", type=float, default=2.0,
+                        help="Seconds to wait for a connection to the server")
+    parser.add_argument("--read-timeout", type=float, default=5.0, help="Seconds to wait for the server to respond")
+    parser.add_argument("--retries", type=int, default=3, help="How often failed requests to the server are retried")
+    parser.add_argument("--station", default=None, help="Name of this telegraph on the server (defaults to hostname)")
+    parser.add_argument("--targets", default=None, type=lambda targets: targets.split(","),
+                        help="Comma separated targets of which this telegraph prints the messages (eg; Relay,Logistics)."
+                             " If not set, it prints the messages that aren't for any other telegraph")
+    parser.add_argument("--outbox", default="telegraph_outbox.db",
+                        help="File in which messages and print acknowledgements are kept until the server has them")
+    parser.add_argument("--trace", default="telegraph_trace.json",
+                        help="File to write the trace of the last messages to (Chrome trace format)")
 
     args = parser.parse_args()
-    wrapper = PygameWrapper(fullscreen=not args.windowed)
+    server = ServerClient(args.server, connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                          max_retries=args.retries)
+    wrapper = PygameWrapper(fullscreen=not args.windowed, headless=args.headless, keyboard_device=args.keyboard,
+                            server_client=server, outbox=Outbox(args.outbox), station=args.station,
+                            targets=args.targets, tracer=Tracer(args.trace), startup_timer=startup_timer)
 
     wrapper.run()
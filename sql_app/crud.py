@@ -1,157 +1,702 @@
-from typing import Optional, List
+from typing import Any, Dict, Optional, List, Sequence, Set, Tuple, Union
 
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, func, insert, literal, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 
+from GridCodec import GridCodec
+from KeyGenerator import KeyGenerator
+from LeakageAuditor import AuditedKey, LeakageAuditor
 from MorseTranslator import MorseTranslator
-from . import models, schemas
+from . import key_cache, models, print_estimate, queue_version, schemas, station_routes
+from .grid_composer import grid_width
 
-from datetime import datetime
-import random
+from datetime import datetime, timedelta
+import logging
 # Some hardcoded stuff regarding encryption. I know, not the greatest. Sue me
-grid_width = 10
 min_code_length = 6
 max_code_length = 10
 max_skip_value = 9
-
-def getAllMessages(db: Session):
-    return db.query(models.Message).all()
-
-
-def getMessageById(message_id: int, db: Session) -> Optional[models.Message]:
-    return db.query(models.Message).filter(models.Message.id == message_id).first()
-
-
-def deleteMessageById(message_id: int, db: Session):
-    db.delete(getMessageById(message_id, db))
-    db.commit()
-
-def deleteEncryptionKeyById(encryption_key_id: int, db: Session):
-    db.delete(getEncryptionKeyById(encryption_key_id, db))
-    db.commit()
-
-def getEncryptionKeyById(encryption_key_id: int, db: Session) -> Optional[models.EncryptionKey]:
-    return db.query(models.EncryptionKey).filter(models.EncryptionKey.id == encryption_key_id).first()
-
-
-def getAllUnprintedMessages(db: Session) -> List[models.Message]:
-    return db.query(models.Message).filter(models.Message.time_printed == None)
+max_key_generation_attempts = 10
+# Sqlite before 3.32 allows at most 999 bound parameters in a statement, so long lists of values are sent in chunks
+max_query_parameters = 500
+
+logger = logging.getLogger('uvicorn.error')
+
+key_generator = KeyGenerator(num_columns=grid_width, min_key_length=min_code_length, max_key_length=max_code_length,
+                             max_skip=max_skip_value)
+
+# Words that are considered readable when they are decoded from a grid with the wrong key
+leakage_words = LeakageAuditor.loadWords()
+
+
+class KeyNotUniqueError(Exception):
+    pass
+
+
+def _getSummaryColumns(model) -> list:
+    """
+    :param model: models.Message or models.ArchivedMessage
+    """
+    return [column for column in model.__table__.columns if column.name in models.Message.__table__.columns
+            and column.name not in ("encoded_text", "grid")]
+
+
+# Everything but the encoded text and the grid, which are by far the biggest part of a message.
+_message_summary_columns = _getSummaryColumns(models.Message)
+_archived_message_summary_columns = _getSummaryColumns(models.ArchivedMessage)
+
+
+async def getMessages(message_filter: schemas.MessageFilter, limit: int, db: AsyncSession,
+                      before_id: Optional[int] = None, after_id: Optional[int] = None,
+                      include_encoded_text: bool = False) -> List[Dict[str, Any]]:
+    """
+    Get a page of messages, newest first. Paging is done on the message id (instead of an offset), so getting the next
+    page stays just as cheap no matter how many messages there are. Archived messages are included, as if they were
+    never moved.
+    :param before_id: Only get messages older than this one (ie; the last id of the previous page)
+    :param after_id: Only get messages newer than this one
+    :return: The messages as dicts with the columns of the message (without encoded_text, unless asked for)
+    """
+    messages = await _getMessagesFrom(models.Message, _message_summary_columns, message_filter, limit, db, before_id,
+                                      after_id, include_encoded_text)
+    # Only printed messages are archived
+    if message_filter.printed is not False:
+        if len(messages) == limit:
+            # Archived messages that are older than the whole page don't end up on it anyway
+            after_id = max(after_id if after_id is not None else 0, messages[-1]["id"])
+        messages += await _getMessagesFrom(models.ArchivedMessage, _archived_message_summary_columns, message_filter,
+                                           limit, db, before_id, after_id, include_encoded_text)
+        messages.sort(key=lambda message: message["id"], reverse=True)
+        del messages[limit:]
+    return messages
+
+
+async def _getMessagesFrom(model, columns: list, message_filter: schemas.MessageFilter, limit: int, db: AsyncSession,
+                           before_id: Optional[int], after_id: Optional[int],
+                           include_encoded_text: bool) -> List[Dict[str, Any]]:
+    """
+    See getMessages
+    :param model: models.Message or models.ArchivedMessage
+    :param columns: The summary columns of the model
+    """
+    columns = list(columns)
+    if include_encoded_text:
+        columns += [model.stored_encoded_text, model.grid]
+    query = select(*columns).order_by(model.id.desc()).limit(limit)
+
+    if before_id is not None:
+        query = query.where(model.id < before_id)
+    if after_id is not None:
+        query = query.where(model.id > after_id)
+    if message_filter.direction is not None:
+        query = query.where(model.direction == message_filter.direction.value)
+    if message_filter.target is not None:
+        query = query.where(model.target == message_filter.target.value)
+    if message_filter.type is not None:
+        query = query.where(model.type == message_filter.type.value)
+    if message_filter.sent_after is not None:
+        query = query.where(model.time_sent >= message_filter.sent_after)
+    if message_filter.sent_before is not None:
+        query = query.where(model.time_sent < message_filter.sent_before)
+    if message_filter.station is not None:
+        query = query.where(model.station == message_filter.station)
+    if message_filter.printed is not None:
+        if message_filter.printed:
+            query = query.where(model.time_printed != None)
+        else:
+            query = query.where(model.time_printed == None)
+
+    messages = [dict(row) for row in (await db.execute(query)).mappings()]
+    if include_encoded_text:
+        for message in messages:
+            grid = message.pop("grid")
+            stored_encoded_text = message.pop("stored_encoded_text")
+            message["encoded_text"] = GridCodec.toText(grid) if grid is not None else stored_encoded_text
+    return messages
+
+async def getMessageById(message_id: int, db: AsyncSession) -> Optional[models.Message]:
+    return await db.get(models.Message, message_id)
+
+
+async def getArchivedMessageById(message_id: int, db: AsyncSession) -> Optional[models.ArchivedMessage]:
+    return await db.get(models.ArchivedMessage, message_id)
+
+
+async def _restoreArchivedMessage(message_id: int, db: AsyncSession) -> Optional[models.Message]:
+    """
+    Move an archived message back to the messages (without committing). The stations might have changed since it was
+    printed, so it's routed again.
+    """
+    db_archived_message = await getArchivedMessageById(message_id, db)
+    if db_archived_message is None:
+        return None
+    db_message = models.Message(**{attribute.key: getattr(db_archived_message, attribute.key)
+                                   for attribute in models.Message.__mapper__.column_attrs})
+    db_message.station = (await getStationRoutes(db)).get(db_message.target)
+    await db.delete(db_archived_message)
+    db.add(db_message)
+    return db_message
 
 
-def reprintMessage(message_id: int, db: Session):
-    db_message = getMessageById(message_id, db)
+async def archiveMessages(printed_before: datetime, batch_size: int, db: AsyncSession) -> int:
+    """
+    Move the messages that were printed before the given time to the archive, a batch at a time (so the telegraphs
+    never have to wait long for the database). The ids of the messages table are AUTOINCREMENT, so the ids of archived
+    messages are never handed out again.
+    :return: The number of messages that were archived
+    """
+    num_archived = 0
+    columns = [column.name for column in models.Message.__table__.columns]
+    while True:
+        message_ids = list(await db.scalars(
+            select(models.Message.id)
+            .where(models.Message.time_printed < printed_before)
+            .order_by(models.Message.id)
+            .limit(batch_size)
+        ))
+        if not message_ids:
+            return num_archived
+        await db.execute(
+            insert(models.ArchivedMessage).from_select(
+                columns + ["archived_at"],
+                select(*models.Message.__table__.columns, literal(datetime.now()))
+                .where(models.Message.id.in_(message_ids))
+            )
+        )
+        await db.execute(delete(models.Message).where(models.Message.id.in_(message_ids)))
+        await db.commit()
+        num_archived += len(message_ids)
+        if len(message_ids) < batch_size:
+            return num_archived
+
+
+async def deleteMessageById(message_id: int, db: AsyncSession):
+    db_message = await getMessageById(message_id, db)
+    if db_message is None:
+        # Archived messages aren't in any queue
+        await db.delete(await getArchivedMessageById(message_id, db))
+        await db.commit()
+        return
+    await db.delete(db_message)
+    await db.commit()
+    queue_version.bump(db_message.station)
+
+async def deleteEncryptionKeyById(encryption_key_id: int, db: AsyncSession):
+    db_key = await getEncryptionKeyById(encryption_key_id, db)
+    await db.delete(db_key)
+    await db.commit()
+    key_cache.invalidateGroupById(db_key.group_id)
+
+async def getEncryptionKeyById(encryption_key_id: int, db: AsyncSession) -> Optional[models.EncryptionKey]:
+    return await db.get(models.EncryptionKey, encryption_key_id)
+
+
+async def getAllUnprintedMessages(db: AsyncSession, station: Optional[str] = None) -> List[models.Message]:
+    """
+    :param station: Only get the messages that this station can print (those routed to it, and those that aren't routed
+    to any station)
+    """
+    query = select(models.Message).where(models.Message.time_printed == None).order_by(*_queue_order)
+    if station is not None:
+        query = query.where(_isForStation(station))
+    return list(await db.scalars(query))
+
+
+# The order in which unprinted messages are handed out
+_queue_order = (models.Message.priority.desc(), models.Message.id)
+
+
+def _isForStation(station: str):
+    return or_(models.Message.station == None, models.Message.station == station)
+
+
+async def getUnprintedStatistics(db: AsyncSession) -> Tuple[int, Optional[datetime]]:
+    """
+    :return: The number of unprinted messages and when the oldest of them was sent
+    """
+    row = (await db.execute(
+        select(func.count(models.Message.id), func.min(models.Message.time_sent))
+        .where(models.Message.time_printed == None)
+    )).one()
+    return row[0], row[1]
+
+
+async def getMessageQueue(db: AsyncSession, station: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Get the unprinted messages in the order in which they will be printed, with an estimate of when that will be (see
+    print_estimate). Every station prints its own queue; Messages that aren't routed to a station are estimated as a
+    queue of their own.
+    :param station: Only get the queue of this station, which includes the messages that aren't routed to a station
+    :return: The messages as dicts with the columns of the message summary, the print_duration, position,
+    estimated_start and estimated_done
+    """
+    now = datetime.now()
+    query = (
+        select(*_message_summary_columns, models.Message.stored_encoded_text, models.Message.grid)
+        .where(models.Message.time_printed == None)
+        .order_by(*_queue_order)
+    )
+    if station is not None:
+        query = query.where(_isForStation(station))
+
+    queues: Dict[Optional[str], List[Dict[str, Any]]] = {}
+    for row in (await db.execute(query)).mappings():
+        message = dict(row)
+        message["print_duration"] = print_estimate.getPrintDuration(
+            message["type"], message["direction"], message.pop("stored_encoded_text"), message.pop("grid"))
+        # The station prints the unrouted messages in between its own
+        queues.setdefault(message["station"] if station is None else station, []).append(message)
+
+    messages = []
+    for queue in queues.values():
+        # A message that is claimed (and of which the claim didn't expire) is being printed right now
+        queue.sort(key=lambda message: not (message["claim_expires"] is not None and message["claim_expires"] > now))
+        messages.extend(print_estimate.addEstimates(queue, now, schemas.Priority.urgent))
+    return messages
+
+
+async def reprintMessage(message_id: int, db: AsyncSession):
+    db_message = await getMessageById(message_id, db) or await _restoreArchivedMessage(message_id, db)
     db_message.time_printed = None
-    db.commit()
-
-
-def markMessageAsPrinted(message_id: int, db: Session):
-    db_message = getMessageById(message_id, db)
-    db_message.time_printed = datetime.now()
-    db.commit()
-
-
-def createMessage(db: Session, message: schemas.MorseMessage) -> models.Message:
+    db_message.claimed_by = None
+    db_message.claim_expires = None
+    await db.commit()
+    queue_version.bump(db_message.station)
+
+
+async def markMessageAsPrinted(message_id: int, db: AsyncSession) -> bool:
+    """
+    :return: False if the message doesn't exist
+    """
+    # No RETURNING (sqlite might be too old for it), so get the station first, in the same transaction.
+    stations = list(await db.scalars(select(models.Message.station).where(models.Message.id == message_id)))
+    if not stations:
+        return False
+    await db.execute(
+        update(models.Message)
+        .where(models.Message.id == message_id)
+        .values(time_printed=datetime.now(), claim_expires=None)
+    )
+    await db.commit()
+    queue_version.bump(stations[0])
+    return True
+
+
+async def claimMessages(station: str, count: int, lease_seconds: int, db: AsyncSession) -> List[models.Message]:
+    """
+    Reserve the next unprinted messages for a station. Messages that are claimed by another station (and of which that
+    claim hasn't expired yet) are skipped. Messages already claimed by the same station are handed out again, so a
+    station that restarted picks up where it left off. Messages that are routed to another station are never handed
+    out.
+    """
+    now = datetime.now()
+    claim_expires = now + timedelta(seconds=lease_seconds)
+    claimable_ids = (
+        select(models.Message.id)
+        .where(models.Message.time_printed == None)
+        .where(_isForStation(station))
+        .where(or_(models.Message.claim_expires == None,
+                   models.Message.claim_expires < now,
+                   models.Message.claimed_by == station))
+        .order_by(*_queue_order)
+        .limit(count)
+    )
+    # A single UPDATE, so two stations claiming at the same time can never get the same message.
+    await db.execute(
+        update(models.Message)
+        .where(models.Message.id.in_(claimable_ids))
+        .values(claimed_by=station, claim_expires=claim_expires)
+    )
+    await db.commit()
+    return list(await db.scalars(
+        select(models.Message)
+        .where(models.Message.claimed_by == station, models.Message.claim_expires == claim_expires)
+        .order_by(*_queue_order)
+    ))
+
+
+async def acknowledgeMessages(message_ids: List[int], db: AsyncSession) -> int:
+    """
+    Mark a number of messages as printed in one go.
+    :return: How many messages were marked as printed (messages that don't exist or were already printed don't count)
+    """
+    if not message_ids:
+        return 0
+    to_acknowledge = (models.Message.id.in_(message_ids), models.Message.time_printed == None)
+    # No RETURNING (sqlite might be too old for it), so get the stations first, in the same transaction.
+    stations = list(await db.scalars(select(models.Message.station).distinct().where(*to_acknowledge)))
+    result = await db.execute(
+        update(models.Message)
+        .where(*to_acknowledge)
+        .values(time_printed=datetime.now(), claim_expires=None)
+    )
+    await db.commit()
+    for station in stations:
+        queue_version.bump(station)
+    return result.rowcount
+
+
+async def getMessageByClientId(client_id: str, db: AsyncSession
+                               ) -> Optional[Union[models.Message, models.ArchivedMessage]]:
+    for model in (models.Message, models.ArchivedMessage):
+        db_message = await db.scalar(select(model).where(model.client_id == client_id))
+        if db_message is not None:
+            return db_message
+    return None
+
+
+async def createMessage(db: AsyncSession, message: schemas.MorseMessage
+                        ) -> Union[models.Message, models.ArchivedMessage]:
+    """
+    :return: The new message, or the one that was already sent with the same client_id
+    """
+    if message.client_id is not None:
+        db_message = await getMessageByClientId(message.client_id, db)
+        if db_message is not None:
+            return db_message
     db_message = models.Message(**message.dict())
     db_message.time_sent = datetime.now()
+    db_message.station = (await getStationRoutes(db)).get(db_message.target)
     if db_message.type == "morse":
-        db_message.encoded_text = MorseTranslator.textToMorse(db_message.text)
+        db_message.stored_encoded_text = MorseTranslator.textToMorse(db_message.text)
     else:
         print("UNKNOWN TYPE!")
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    await db.commit()
+    queue_version.bump(db_message.station)
+    await db.refresh(db_message)
     return db_message
 
-def createGridMessage(db: Session, primary_text, secondary_text, flat_grid_text: str, target: str, author: str) -> models.Message:
+async def createGridMessage(db: AsyncSession, primary_text, secondary_text, packed_grid: bytes, target: str,
+                            author: str, grid_keys: List[Dict[str, Any]],
+                            leakage_audit: Optional[dict] = None, priority: int = 0) -> models.Message:
+    """
+    :param packed_grid: See GridCodec
+    :param grid_keys: See models.Message.grid_keys
+    """
     db_message = models.Message(
         type="grid",
         text=primary_text,
         secondary_text=secondary_text,
-        encoded_text=flat_grid_text,
+        stored_encoded_text="",
+        grid=packed_grid,
+        grid_keys=grid_keys,
         direction="Incoming",
         target=target,
         time_sent=datetime.now(),
-        author=author
+        author=author,
+        leakage_audit=leakage_audit,
+        priority=priority,
+        station=(await getStationRoutes(db)).get(target)
     )
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    await db.commit()
+    queue_version.bump(db_message.station)
+    await db.refresh(db_message)
     return db_message
 
 
-def getGroupByName(group_name: str, db: Session) -> Optional[models.EncryptionGroup]:
-    return db.query(models.EncryptionGroup).filter(models.EncryptionGroup.name == group_name).first()
-
-
-def getGroupById(group_id: int, db: Session) -> Optional[models.EncryptionGroup]:
-    return db.query(models.EncryptionGroup).filter(models.EncryptionGroup.id == group_id).first()
-
-
-def getAllGroups(db: Session) -> List[models.EncryptionGroup]:
-    return db.query(models.EncryptionGroup).all()
-
-
-def createGroup(group: schemas.GroupCreate, db: Session) -> models.EncryptionGroup:
+async def getAllStations(db: AsyncSession) -> List[models.Station]:
+    return list(await db.scalars(select(models.Station).order_by(models.Station.name)))
+
+
+async def getStationRoutes(db: AsyncSession) -> Dict[str, str]:
+    """
+    :return: The name of the station of every target that has one (usually straight from the cache)
+    """
+    routes = station_routes.getRoutes()
+    if routes is None:
+        generation = station_routes.getGeneration()
+        routes = {target: station.name for station in await getAllStations(db) for target in station.targets}
+        station_routes.storeRoutes(routes, generation)
+    return routes
+
+
+async def registerStation(registration: schemas.StationRegistration, db: AsyncSession) -> models.Station:
+    """
+    Register a station, or update the targets of one that registered before. Targets that belonged to another station
+    are taken away from it. The unprinted messages of all targets that changed hands are routed again.
+    """
+    targets = [target.value for target in registration.targets]
+    db_station = None
+    changed_targets = set(targets)
+    for station in await getAllStations(db):
+        if station.name == registration.name:
+            db_station = station
+            changed_targets.symmetric_difference_update(station.targets)
+        elif set(station.targets) & set(targets):
+            changed_targets.update(set(station.targets) & set(targets))
+            station.targets = [target for target in station.targets if target not in targets]
+    if db_station is None:
+        db_station = models.Station(name=registration.name)
+        db.add(db_station)
+    db_station.targets = targets
+    db_station.registered_at = datetime.now()
+    await db.flush()
+    await _routeUnprintedMessages(changed_targets, db)
+    await db.commit()
+    _onRoutesChanged()
+    return db_station
+
+
+async def deleteStation(station: models.Station, db: AsyncSession) -> None:
+    """
+    The unprinted messages of the station can be printed by any station afterwards.
+    """
+    await db.delete(station)
+    await db.flush()
+    await _routeUnprintedMessages(set(station.targets), db)
+    await db.commit()
+    _onRoutesChanged()
+
+
+async def getStationByName(station_name: str, db: AsyncSession) -> Optional[models.Station]:
+    return await db.scalar(select(models.Station).where(models.Station.name == station_name))
+
+
+async def _routeUnprintedMessages(targets: Set[str], db: AsyncSession) -> None:
+    """
+    Route the unprinted messages of these targets to the station that has the target now. Must be called after the
+    stations changed (and have been flushed), in the same transaction.
+    """
+    routes = {target: station.name for station in await getAllStations(db) for target in station.targets}
+    for target in targets:
+        await db.execute(
+            update(models.Message)
+            .where(models.Message.target == target, models.Message.time_printed == None)
+            .values(station=routes.get(target))
+        )
+
+
+def _onRoutesChanged() -> None:
+    station_routes.invalidate()
+    # Messages moved between the queues of the stations
+    queue_version.bump()
+
+
+async def getGroupByName(group_name: str, db: AsyncSession) -> Optional[models.EncryptionGroup]:
+    return await db.scalar(select(models.EncryptionGroup).where(models.EncryptionGroup.name == group_name))
+
+
+async def getGroupById(group_id: int, db: AsyncSession) -> Optional[models.EncryptionGroup]:
+    return await db.get(models.EncryptionGroup, group_id)
+
+
+async def getAllGroups(db: AsyncSession) -> List[models.EncryptionGroup]:
+    return list(await db.scalars(select(models.EncryptionGroup)))
+
+
+async def getGroupsWithKeys(group_names: List[str], db: AsyncSession) -> Dict[str, models.EncryptionGroup]:
+    """
+    Get a number of groups, together with all of their keys, in a single query.
+    :return: The groups by name. Groups that don't exist are left out.
+    """
+    groups = await db.scalars(
+        select(models.EncryptionGroup)
+        .where(models.EncryptionGroup.name.in_(group_names))
+        .options(joinedload(models.EncryptionGroup.encryption_keys))
+    )
+    return {group.name: group for group in groups.unique()}
+
+
+async def getKeyRings(group_names: List[str], db: AsyncSession) -> Dict[str, Optional[key_cache.KeyRing]]:
+    """
+    Get the key rings of a number of groups. Only the groups that aren't in the key cache yet are loaded from the
+    database.
+    :return: The key rings by group name. None for groups that don't exist.
+    """
+    key_rings, missing_group_names = key_cache.getKeyRings(group_names)
+    if missing_group_names:
+        generation = key_cache.getGeneration()
+        groups = await getGroupsWithKeys(missing_group_names, db)
+        loaded_key_rings = {group_name: key_cache.createKeyRing(groups[group_name]) if group_name in groups else None
+                            for group_name in missing_group_names}
+        key_cache.storeKeyRings(loaded_key_rings, generation)
+        key_rings.update(loaded_key_rings)
+    return key_rings
+
+
+async def createGroup(group: schemas.GroupCreate, db: AsyncSession) -> models.EncryptionGroup:
     db_group = models.EncryptionGroup(**group.__dict__)
     db.add(db_group)
-    db.commit()
-    db.refresh(db_group)
+    await db.commit()
+    await db.refresh(db_group)
+    key_cache.invalidateGroup(db_group.name)
     return db_group
 
-def getAllEncryptionKeys(db: Session) -> List[models.EncryptionKey]:
-    return db.query(models.EncryptionKey).all()
-
-
-def createEncryptionKey(key: schemas.EncryptionKeyCreate, db: Session) -> models.EncryptionKey:
-    db_group = getGroupByName(key.group_name, db)
-    db_key = models.EncryptionKey(encryption_type=key.encryption_type, group_id = db_group.id, key = key.key)
-    db.add(db_key)
-    db.commit()
-    db.refresh(db_key)
-    return db_key
-
-def getAllEncryptionKeysByGroup(group_name: str, db: Session) -> List[models.EncryptionKey]:
-    return (
-        db.query(models.EncryptionKey)
-        .filter(models.EncryptionKey.group_id == getGroupByName(group_name, db).id)
-        .all()
+async def getAllEncryptionKeys(db: AsyncSession) -> List[models.EncryptionKey]:
+    # The group is part of the response, so join it in right away (instead of a query per key)
+    return list(await db.scalars(select(models.EncryptionKey).options(joinedload(models.EncryptionKey.group))))
+
+
+async def getLeakageAuditor(db: AsyncSession) -> LeakageAuditor:
+    """
+    Get the auditor for all issued keys from the cache, or build it if the keys changed since it was built.
+    """
+    auditor = key_cache.getLeakageAuditor()
+    if auditor is not None:
+        return auditor
+    generation = key_cache.getGeneration()
+    rows = await db.execute(
+        select(models.EncryptionKey.id, models.EncryptionGroup.name, models.EncryptionKey.encryption_type,
+               models.EncryptionKey.key)
+        .join(models.EncryptionKey.group)
+        .order_by(models.EncryptionKey.id)
     )
+    auditor = LeakageAuditor([AuditedKey(*row) for row in rows], leakage_words, num_columns=grid_width)
+    key_cache.storeLeakageAuditor(auditor, generation)
+    return auditor
+
+
+async def createEncryptionKey(key: schemas.EncryptionKeyCreate, group: models.EncryptionGroup,
+                              db: AsyncSession) -> models.EncryptionKey:
+    """
+    :raise KeyNotUniqueError: If a key of the same encryption type that works the same way already exists
+    """
+    db_key = await _insertEncryptionKey(group, key.encryption_type, key.key, db)
+    if db_key is None:
+        raise KeyNotUniqueError(f"An {key.encryption_type.value} key like {key.key} already exists")
+    return db_key
 
-def createEncryptionKeyForGroup(group_name: str, encryption_type: str, db: Session) -> models.EncryptionKey:
-    group = getGroupByName(group_name, db)
-    if not group:
-        raise Exception(f"Group with name '{group_name}' doesn't exist")
-
-    # TODO: Actually figure out a key that works. Now it's just hardcoded to be a specific one
-    key_to_use = []
-    while True:
-        key_to_use = generateRandomKey(encryption_type)
-        if validateKeyIsUnique(encryption_type, key_to_use, db):
-            break
-        else:
-            print("key wasn't unique, trying again!")
-    encryption_key = models.EncryptionKey(group_id=group.id, encryption_type=encryption_type, key=key_to_use)
+async def createEncryptionKeyForGroup(group: models.EncryptionGroup, encryption_type: str,
+                                      db: AsyncSession) -> models.EncryptionKey:
+    """
+    :raise KeyNotUniqueError: If no unique key was found (which only happens if almost all keys are already taken)
+    """
+    # The new key should work well together with the keys that the group already has
+    key_ring = (await getKeyRings([group.name], db))[group.name]
+    group_keys = [(key_type, key) for _, key_type, key in key_ring.getAllKeys()]
+    for _ in range(max_key_generation_attempts):
+        key = generateKey(encryption_type, group_keys)
+        encryption_key = await _insertEncryptionKey(group, encryption_type, key, db)
+        if encryption_key is not None:
+            return encryption_key
+        logger.info("key wasn't unique, trying again!")
+    raise KeyNotUniqueError(f"Unable to find a unique {encryption_type} key in {max_key_generation_attempts} attempts")
+
+
+async def _insertEncryptionKey(group: models.EncryptionGroup, encryption_type: str, key: List[int],
+                               db: AsyncSession) -> Optional[models.EncryptionKey]:
+    """
+    Uniqueness of the keys is enforced by the database (unique index on encryption type + fingerprint), so there is no
+    need to check all other keys first.
+    :return: The key, or None if it wasn't unique
+    """
+    group_id = group.id
+    encryption_key = models.EncryptionKey(group=group, encryption_type=encryption_type, key=key,
+                                          fingerprint=getKeyFingerprint(key))
     db.add(encryption_key)
-    db.commit()
-    db.refresh(encryption_key)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        # The rollback expired the group; Get it back, as the caller (and the response) still needs it.
+        await db.get(models.EncryptionGroup, group_id, populate_existing=True)
+        return None
+    key_cache.invalidateGroup(group.name)
     return encryption_key
 
 
-def generateRandomKey(encryption_type: str) -> List[int]:
-    key_length = random.randint(min_code_length, max_code_length)
-    if "row" in encryption_type:
-        key = [random.randint(0, grid_width) for _ in range(key_length)]
-    else:
-        # Skip encryption!
-        key = [random.randint(0, max_skip_value) for _ in range(key_length)]
-
-    return key
-
-def validateKeyIsUnique(encryption_type: str, key: List[int], db: Session):
-    # So we first get all existing encryption keys with the same encryption type
-    all_keys = db.query(models.EncryptionKey).filter(models.EncryptionKey.encryption_type == encryption_type).all()
-
-    for encryption_key in all_keys:
-        if encryption_key.key == key:
-            return False
-
-    return True
\ No newline at end of file
+async def createEncryptionKeysInBulk(batches: List[schemas.EncryptionKeyBatch],
+                                     key_rings: Dict[str, key_cache.KeyRing],
+                                     db: AsyncSession) -> List[models.EncryptionKey]:
+    """
+    Generate a lot of keys at once. The fingerprints of all existing keys are loaded up front, so the keys can be
+    checked for uniqueness in memory. All keys are then inserted in a single transaction.
+    :param key_rings: The key rings of the groups of the batches, by group name
+    :raise KeyNotUniqueError: If not enough unique keys could be found (or another request took them in the meantime)
+    """
+    encryption_types = {batch.encryption_type.value for batch in batches}
+    taken = {(encryption_type, fingerprint) for encryption_type, fingerprint in await db.execute(
+        select(models.EncryptionKey.encryption_type, models.EncryptionKey.fingerprint)
+        .where(models.EncryptionKey.encryption_type.in_(encryption_types), models.EncryptionKey.fingerprint != None)
+    )}
+
+    new_keys = []
+    group_keys = {group_name: [(key_type, key) for _, key_type, key in key_ring.getAllKeys()]
+                  for group_name, key_ring in key_rings.items()}
+    for batch in batches:
+        encryption_type = batch.encryption_type.value
+        attempts_left = batch.count * max_key_generation_attempts
+        num_created = 0
+        while num_created < batch.count:
+            if attempts_left == 0:
+                raise KeyNotUniqueError(f"Unable to find {batch.count} unique {encryption_type} keys")
+            attempts_left -= 1
+            key = generateKey(encryption_type, group_keys[batch.group_name])
+            fingerprint = getKeyFingerprint(key)
+            if (encryption_type, fingerprint) in taken:
+                continue
+            taken.add((encryption_type, fingerprint))
+            group_keys[batch.group_name].append((encryption_type, key))
+            new_keys.append({"group_id": key_rings[batch.group_name].group_id, "encryption_type": encryption_type,
+                             "key": key, "fingerprint": fingerprint})
+            num_created += 1
+
+    try:
+        # A list of parameters makes this a single executemany, instead of a statement per key.
+        await db.execute(insert(models.EncryptionKey.__table__), new_keys)
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise KeyNotUniqueError("Some of the keys were created by someone else in the meantime, try again")
+    for batch in batches:
+        key_cache.invalidateGroup(batch.group_name)
+
+    # No RETURNING (sqlite might be too old for it), so get the created keys (and their ids) back by fingerprint.
+    created = {(key["encryption_type"], key["fingerprint"]) for key in new_keys}
+    fingerprints = sorted({key["fingerprint"] for key in new_keys})
+    candidates = []
+    for start in range(0, len(fingerprints), max_query_parameters):
+        candidates.extend(await db.scalars(
+            select(models.EncryptionKey)
+            .where(models.EncryptionKey.fingerprint.in_(fingerprints[start:start + max_query_parameters]))
+            .options(joinedload(models.EncryptionKey.group))
+        ))
+    return sorted((key for key in candidates if (key.encryption_type, key.fingerprint) in created),
+                  key=lambda key: key.id)
+
+
+def getKeyFingerprint(key: List[int]) -> str:
+    """
+    The keys loop, so [1, 2, 1, 2] encodes exactly the same as [1, 2]. The fingerprint is the shortest part that
+    repeats, so those two keys have the same fingerprint.
+    """
+    for period in range(1, len(key) + 1):
+        if len(key) % period == 0 and key == key[:period] * (len(key) // period):
+            return ",".join(str(value) for value in key[:period])
+    return ""
+
+
+async def backfillKeyFingerprints(db: AsyncSession) -> None:
+    """
+    Keys created before fingerprints were added don't have one yet. Fill those in. If an older key turns out to be a
+    duplicate of another one, it's left without fingerprint (it keeps working, but it doesn't block any new keys)
+    """
+    keys_without_fingerprint = list(await db.scalars(
+        select(models.EncryptionKey).where(models.EncryptionKey.fingerprint == None).order_by(models.EncryptionKey.id)
+    ))
+    if not keys_without_fingerprint:
+        return
+    taken = {(encryption_type, fingerprint) for encryption_type, fingerprint in await db.execute(
+        select(models.EncryptionKey.encryption_type, models.EncryptionKey.fingerprint)
+        .where(models.EncryptionKey.fingerprint != None)
+    )}
+    for encryption_key in keys_without_fingerprint:
+        fingerprint = getKeyFingerprint(encryption_key.key)
+        if (encryption_key.encryption_type, fingerprint) in taken:
+            logger.warning(f"Encryption key {encryption_key.id} is a duplicate of another "
+                           f"{encryption_key.encryption_type} key")
+            continue
+        taken.add((encryption_key.encryption_type, fingerprint))
+        encryption_key.fingerprint = fingerprint
+    await db.commit()
+
+
+def generateKey(encryption_type: str, group_keys: List[Tuple[str, Sequence[int]]]) -> List[int]:
+    """
+    :param group_keys: (encryption type, key) of all keys the group already has
+    """
+    return key_generator.generateKey(encryption_type, group_keys)
@@ -1,12 +1,162 @@
-from sqlalchemy import create_engine
+import logging
+import os
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+logger = logging.getLogger('uvicorn.error')
+
+# All of these can be overridden with environment variables (eg; in the service file)
+SQLALCHEMY_DATABASE_URL = os.environ.get("TELEGRAPH_DATABASE_URL", "sqlite:///./sql_app.db")
+
+# With WAL the telegraph polls (readers) don't have to wait for the GM posting messages (writers) and vice versa.
+SQLITE_JOURNAL_MODE = os.environ.get("TELEGRAPH_SQLITE_JOURNAL_MODE", "WAL")
+# NORMAL is safe with WAL; A power cut can lose the last transactions, but never corrupts the database.
+SQLITE_SYNCHRONOUS = os.environ.get("TELEGRAPH_SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.environ.get("TELEGRAPH_SQLITE_MMAP_SIZE", 64 * 1024 * 1024))  # bytes
+SQLITE_CACHE_SIZE = int(os.environ.get("TELEGRAPH_SQLITE_CACHE_SIZE", -8192))  # Negative means KiB instead of pages
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("TELEGRAPH_SQLITE_BUSY_TIMEOUT", 5))  # seconds to wait for a write lock
+# With INCREMENTAL the space of archived messages can be given back to the filesystem bit by bit (see incrementalVacuum)
+# instead of with a full VACUUM, which locks the database for as long as it takes to copy all of it.
+SQLITE_AUTO_VACUUM = os.environ.get("TELEGRAPH_SQLITE_AUTO_VACUUM", "INCREMENTAL")
+
+DATABASE_POOL_SIZE = int(os.environ.get("TELEGRAPH_DATABASE_POOL_SIZE", 8))
+DATABASE_MAX_OVERFLOW = int(os.environ.get("TELEGRAPH_DATABASE_MAX_OVERFLOW", 8))
+
+
+def _isFileBasedSqlite(database_url: str) -> bool:
+    return database_url.startswith("sqlite") and ":memory:" not in database_url and database_url.rstrip("/") != "sqlite:"
+
+
+def _toAsyncUrl(database_url: str) -> str:
+    """
+    The urls are configured like the usual sqlite urls, but the server talks to the database through aiosqlite.
+    """
+    if database_url.startswith("sqlite://"):
+        return database_url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return database_url
+
+
+def _createEngine(database_url: str) -> AsyncEngine:
+    engine_arguments = {}
+    if _isFileBasedSqlite(database_url):
+        engine_arguments["pool_size"] = DATABASE_POOL_SIZE
+        engine_arguments["max_overflow"] = DATABASE_MAX_OVERFLOW
+    elif database_url.startswith("sqlite"):
+        # Every connection to an in memory database is a new (empty) database, so they all have to share one.
+        engine_arguments["poolclass"] = StaticPool
+    return create_async_engine(
+        _toAsyncUrl(database_url), connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT},
+        **engine_arguments
+    )
+
+
+def _setSqlitePragmas(dbapi_connection, connection_record) -> None:
+    """
+    Pragmas are per connection, so they are set every time the pool opens a new one.
+    """
+    cursor = dbapi_connection.cursor()
+    # Only has an effect on a new database; Existing ones are converted by initDatabase
+    cursor.execute(f"PRAGMA auto_vacuum={SQLITE_AUTO_VACUUM}")
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.close()
+
+
+engine = _createEngine(SQLALCHEMY_DATABASE_URL)
+if engine.dialect.name == "sqlite":
+    event.listen(engine.sync_engine, "connect", _setSqlitePragmas)
+
+# Objects are used after the commit (to build the response), so don't expire them on commit. Expired attributes would
+# have to be lazy loaded again, which isn't possible with an async session.
+AsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+Base = declarative_base()
+
+
+async def initDatabase() -> None:
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.run_sync(upgradeSchema)
+    if _isFileBasedSqlite(SQLALCHEMY_DATABASE_URL):
+        await _convertAutoVacuum()
+
+
+async def _convertAutoVacuum() -> None:
+    """
+    Changing auto_vacuum of an existing database only takes effect after a full VACUUM, which is done (once) here.
+    """
+    wanted_mode = {"NONE": 0, "FULL": 1, "INCREMENTAL": 2}.get(SQLITE_AUTO_VACUUM.upper(), SQLITE_AUTO_VACUUM)
+    async with engine.connect() as connection:
+        if str((await connection.execute(text("PRAGMA auto_vacuum"))).scalar()) == str(wanted_mode):
+            return
+        logger.info("Converting the database to auto_vacuum=%s, this can take a while", SQLITE_AUTO_VACUUM)
+        # The connection already has the new auto_vacuum mode set (see _setSqlitePragmas). VACUUM can't run inside a
+        # transaction.
+        await connection.rollback()
+        autocommit_connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await autocommit_connection.execute(text("VACUUM"))
+
+
+async def incrementalVacuum(max_pages: int) -> int:
+    """
+    Give (at most) max_pages of free pages back to the filesystem. Only does something with auto_vacuum=INCREMENTAL.
+    :return: The number of free pages that are left
+    """
+    async with engine.connect() as connection:
+        # The pragma frees a single page every time it's stepped, but sqlite3 only steps statements without result
+        # columns once. executescript runs them to the end.
+        sqlite_connection = (await connection.get_raw_connection()).driver_connection
+        await sqlite_connection.executescript(f"PRAGMA incremental_vacuum({int(max_pages)})")
+        return (await connection.execute(text("PRAGMA freelist_count"))).scalar()
+
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+def upgradeSchema(connection: Connection) -> None:
+    """
+    create_all only creates tables that don't exist yet. Columns (and indexes) that were added to the models later on
+    are added here, so that the database of a previous event keeps working. New columns must either be nullable or
+    have a server_default.
+    """
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_definition = f"{column.name} {column.type.compile(connection.dialect)}"
+            if column.server_default is not None:
+                column_definition += f" DEFAULT {column.server_default.arg}"
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_definition}"))
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+        if connection.dialect.name == "sqlite" and table.dialect_options["sqlite"]["autoincrement"]:
+            _addAutoincrement(connection, table)
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+def _addAutoincrement(connection: Connection, table) -> None:
+    """
+    AUTOINCREMENT can't be added to an existing table, so a table from before it was set is rebuilt with it (see
+    https://www.sqlite.org/lang_altertable.html). The highest id of the rows that are copied over is where the ids
+    continue from.
+    """
+    table_sql = connection.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table.name}).scalar()
+    if "AUTOINCREMENT" in table_sql.upper():
+        return
+    logger.info(f"Rebuilding table {table.name} with AUTOINCREMENT, this can take a while")
+    old_name = f"{table.name}_without_autoincrement"
+    connection.execute(text(f"ALTER TABLE {table.name} RENAME TO {old_name}"))
+    # The indexes moved along with the table, but their names are needed for the new one
+    for index in table.indexes:
+        connection.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+    table.create(connection)
+    columns = ", ".join(column.name for column in table.columns)
+    connection.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}"))
+    connection.execute(text(f"DROP TABLE {old_name}"))
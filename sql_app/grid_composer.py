@@ -0,0 +1,96 @@
+"""
+Composing the grid of a grid message; Picking the keys with which both messages fit in one grid, and building that grid.
+
+This is kept apart from the server (main.py), so that GridProfileReplay.py can compose a grid offline without setting
+up the server.
+"""
+import logging
+import random
+from typing import Any, Dict, List, Optional, Tuple
+
+from GridBasedEncryption import EncryptionGrid
+from . import key_cache, metrics, schemas
+
+logger = logging.getLogger('uvicorn.error')
+
+# Number of columns of every grid, and so the highest column a key can use
+grid_width = 10
+
+
+def composeGrid(grid_msg: schemas.GridMessage, primary_key_ring: key_cache.KeyRing,
+                secondary_key_ring: Optional[key_cache.KeyRing],
+                rng: Optional[random.Random] = None) -> Optional[Tuple[EncryptionGrid, List[Dict[str, Any]]]]:
+    """
+    Find a combination of keys with which both messages fit in a single grid, and build that grid. Whether a
+    combination works out is decided on the footprints of the keys, so only one grid is ever built, with exactly as
+    many rows as the chosen keys need.
+    :param rng: Random generator for the order in which the keys are tried and for filling the grid. With a seeded
+    one, the same keys and messages always give the same grid.
+    :return: The grid and the keys used (see models.Message.grid_keys), or None if no combination worked out
+    """
+    rng = rng if rng is not None else random.Random()
+    primary_message = grid_msg.primary_message
+    secondary_message = grid_msg.secondary_message
+    primary_length = len(EncryptionGrid.formatMessage(primary_message))
+
+    all_primary_group_keys = primary_key_ring.getAllKeys()
+    if secondary_message and secondary_key_ring is None:
+        pairs_to_try = []  # Nobody to encode the secondary message for
+    elif secondary_message:
+        all_secondary_group_keys = secondary_key_ring.getAllKeys()
+        # Start with the pairs of keys that have the fewest fields in common. Shuffle first, so that pairs that are
+        # just as good are tried in a random order.
+        key_pairs = key_cache.getCompatibility(
+            grid_msg.primary_group, grid_msg.secondary_group, primary_key_ring, secondary_key_ring,
+            primary_length, len(EncryptionGrid.formatMessage(secondary_message)), grid_width)
+        key_pairs = rng.sample(key_pairs, len(key_pairs))
+        key_pairs.sort(key=lambda key_pair: key_pair[0])
+        pairs_to_try = [(all_primary_group_keys[primary_index], all_secondary_group_keys[secondary_index])
+                        for _, primary_index, secondary_index in key_pairs]
+    else:
+        rng.shuffle(all_primary_group_keys)
+        pairs_to_try = [(primary_encryption_key, None) for primary_encryption_key in all_primary_group_keys]
+
+    num_pairs_tried = 0
+    for (primary_key_id, primary_encryption_type, primary_key), secondary_encryption_key in pairs_to_try:
+        num_pairs_tried += 1
+        rows_needed = EncryptionGrid.getRowsNeeded(primary_encryption_type, list(primary_key), primary_length,
+                                                   grid_width)
+        if rows_needed is None:
+            metrics.grid_key_pairs_rejected.inc(reason="unusable_key")
+            continue  # This key can't encode anything (eg; a row key with only zeroes)
+
+        if secondary_encryption_key is not None:
+            secondary_key_id, secondary_encryption_type, secondary_key = secondary_encryption_key
+            secondary_rows_needed = EncryptionGrid.getRowsNeeded(
+                secondary_encryption_type, list(secondary_key), len(EncryptionGrid.formatMessage(secondary_message)),
+                grid_width)
+            if secondary_rows_needed is None:
+                metrics.grid_key_pairs_rejected.inc(reason="unusable_key")
+                continue
+            if not EncryptionGrid.canShareGrid(primary_encryption_type, list(primary_key), primary_message,
+                                               secondary_encryption_type, list(secondary_key), secondary_message,
+                                               grid_width):
+                metrics.grid_key_pairs_rejected.inc(reason="conflict")
+                continue  # Both need the same field for a different letter
+            rows_needed = max(rows_needed, secondary_rows_needed)
+
+        grid = EncryptionGrid(grid_width, max(rows_needed, 1), rng)
+        grid.addMessage(primary_encryption_type, primary_message, list(primary_key))
+        if secondary_encryption_key is not None:
+            grid.addMessage(secondary_encryption_type, secondary_message, list(secondary_key))
+
+        # Debug prints to check if the encoding went well
+        logger.info(
+            f"Attempting to decode primary message encoded with {primary_encryption_type} and key {primary_key}: {grid.decodeMethod(primary_encryption_type, primary_key)}")
+        if secondary_encryption_key is not None:
+            logger.info(
+                f"Attempting to decode Secondary message encoded with {secondary_encryption_type} and key {secondary_key}: {grid.decodeMethod(secondary_encryption_type, secondary_key)}")
+        grid_keys = [{"key_id": primary_key_id, "encryption_type": primary_encryption_type}]
+        if secondary_encryption_key is not None:
+            grid_keys.append({"key_id": secondary_key_id, "encryption_type": secondary_encryption_type})
+        metrics.grid_key_pairs_tried.observe(num_pairs_tried)
+        return grid, grid_keys
+
+    metrics.grid_key_pairs_tried.observe(num_pairs_tried)
+    return None
@@ -0,0 +1,113 @@
+"""
+Opt-in profiling of composing grid messages.
+
+How long composing a grid takes depends on the random order in which keys are tried and on the random fill of the
+grid, so a slow case is hard to reproduce. A profiled grid message is composed with a random generator of which the
+seed is stored, next to the profile itself, the message and the keys of the groups at that time. That is everything
+GridProfileReplay.py needs to compose the exact same grid again (and profile it) offline.
+
+Profiling is switched on for a single request with the X-Profile-Grid header, or for all of them with
+/admin/grid_profiling.
+"""
+import base64
+import cProfile
+import json
+import os
+import random
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from GridBasedEncryption import EncryptionGrid
+from GridCodec import GridCodec
+from . import key_cache, schemas
+
+PROFILE_DIRECTORY = os.environ.get("TELEGRAPH_GRID_PROFILE_DIR", "grid_profiles")
+
+T = TypeVar("T")
+
+_enabled = False
+
+
+def isEnabled() -> bool:
+    return _enabled
+
+
+def setEnabled(enabled: bool) -> None:
+    global _enabled
+    _enabled = enabled
+
+
+class GridProfile:
+    def __init__(self, seed: Optional[int] = None) -> None:
+        """
+        :param seed: Seed for the random generator. If not set, a random one is picked.
+        """
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        self.random = random.Random(self.seed)
+        self._profiler = cProfile.Profile()
+        self._durations: Dict[str, float] = {}
+
+    def run(self, stage: str, function: Callable[..., T], *args: Any) -> T:
+        """
+        Run (and profile) a part of composing the grid. Must be called from the thread that does the work; cProfile
+        only sees the thread it is enabled on.
+        """
+        start_time = time.perf_counter()
+        try:
+            return self._profiler.runcall(function, *args)
+        finally:
+            self._durations[stage] = self._durations.get(stage, 0) + time.perf_counter() - start_time
+
+    def save(self, grid_msg: schemas.GridMessage, key_rings: Dict[str, Optional[key_cache.KeyRing]],
+             num_columns: int, composed: Optional[Tuple[EncryptionGrid, List[Dict[str, Any]]]]) -> str:
+        """
+        Store the profile (<id>.prof, readable with pstats or snakeviz) and everything needed to replay it
+        (<id>.json) in the profile directory.
+        :param composed: The grid and the keys used, or None if no combination worked out
+        :return: The id of the profile
+        """
+        grid_details: Dict[str, Any] = {"num_columns": num_columns, "num_rows": None, "keys": None, "packed": None}
+        if composed is not None:
+            grid, grid_keys = composed
+            grid_details.update(num_rows=len(grid.getRawGrid()), keys=grid_keys,
+                                packed=base64.b64encode(GridCodec.encode(grid)).decode("ascii"))
+        os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+        profile_id = f"grid_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        self._profiler.dump_stats(os.path.join(PROFILE_DIRECTORY, profile_id + ".prof"))
+        details = {
+            "profile_id": profile_id,
+            "seed": self.seed,
+            "durations": self._durations,
+            "message": grid_msg.model_dump(mode="json"),
+            "grid": grid_details,
+            "key_rings": {group_name: None if key_ring is None else
+                          {"group_id": key_ring.group_id,
+                           "keys": [[key_id, encryption_type, list(key)]
+                                    for key_id, encryption_type, key in key_ring.getAllKeys()]}
+                          for group_name, key_ring in key_rings.items()},
+        }
+        with open(os.path.join(PROFILE_DIRECTORY, profile_id + ".json"), "w") as f:
+            json.dump(details, f, indent=2)
+        return profile_id
+
+
+def loadDetails(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def createKeyRings(details: Dict[str, Any]) -> Dict[str, Optional[key_cache.KeyRing]]:
+    """
+    :param details: As stored by GridProfile.save
+    """
+    key_rings = {}
+    for group_name, stored in details["key_rings"].items():
+        if stored is None:
+            key_rings[group_name] = None
+            continue
+        keys_by_method: Dict[str, List[key_cache.KeyTuple]] = {}
+        for key_id, encryption_type, key in stored["keys"]:
+            keys_by_method.setdefault(encryption_type, []).append((key_id, encryption_type, tuple(key)))
+        key_rings[group_name] = key_cache.KeyRing(stored["group_id"], keys_by_method, {})
+    return key_rings
@@ -0,0 +1,209 @@
+"""
+Process-local cache of the keys of every group (its "key ring").
+
+Composing a grid message needs all the keys of one or two groups. Those hardly ever change during an event, so there
+is no need to get them from the database for every message. Everything that changes the keys of a group (or creates a
+group) must invalidate the cache. Note that this cache is per process; If the server is ever run with multiple
+workers, a key added through one worker is not seen by the others until they are restarted.
+
+Next to the key rings, the cache keeps a compatibility matrix for pairs of groups that were used together for a grid
+message: For every combination of a key of the one group and a key of the other, how many fields they have in common.
+Composing a grid can then start with the pairs that (almost) don't get in each other's way.
+
+Last, it keeps the LeakageAuditor for all issued keys, which is rebuilt after any of the key rings is invalidated.
+"""
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from GridBasedEncryption import EncryptionGrid
+from LeakageAuditor import LeakageAuditor
+from . import models
+
+# (id, encryption_type, key)
+KeyTuple = Tuple[int, str, Tuple[int, ...]]
+
+# (number of overlapping fields, index of the primary key, index of the secondary key). The indices are those of
+# KeyRing.getAllKeys()
+KeyPair = Tuple[int, int, int]
+
+# (primary group name, secondary group name, primary length bucket, secondary length bucket)
+CompatibilityKey = Tuple[str, str, int, int]
+
+# The footprint of a key only depends on the length of the message. Message lengths are rounded up to a multiple of
+# this, so that the matrices can be re-used for messages of about the same length. The overlap of the rounded up
+# lengths is never less than the actual overlap.
+LENGTH_BUCKET_SIZE = 10
+
+MAX_COMPATIBILITY_MATRICES = 256
+
+
+class KeyRing(NamedTuple):
+    group_id: int
+    keys_by_method: Dict[str, List[KeyTuple]]
+    footprint_masks: Dict[int, List[int]]  # Length bucket -> footprint mask of every key (in getAllKeys order)
+
+    def getAllKeys(self) -> List[KeyTuple]:
+        """
+        :return: A new list with all the keys, so the caller is free to shuffle it.
+        """
+        return [key for keys in self.keys_by_method.values() for key in keys]
+
+    def getFootprintMasks(self, length_bucket: int, num_columns: int) -> List[int]:
+        masks = self.footprint_masks.get(length_bucket)
+        if masks is None:
+            masks = [EncryptionGrid.getFootprintMask(encryption_type, list(key), length_bucket, num_columns)
+                     for _, encryption_type, key in self.getAllKeys()]
+            self.footprint_masks[length_bucket] = masks
+        return masks
+
+
+# Group name -> key ring. None means that the group doesn't exist (so asking again doesn't need the database either).
+_key_rings: Dict[str, Optional[KeyRing]] = {}
+
+# The key rings that a matrix was computed for are stored with it. If those are no longer the cached key rings, the
+# matrix is outdated.
+_compatibility: Dict[CompatibilityKey, Tuple[KeyRing, KeyRing, List[KeyPair]]] = {}
+# Matrices are computed on worker threads
+_compatibility_lock = threading.Lock()
+
+# (generation it was built in, auditor)
+_leakage_auditor: Optional[Tuple[int, LeakageAuditor]] = None
+
+# Increased on every invalidation. Used to prevent storing key rings that were loaded before the invalidation.
+_generation = 0
+
+
+def createKeyRing(group: models.EncryptionGroup) -> KeyRing:
+    """
+    :param group: Group of which the encryption_keys are loaded
+    """
+    keys_by_method: Dict[str, List[KeyTuple]] = {}
+    for key in group.encryption_keys:
+        keys_by_method.setdefault(key.encryption_type, []).append((key.id, key.encryption_type, tuple(key.key)))
+    return KeyRing(group.id, keys_by_method, {})
+
+
+def getGeneration() -> int:
+    return _generation
+
+
+def getKeyRings(group_names: List[str]) -> Tuple[Dict[str, Optional[KeyRing]], List[str]]:
+    """
+    :return: The cached key rings by group name (None for groups that don't exist) and the group names that aren't
+    cached yet.
+    """
+    cached = {}
+    missing = []
+    for group_name in group_names:
+        if group_name in _key_rings:
+            cached[group_name] = _key_rings[group_name]
+        else:
+            missing.append(group_name)
+    return cached, missing
+
+
+def storeKeyRings(key_rings: Dict[str, Optional[KeyRing]], generation: int) -> None:
+    """
+    :param generation: The generation (see getGeneration) from before the key rings were loaded. If the cache was
+    invalidated since, the key rings might be outdated already, so they are not stored.
+    """
+    if generation != _generation:
+        return
+    _key_rings.update(key_rings)
+
+
+def getLeakageAuditor() -> Optional[LeakageAuditor]:
+    """
+    :return: The auditor, or None if there is none or it was built before the last invalidation.
+    """
+    if _leakage_auditor is None or _leakage_auditor[0] != _generation:
+        return None
+    return _leakage_auditor[1]
+
+
+def storeLeakageAuditor(auditor: LeakageAuditor, generation: int) -> None:
+    """
+    :param generation: Same as for storeKeyRings
+    """
+    global _leakage_auditor
+    if generation != _generation:
+        return
+    _leakage_auditor = (generation, auditor)
+
+
+def invalidateGroup(group_name: str) -> None:
+    global _generation
+    _generation += 1
+    _key_rings.pop(group_name, None)
+
+
+def invalidateGroupById(group_id: int) -> None:
+    global _generation
+    _generation += 1
+    for group_name, key_ring in list(_key_rings.items()):
+        if key_ring is not None and key_ring.group_id == group_id:
+            del _key_rings[group_name]
+
+
+def clear() -> None:
+    global _generation
+    _generation += 1
+    _key_rings.clear()
+    with _compatibility_lock:
+        _compatibility.clear()
+
+
+def getLengthBucket(message_length: int) -> int:
+    return max(1, -(-message_length // LENGTH_BUCKET_SIZE)) * LENGTH_BUCKET_SIZE
+
+
+def computeCompatibility(primary_key_ring: KeyRing, secondary_key_ring: KeyRing, primary_length_bucket: int,
+                         secondary_length_bucket: int, num_columns: int) -> List[KeyPair]:
+    """
+    :return: Every pair of a primary and a secondary key, the pairs with the fewest overlapping fields first
+    """
+    primary_masks = primary_key_ring.getFootprintMasks(primary_length_bucket, num_columns)
+    secondary_masks = secondary_key_ring.getFootprintMasks(secondary_length_bucket, num_columns)
+    pairs = [(bin(primary_mask & secondary_mask).count("1"), primary_index, secondary_index)
+             for primary_index, primary_mask in enumerate(primary_masks)
+             for secondary_index, secondary_mask in enumerate(secondary_masks)]
+    pairs.sort()
+    return pairs
+
+
+def getCompatibility(primary_group_name: str, secondary_group_name: str, primary_key_ring: KeyRing,
+                     secondary_key_ring: KeyRing, primary_message_length: int, secondary_message_length: int,
+                     num_columns: int) -> List[KeyPair]:
+    """
+    Get the compatibility matrix of two groups from the cache, or compute it if it's not in there (yet).
+    """
+    compatibility_key = (primary_group_name, secondary_group_name, getLengthBucket(primary_message_length),
+                         getLengthBucket(secondary_message_length))
+    cached = _compatibility.get(compatibility_key)
+    if cached is not None and cached[0] is primary_key_ring and cached[1] is secondary_key_ring:
+        return cached[2]
+
+    pairs = computeCompatibility(primary_key_ring, secondary_key_ring, compatibility_key[2], compatibility_key[3],
+                                 num_columns)
+    with _compatibility_lock:
+        _compatibility.pop(compatibility_key, None)  # So it's moved to the end (as most recently computed)
+        _compatibility[compatibility_key] = (primary_key_ring, secondary_key_ring, pairs)
+        while len(_compatibility) > MAX_COMPATIBILITY_MATRICES:
+            del _compatibility[next(iter(_compatibility))]
+    return pairs
+
+
+def getOutdatedCompatibility() -> List[CompatibilityKey]:
+    """
+    :return: The matrices that were computed for key rings that have since been invalidated.
+    """
+    with _compatibility_lock:
+        compatibility = list(_compatibility.items())
+    return [compatibility_key for compatibility_key, (primary_key_ring, secondary_key_ring, _) in compatibility
+            if _key_rings.get(compatibility_key[0]) is not primary_key_ring
+            or _key_rings.get(compatibility_key[1]) is not secondary_key_ring]
+
+
+def dropCompatibility(compatibility_key: CompatibilityKey) -> None:
+    with _compatibility_lock:
+        _compatibility.pop(compatibility_key, None)
@@ -1,35 +1,84 @@
-from fastapi import Depends, FastAPI, HTTPException
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.openapi.docs import (
     get_redoc_html,
     get_swagger_ui_html,
     get_swagger_ui_oauth2_redirect_html
 )
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
-
-from GridBasedEncryption import EncryptionGrid
-from . import crud, models, schemas
-from .database import SessionLocal, engine
-import random
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from GridCodec import GridCodec
+from . import crud, grid_composer, grid_profiler, key_cache, metrics, models, queue_version, schemas
+from .database import AsyncSessionLocal, engine, incrementalVacuum, initDatabase
+from .grid_composer import grid_width
 from .schemas import EncryptionKeyCreate
 
-models.Base.metadata.create_all(bind=engine)
-
 import logging
 
 tags_metadata = [
     {"name": "Messages", "description": ""},
+    {"name": "Stations", "description": ""},
     {"name": "Groups", "description": ""},
     {"name": "Encryption Keys", "description": ""},
+    {"name": "Admin", "description": ""},
 ]
 
 logger = logging.getLogger('uvicorn.error')
 
+# Seconds between checking for compatibility matrices that have to be computed again
+COMPATIBILITY_REFRESH_INTERVAL = 5
+
+# Printed messages are moved to the archive (see models.ArchivedMessage) once they are this old (in seconds), which is
+# checked every ARCHIVE_INTERVAL seconds. Both can be overridden with environment variables, like the database settings.
+ARCHIVE_AFTER = float(os.environ.get("TELEGRAPH_ARCHIVE_AFTER", 60 * 60))
+ARCHIVE_INTERVAL = float(os.environ.get("TELEGRAPH_ARCHIVE_INTERVAL", 10 * 60))
+# Messages that are archived per transaction, so the telegraphs are never kept waiting for long
+ARCHIVE_BATCH_SIZE = 500
+# Free pages that are given back to the filesystem after archiving, at most
+VACUUM_PAGES = 1000
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await initDatabase()
+    async with AsyncSessionLocal() as db:
+        await crud.backfillKeyFingerprints(db)
+    compatibility_task = asyncio.create_task(_maintainCompatibility())
+    archive_task = asyncio.create_task(_maintainArchive())
+    yield
+    compatibility_task.cancel()
+    archive_task.cancel()
+
+
 # Mount the swagger & redoc stuff locally.
-app = FastAPI(docs_url=None, redoc_url=None, openapi_tags=tags_metadata)
+app = FastAPI(docs_url=None, redoc_url=None, openapi_tags=tags_metadata, lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+metrics.trackQueries(engine.sync_engine)
+
+
+@app.middleware("http")
+async def collect_request_metrics(request: Request, call_next):
+    query_statistics = metrics.startTrackingQueries()
+    start_time = time.perf_counter()
+    response = await call_next(request)
+    # Use the path of the route (eg; /messages/{message_id}/), so every message doesn't get its own label
+    route = request.scope.get("route")
+    labels = {"method": request.method, "route": route.path if route is not None else "unmatched"}
+    metrics.request_duration.observe(time.perf_counter() - start_time, **labels)
+    metrics.request_db_queries.observe(query_statistics.num_queries, **labels)
+    metrics.request_db_duration.observe(query_statistics.duration, **labels)
+    return response
+
 
 @app.get("/docs", include_in_schema=False)
 async def custom_swagger_ui_html():
@@ -62,37 +111,75 @@ async def redoc_html():
     )
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-@app.get("/messages/", response_model=list[schemas.Message], tags=["Messages"])
-def get_all_messages(db: Session = Depends(get_db)):
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics(db: AsyncSession = Depends(get_db)):
+    """
+    Metrics in the Prometheus text format.
+    """
+    num_unprinted, oldest_time_sent = await crud.getUnprintedStatistics(db)
+    metrics.unprinted_messages.set(num_unprinted)
+    metrics.oldest_unprinted_message_age.set(
+        (datetime.now() - oldest_time_sent).total_seconds() if oldest_time_sent is not None else 0)
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/messages/", response_model=list[schemas.MessageSummary], tags=["Messages"])
+async def get_messages(response: Response, message_filter: schemas.MessageFilter = Depends(),
+                       limit: int = Query(100, ge=1, le=1000), before_id: Optional[int] = None,
+                       after_id: Optional[int] = None, include_encoded_text: bool = False,
+                       db: AsyncSession = Depends(get_db)):
     """
-    Get all messages in the database
+    Get the messages in the database, newest first. At most `limit` messages are returned. If there are more, the
+    `X-Next-Before-Id` header is set; Pass that as `before_id` to get the next page.
+    The encoded text is left out, unless `include_encoded_text` is set.
     """
-    return crud.getAllMessages(db)
+    # Get one extra, so we know if there is a next page.
+    messages = await crud.getMessages(message_filter, limit + 1, db, before_id=before_id, after_id=after_id,
+                                      include_encoded_text=include_encoded_text)
+    if len(messages) > limit:
+        messages = messages[:limit]
+        response.headers["X-Next-Before-Id"] = str(messages[-1]["id"])
+    return messages
+
+
 
 
 
+@app.get("/messages/unprinted/", response_model=list[schemas.PrintableMessage], response_model_exclude_none=True,
+         responses={304: {"description": "Not Modified"}}, tags=["Messages"])
+async def get_all_unprinted_messages(response: Response, station: Optional[str] = None,
+                                     if_none_match: Optional[str] = Header(None), db: AsyncSession = Depends(get_db)):
+    """
+    Get all messages that haven't been printed yet. If a `station` is given, only the messages that it can print (those
+    routed to it and those that aren't routed to any station). The response has an ETag; Send it back as If-None-Match
+    to get a 304 (without the server having to look at the database at all) if nothing changed since.
+    """
+    # Get the version before the query. If it changes during the query, the client just gets the messages again.
+    etag = queue_version.getETag(queue_version.getVersion(station))
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return await crud.getAllUnprintedMessages(db, station)
 
 
-@app.get("/messages/unprinted/", response_model=list[schemas.Message], tags=["Messages"])
-def get_all_unprinted_messages(db: Session = Depends(get_db)):
+@app.get("/messages/queue/", response_model=list[schemas.QueuedMessage], tags=["Messages"])
+async def get_message_queue(station: Optional[str] = None, db: AsyncSession = Depends(get_db)):
     """
-    Get all messages in the database
+    Get the messages that are waiting to be printed, in the order in which they will be printed, with an estimate of
+    when each of them will be done. Without a `station`, the queues of all stations.
     """
-    return crud.getAllUnprintedMessages(db)
+    return await crud.getMessageQueue(db, station)
 
 
 @app.get("/messages/{message_id}/", response_model=schemas.Message, responses={404: {"model": schemas.NotFoundError}},
          tags=["Messages"])
-def get_message_by_id(message_id: int, db: Session = Depends(get_db)):
-    db_message = crud.getMessageById(message_id, db)
+async def get_message_by_id(message_id: int, db: AsyncSession = Depends(get_db)):
+    db_message = await crud.getMessageById(message_id, db) or await crud.getArchivedMessageById(message_id, db)
     if not db_message:
         raise HTTPException(status_code=404, detail=f"Message with ID [{message_id}] was not found")
     return db_message
@@ -100,176 +187,247 @@ def get_message_by_id(message_id: int, db: Session = Depends(get_db)):
 
 @app.delete("/messages/{message_id}/", responses = {404: {"model": schemas.NotFoundError}},
             tags = ["Messages"])
-def delete_message_by_id(message_id: int, db: Session = Depends(get_db)):
-    db_message = crud.getMessageById(message_id, db)
+async def delete_message_by_id(message_id: int, db: AsyncSession = Depends(get_db)):
+    db_message = await crud.getMessageById(message_id, db) or await crud.getArchivedMessageById(message_id, db)
     if not db_message:
         raise HTTPException(status_code=404, detail=f"Message with ID [{message_id}] was not found")
-    crud.deleteMessageById(message_id, db)
+    await crud.deleteMessageById(message_id, db)
 
 @app.post("/messages/{message_id}/reprint",
           responses={400: {"model": schemas.BadRequestError}, 404: {"model": schemas.NotFoundError}}, tags=["Messages"])
-def reprint_message(message_id: int, db: Session = Depends(get_db)):
-    db_message = crud.getMessageById(message_id, db)
+async def reprint_message(message_id: int, db: AsyncSession = Depends(get_db)):
+    db_message = await crud.getMessageById(message_id, db) or await crud.getArchivedMessageById(message_id, db)
     if not db_message:
         raise HTTPException(status_code=404, detail=f"Message with ID [{message_id}] was not found")
 
     if db_message.time_printed is None:
         raise HTTPException(status_code=400, detail=f"Can't reprint message as it's still waiting to be printed")
 
-    crud.reprintMessage(message_id, db)
+    await crud.reprintMessage(message_id, db)
 
 
 @app.post("/messages/{message_id}/mark_as_printed",
           responses={400: {"model": schemas.BadRequestError}, 404: {"model": schemas.NotFoundError}}, tags=["Messages"])
-def mark_message_as_printed(message_id: int, db: Session = Depends(get_db)):
-    db_message = crud.getMessageById(message_id, db)
-    if not db_message:
+async def mark_message_as_printed(message_id: int, db: AsyncSession = Depends(get_db)):
+    if not await crud.markMessageAsPrinted(message_id, db):
         raise HTTPException(status_code=404, detail=f"Message with ID [{message_id}] was not found")
 
-    crud.markMessageAsPrinted(message_id, db)
 
+@app.post("/messages/claim", response_model=list[schemas.PrintableMessage], response_model_exclude_none=True,
+          tags=["Messages"])
+async def claim_messages(claim: schemas.ClaimRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Reserve the next unprinted messages for a station, so that no other station prints them. The claim ends when the
+    messages are acknowledged (see /messages/ack) or when the lease runs out.
+    """
+    return await crud.claimMessages(claim.station, claim.count, claim.lease_seconds, db)
+
+
+@app.post("/messages/ack", response_model=schemas.AckResponse, tags=["Messages"])
+async def acknowledge_messages(ack: schemas.AckRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Mark a list of messages as printed in one go.
+    """
+    return schemas.AckResponse(acknowledged=await crud.acknowledgeMessages(ack.ids, db))
+
+
+async def _handleGridMessage(grid_msg: schemas.GridMessage, db: AsyncSession, response: Response,
+                             profile: bool = False):
+    """
+    :param profile: Profile composing the grid (see grid_profiler). The id of the profile is returned in the
+    X-Grid-Profile header.
+    """
+    # Get the keys of both groups in one go (usually straight from the key cache)
+    group_names = [grid_msg.primary_group]
+    if grid_msg.secondary_group:
+        group_names.append(grid_msg.secondary_group)
+    key_rings = await crud.getKeyRings(group_names, db)
 
-def _handleGridMessage(grid_msg: schemas.GridMessage, db: Session):
     # Check primary group exists.
-    primary_group = crud.getGroupByName(grid_msg.primary_group, db)
-    if not primary_group:
+    primary_key_ring = key_rings[grid_msg.primary_group]
+    if not primary_key_ring:
         raise HTTPException(
             status_code=404,
             detail=f"Group with name '{grid_msg.primary_group}' doesn't exist"
         )
 
     # If secondary_group is provided, check it exists.
-    secondary_group = None
+    secondary_key_ring = None
     if grid_msg.secondary_group:
-        secondary_group = crud.getGroupByName(grid_msg.secondary_group, db)
-        if not secondary_group:
+        secondary_key_ring = key_rings[grid_msg.secondary_group]
+        if not secondary_key_ring:
             raise HTTPException(
                 status_code=404,
                 detail=f"Group with name '{grid_msg.secondary_group}' doesn't exist"
             )
 
-    # Retrieve and shuffle keys for primary (and secondary if applicable)
-    all_primary_group_keys = crud.getAllEncryptionKeysByGroup(primary_group.name, db)
-    random.shuffle(all_primary_group_keys)
-
-    if secondary_group:
-        all_secondary_group_keys = crud.getAllEncryptionKeysByGroup(secondary_group.name, db)
-        random.shuffle(all_secondary_group_keys)
+    # Trying all the key combinations can take a while. Do it on a worker thread, so that the other requests (such as
+    # the telegraphs polling for messages) are not blocked in the meantime.
+    grid_profile = grid_profiler.GridProfile() if profile or grid_profiler.isEnabled() else None
+    start_time = time.perf_counter()
+    if grid_profile is not None:
+        composed = await run_in_threadpool(grid_profile.run, "composition", grid_composer.composeGrid, grid_msg,
+                                           primary_key_ring, secondary_key_ring, grid_profile.random)
     else:
-        all_secondary_group_keys = []
-
-    estimated_rows_needed = max(len(grid_msg.primary_message), len(grid_msg.secondary_message))
-
-    # About 10% of row messages is "skip this row" so make the entire thing a tad bit longer
-    estimated_rows_needed *= 1.15
-    estimated_rows_needed = int(estimated_rows_needed)
-    grid = EncryptionGrid(10, estimated_rows_needed)
-    primary_key_id = None
-    primary_encryption_type = ""
-    primary_key = []
-    secondary_key_id = None
-    secondary_key = []
-    secondary_encryption_type = ""
-
-    is_successful = False
-
-    for primary_encryption_key in all_primary_group_keys:
-
-        primary_key_id = primary_encryption_key.id
-        primary_key = primary_encryption_key.key
-        primary_encryption_type = primary_encryption_key.encryption_type
-        try:
-            grid.addMessage(
-                primary_encryption_key.encryption_type,
-                grid_msg.primary_message,
-                primary_encryption_key.key
-            )
-        except Exception as e:
-            logger.error(f"failed to add for {primary_encryption_key.encryption_type}: {e}")
-            continue
-        is_successful = True
-        if not grid_msg.secondary_message:
-            break  # No secondary message; use current grid.
-
-        secondary_message_added = False
-        for secondary_encryption_key in all_secondary_group_keys:
-            secondary_key_id = secondary_encryption_key.id
-            secondary_key = secondary_encryption_key.key
-            secondary_encryption_type = secondary_encryption_key.encryption_type
-            try:
-                grid.addMessage(
-                    secondary_encryption_key.encryption_type,
-                    grid_msg.secondary_message,
-                    secondary_encryption_key.key
-                )
-            except Exception:
-                continue
-            secondary_message_added = True
-            break
-
-        if secondary_message_added:
-            break
-        else:
-            # Reset grid and try the next primary key.
-            grid = EncryptionGrid(10, estimated_rows_needed)
-            is_successful = False
-
-    # Debug prints to check if the encoding went well
-    logger.info(
-        f"Attempting to decode primary message encoded with {primary_encryption_type} and key {primary_key}: {grid.decodeMethod(primary_encryption_type, primary_key)}")
-    if secondary_encryption_type:
-        logger.info(
-            f"Attempting to decode Secondary message encoded with {secondary_encryption_type} and key {secondary_key}: {grid.decodeMethod(secondary_encryption_type, secondary_key)}")
-
-    if not is_successful:
+        composed = await run_in_threadpool(grid_composer.composeGrid, grid_msg, primary_key_ring, secondary_key_ring)
+    metrics.grid_composition_duration.observe(time.perf_counter() - start_time,
+                                              method=composed[1][0]["encryption_type"] if composed else "none")
+
+    if composed is None:
+        if grid_profile is not None:
+            profile_id = await run_in_threadpool(grid_profile.save, grid_msg, key_rings, grid_width, None)
+            logger.info(f"Stored grid profile {profile_id} (no combination worked out)")
         raise HTTPException(
             status_code=400,
             detail=f"Could not encode provided messages with any combination. Consider changing the message or making them shorter"
         )
 
-    # Flatten the grid into text.
-    flat_grid_text = "\n".join(" ".join(row) for row in grid.getRawGrid())
+    grid, grid_keys = composed
+    used_key_ids = [grid_key["key_id"] for grid_key in grid_keys]
+
+    # Check that none of the other keys happens to decode something readable from the grid
+    auditor = await crud.getLeakageAuditor(db)
+    messages = [grid_msg.primary_message, grid_msg.secondary_message]
+    if grid_profile is not None:
+        leakage_audit = await run_in_threadpool(grid_profile.run, "audit", auditor.audit, grid, messages, used_key_ids)
+        profile_id = await run_in_threadpool(grid_profile.save, grid_msg, key_rings, grid_width, composed)
+        response.headers["X-Grid-Profile"] = profile_id
+        logger.info(f"Stored grid profile {profile_id}")
+    else:
+        leakage_audit = await run_in_threadpool(auditor.audit, grid, messages, used_key_ids)
+    for leak in leakage_audit["leaks"]:
+        logger.warning(f"Key {leak['key_id']} of group {leak['group']} decodes {leak['words']} from the grid")
+
     # Create and return the grid message.
-    return crud.createGridMessage(
+    return await crud.createGridMessage(
         db,
         grid_msg.primary_message,
         grid_msg.secondary_message,
-        flat_grid_text,
+        GridCodec.encode(grid),
         grid_msg.target,
-        grid_msg.author
+        grid_msg.author,
+        grid_keys,
+        leakage_audit,
+        grid_msg.priority
     )
 
 
+async def _maintainArchive() -> None:
+    """
+    Keep the messages table small by moving the messages that were printed a while ago to the archive, and give the
+    space they took back to the filesystem.
+    """
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+        try:
+            async with AsyncSessionLocal() as db:
+                num_archived = await crud.archiveMessages(datetime.now() - timedelta(seconds=ARCHIVE_AFTER),
+                                                          ARCHIVE_BATCH_SIZE, db)
+            if num_archived:
+                logger.info(f"Archived {num_archived} messages")
+                await incrementalVacuum(VACUUM_PAGES)
+        except Exception:
+            logger.exception("Unable to archive the printed messages")
+
+
+async def _maintainCompatibility() -> None:
+    """
+    Keep the compatibility matrices of the groups up to date. If the keys of a group change, the matrices it's in are
+    computed again in the background, so the next grid message doesn't have to wait for it.
+    """
+    while True:
+        await asyncio.sleep(COMPATIBILITY_REFRESH_INTERVAL)
+        outdated = key_cache.getOutdatedCompatibility()
+        if not outdated:
+            continue
+        try:
+            async with AsyncSessionLocal() as db:
+                key_rings = await crud.getKeyRings(list({name for key in outdated for name in key[:2]}), db)
+        except Exception:
+            logger.exception("Unable to get the key rings to update the compatibility matrices")
+            continue
+        for primary_group_name, secondary_group_name, primary_length, secondary_length in outdated:
+            primary_key_ring = key_rings[primary_group_name]
+            secondary_key_ring = key_rings[secondary_group_name]
+            if primary_key_ring is None or secondary_key_ring is None:
+                key_cache.dropCompatibility((primary_group_name, secondary_group_name, primary_length, secondary_length))
+                continue
+            await run_in_threadpool(key_cache.getCompatibility, primary_group_name, secondary_group_name,
+                                    primary_key_ring, secondary_key_ring, primary_length, secondary_length, grid_width)
+
+
 @app.post("/messages/", response_model=schemas.Message, responses={400: {"model": schemas.BadRequestError}},
           tags=["Messages"])
-def post_message(message: schemas.MessageCreate, db: Session = Depends(get_db)):
+async def post_message(message: schemas.MessageCreate, response: Response,
+                       x_profile_grid: bool = Header(False, description="Profile composing the grid"),
+                       db: AsyncSession = Depends(get_db)):
     if message.type == schemas.MessageType.morse:
         # Call your existing plain message creation logic.
-        return crud.createMessage(db, message)
+        return await crud.createMessage(db, message)
 
     elif message.type == schemas.MessageType.grid:
-        return _handleGridMessage(message, db)
+        return await _handleGridMessage(message, db, response, x_profile_grid)
     else:
         # Should never get here because the union is discriminated by "type".
         raise HTTPException(status_code=400, detail="Invalid message type")
 
 
+@app.get("/admin/grid_profiling", response_model=schemas.GridProfiling, tags=["Admin"])
+async def getGridProfiling():
+    return schemas.GridProfiling(enabled=grid_profiler.isEnabled(), directory=grid_profiler.PROFILE_DIRECTORY)
+
+
+@app.post("/admin/grid_profiling", response_model=schemas.GridProfiling, tags=["Admin"])
+async def setGridProfiling(grid_profiling: schemas.GridProfilingUpdate):
+    """
+    Profile composing every grid message (or stop doing so). Profiling a single message can be done with the
+    X-Profile-Grid header instead. Replay a profile with GridProfileReplay.py.
+    """
+    grid_profiler.setEnabled(grid_profiling.enabled)
+    return await getGridProfiling()
+
+
+@app.post("/stations/", response_model=schemas.Station, tags=["Stations"])
+async def registerStation(registration: schemas.StationRegistration, db: AsyncSession = Depends(get_db)):
+    """
+    Register a station (or change its targets). From then on, the messages for its targets are only handed out to
+    this station, including the ones that are waiting to be printed already.
+    """
+    return await crud.registerStation(registration, db)
+
+
+@app.get("/stations/", response_model=list[schemas.Station], tags=["Stations"])
+async def getStations(db: AsyncSession = Depends(get_db)):
+    return await crud.getAllStations(db)
+
+
+@app.delete("/stations/{station_name}", responses={404: {"model": schemas.NotFoundError}}, tags=["Stations"])
+async def deleteStation(station_name: str, db: AsyncSession = Depends(get_db)):
+    """
+    Remove a station. Messages for its targets can be printed by any station again.
+    """
+    db_station = await crud.getStationByName(station_name, db)
+    if not db_station:
+        raise HTTPException(status_code=404, detail=f"Station with name '{station_name}' doesn't exist")
+    await crud.deleteStation(db_station, db)
+
+
 @app.post("/groups/", response_model=schemas.Group, tags=["Groups"])
-def postGroup(group: schemas.GroupCreate, db: Session = Depends(get_db)):
-    db_group = crud.getGroupByName(group.name, db)
+async def postGroup(group: schemas.GroupCreate, db: AsyncSession = Depends(get_db)):
+    db_group = await crud.getGroupByName(group.name, db)
     if db_group:
         raise HTTPException(status_code=400, detail=f"Group with name [{group.name}] already exists")
-    return crud.createGroup(group, db)
+    return await crud.createGroup(group, db)
 
 
 @app.get("/groups/", response_model=list[schemas.Group], tags=["Groups"])
-def getGroups(db: Session = Depends(get_db)):
-    return crud.getAllGroups(db)
+async def getGroups(db: AsyncSession = Depends(get_db)):
+    return await crud.getAllGroups(db)
 
 
 @app.get("/groups/{group_name}", response_model=schemas.Group, tags=["Groups"])
-def getGroupByName(group_name: str, db: Session = Depends(get_db)):
-    db_group = crud.getGroupByName(group_name, db)
+async def getGroupByName(group_name: str, db: AsyncSession = Depends(get_db)):
+    db_group = await crud.getGroupByName(group_name, db)
     if not db_group:
         raise HTTPException(status_code=404, detail=f"Group with name '{group_name}' doesn't exist")
     return db_group
@@ -277,35 +435,65 @@ def getGroupByName(group_name: str, db: Session = Depends(get_db)):
 
 @app.post("/groups/{group_name}/encryption_key/{key_type}", response_model=schemas.EncryptionKey,
           tags=["Groups", "Encryption Keys"])
-def createNewEncryptionKeyForGroup(group_name: str, key_type: str, db: Session = Depends(get_db)):
-    db_group = crud.getGroupByName(group_name, db)
+async def createNewEncryptionKeyForGroup(group_name: str, key_type: str, db: AsyncSession = Depends(get_db)):
+    db_group = await crud.getGroupByName(group_name, db)
     if not db_group:
         raise HTTPException(status_code=404, detail=f"Group with name '{group_name}' doesn't exist")
 
     if not key_type in ["row", "row-plow", "skip", "skip-plow"]:
         raise HTTPException(status_code=400, detail=f"Encryption key {key_type} is unknown.")
 
-    return crud.createEncryptionKeyForGroup(group_name, key_type, db)
+    try:
+        return await crud.createEncryptionKeyForGroup(db_group, key_type, db)
+    except crud.KeyNotUniqueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     pass
 
 
 @app.get("/encryption_keys/", response_model=list[schemas.EncryptionKey], tags=["Encryption Keys"])
-def getEncryptionKeys(db: Session = Depends(get_db)):
-    return crud.getAllEncryptionKeys(db)
+async def getEncryptionKeys(db: AsyncSession = Depends(get_db)):
+    return await crud.getAllEncryptionKeys(db)
 
 
 
 @app.post("/encryption_keys")
-def postEncryptionKey(key: EncryptionKeyCreate, db: Session = Depends(get_db)):
-    db_group = crud.getGroupByName(key.group_name, db)
+async def postEncryptionKey(key: EncryptionKeyCreate, db: AsyncSession = Depends(get_db)):
+    db_group = await crud.getGroupByName(key.group_name, db)
     if not db_group:
         raise HTTPException(status_code=404, detail=f"Group with name '{key.group_name}' doesn't exist")
-    return crud.createEncryptionKey(key, db)
+    try:
+        return await crud.createEncryptionKey(key, db_group, db)
+    except crud.KeyNotUniqueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@app.post("/encryption_keys/bulk", response_class=StreamingResponse,
+          responses={200: {"content": {"application/x-ndjson": {}}, "description": "The created keys, one per line"},
+                     404: {"model": schemas.NotFoundError}, 409: {"model": schemas.BadRequestError}},
+          tags=["Encryption Keys"])
+async def postEncryptionKeysInBulk(request: schemas.BulkEncryptionKeyCreate, db: AsyncSession = Depends(get_db)):
+    """
+    Create a lot of keys in one go (eg; when setting up all groups before an event). The created keys are sent back
+    as newline delimited json, in the same format as the other key endpoints.
+    """
+    group_names = list({batch.group_name for batch in request.batches})
+    key_rings = await crud.getKeyRings(group_names, db)
+    for group_name in group_names:
+        if key_rings[group_name] is None:
+            raise HTTPException(status_code=404, detail=f"Group with name '{group_name}' doesn't exist")
+    try:
+        keys = await crud.createEncryptionKeysInBulk(request.batches, key_rings, db)
+    except crud.KeyNotUniqueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    lines = (schemas.EncryptionKey.model_validate(key, from_attributes=True).model_dump_json() + "\n" for key in keys)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
 
 @app.delete("/encryption_keys/{encryption_key_id}/", responses = {404: {"model": schemas.NotFoundError}},
             tags = ["Encryption Keys"])
-def delete_message_by_id(encryption_key_id: int, db: Session = Depends(get_db)):
-    db_message = crud.getEncryptionKeyById(encryption_key_id, db)
+async def delete_message_by_id(encryption_key_id: int, db: AsyncSession = Depends(get_db)):
+    db_message = await crud.getEncryptionKeyById(encryption_key_id, db)
     if not db_message:
         raise HTTPException(status_code=404, detail=f"Key with ID [{encryption_key_id}] was not found")
-    crud.deleteEncryptionKeyById(encryption_key_id, db)
\ No newline at end of file
+    await crud.deleteEncryptionKeyById(encryption_key_id, db)
\ No newline at end of file
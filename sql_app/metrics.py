@@ -0,0 +1,211 @@
+"""
+A tiny metrics registry, rendered in the Prometheus text format on /metrics.
+
+Just like the key cache, the metrics are per process. Metrics are updated from the event loop as well as from worker
+threads (grid composition), so every metric has a lock.
+"""
+import contextvars
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escapeLabelValue(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _formatValue(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()) -> None:
+        self._name = name
+        self._description = description
+        self._label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def getName(self) -> str:
+        return self._name
+
+    def _getLabelValues(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self._label_names):
+            raise ValueError(f"Metric {self._name} needs the labels {self._label_names}, got {tuple(labels)}")
+        return tuple(str(labels[label_name]) for label_name in self._label_names)
+
+    def _formatLabels(self, label_values: LabelValues, extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self._label_names, label_values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escapeLabelValue(value)}"' for name, value in pairs) + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self._name} {self._description}", f"# TYPE {self._name} {self.metric_type}"]
+        lines.extend(self._renderSamples())
+        return lines
+
+    def _renderSamples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()) -> None:
+        super().__init__(name, description, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        label_values = self._getLabelValues(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def getValue(self, **labels: str) -> float:
+        return self._values.get(self._getLabelValues(labels), 0)
+
+    def _renderSamples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self._name}{self._formatLabels(label_values)} {_formatValue(value)}"
+                for label_values, value in values]
+
+
+class Gauge(Counter):
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        label_values = self._getLabelValues(labels)
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, description, label_names)
+        self._buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Label values -> (count per bucket (not cumulative), sum)
+        self._values: Dict[LabelValues, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        label_values = self._getLabelValues(labels)
+        bucket_index = next(index for index, bound in enumerate(self._buckets) if value <= bound)
+        with self._lock:
+            counts, total = self._values.get(label_values, ([0] * len(self._buckets), 0.0))
+            counts[bucket_index] += 1
+            self._values[label_values] = (counts, total + value)
+
+    def getCount(self, **labels: str) -> int:
+        counts, _ = self._values.get(self._getLabelValues(labels), ([], 0.0))
+        return sum(counts)
+
+    def _renderSamples(self) -> List[str]:
+        with self._lock:
+            values = sorted((label_values, (list(counts), total)) for label_values, (counts, total)
+                            in self._values.items())
+        lines = []
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                lines.append(f"{self._name}_bucket{self._formatLabels(label_values, [('le', _formatValue(bound))])} "
+                             f"{cumulative}")
+            lines.append(f"{self._name}_sum{self._formatLabels(label_values)} {_formatValue(total)}")
+            lines.append(f"{self._name}_count{self._formatLabels(label_values)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.getName() in self._metrics:
+            raise ValueError(f"A metric named {metric.getName()} is already registered")
+        self._metrics[metric.getName()] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    "telegraph_http_request_duration_seconds", "Time it took to handle a request", ["method", "route"]))
+request_db_queries = registry.register(Histogram(
+    "telegraph_http_request_db_queries", "Database queries done for a request", ["method", "route"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100)))
+request_db_duration = registry.register(Histogram(
+    "telegraph_http_request_db_duration_seconds", "Time spent on database queries for a request",
+    ["method", "route"]))
+
+grid_key_pairs_tried = registry.register(Histogram(
+    "telegraph_grid_key_pairs_tried", "Key combinations looked at to compose a grid message",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 1000)))
+grid_key_pairs_rejected = registry.register(Counter(
+    "telegraph_grid_key_pairs_rejected_total",
+    "Key combinations that couldn't be used for a grid message; unusable_key if a key can't encode the message at all, "
+    "conflict if both messages need the same field for a different letter", ["reason"]))
+grid_composition_duration = registry.register(Histogram(
+    "telegraph_grid_composition_duration_seconds",
+    "Time it took to compose a grid, by the encryption type of the primary key (none if no combination worked out)",
+    ["method"]))
+
+unprinted_messages = registry.register(Gauge(
+    "telegraph_unprinted_messages", "Messages that haven't been printed yet"))
+oldest_unprinted_message_age = registry.register(Gauge(
+    "telegraph_oldest_unprinted_message_age_seconds", "How long the oldest unprinted message has been waiting"))
+
+
+class QueryStatistics:
+    def __init__(self) -> None:
+        self.num_queries = 0
+        self.duration = 0.0
+
+
+# The statistics of the request that is being handled (see trackQueries)
+_current_query_statistics: contextvars.ContextVar[Optional[QueryStatistics]] = contextvars.ContextVar(
+    "current_query_statistics", default=None)
+
+
+def startTrackingQueries() -> QueryStatistics:
+    """
+    Count the queries done from the current context (ie; the request that is being handled) from now on.
+    """
+    query_statistics = QueryStatistics()
+    _current_query_statistics.set(query_statistics)
+    return query_statistics
+
+
+def _beforeCursorExecute(connection, cursor, statement, parameters, context, executemany) -> None:
+    connection.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _afterCursorExecute(connection, cursor, statement, parameters, context, executemany) -> None:
+    start_time = connection.info["query_start_time"].pop()
+    query_statistics = _current_query_statistics.get()
+    if query_statistics is not None:
+        query_statistics.num_queries += 1
+        query_statistics.duration += time.perf_counter() - start_time
+
+
+def trackQueries(engine: Engine) -> None:
+    event.listen(engine, "before_cursor_execute", _beforeCursorExecute)
+    event.listen(engine, "after_cursor_execute", _afterCursorExecute)
@@ -1,15 +1,17 @@
 from typing import Optional, List
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, JSON, LargeBinary
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column, registry, relationship
 
+from GridCodec import GridCodec
 from .database import Base
 
 
-class Message(Base):
-    __tablename__ = "messages"
-
+class MessageColumns:
+    """
+    The columns of a message, shared by the messages that are in use (Message) and the archived ones (ArchivedMessage).
+    """
     id: Mapped[int] = mapped_column(primary_key = True, index = True)
 
     # Text contains the "real" message
@@ -18,8 +20,17 @@ class Message(Base):
     # Some message have a secondary message hidden in them
     secondary_text: Mapped[Optional[str]]
 
-    # Encoded text contains the cyphered text (where morse is considered a cypher!)
-    encoded_text: Mapped[str]
+    # Encoded text contains the cyphered text (where morse is considered a cypher!). Grid messages leave this empty and
+    # store their grid in `grid` instead, except for those from before that column existed. Use encoded_text to get the
+    # text of any message.
+    stored_encoded_text: Mapped[str] = mapped_column("encoded_text")
+
+    # The grid of a grid message, packed by GridCodec (so including which fields are part of the messages)
+    grid: Mapped[Optional[bytes]] = mapped_column(LargeBinary)
+
+    # The keys that the messages of a grid message were encoded with; The one of the primary message first.
+    # [{"key_id": ..., "encryption_type": ...}, ...]
+    grid_keys: Mapped[Optional[list]] = mapped_column(JSON)
 
     time_sent: Mapped[datetime]
 
@@ -35,10 +46,72 @@ class Message(Base):
     # Has the message been printed already? If it's None it hasn't been printed yet
     time_printed: Mapped[Optional[datetime]]
 
+    # Messages with a higher priority are printed first (see schemas.Priority)
+    priority: Mapped[int] = mapped_column(default=0, server_default="0")
+
     # Human-readable string to indicate who sent the message. This should only be used to indicate what SL sent
     # something to the players
     author: Mapped[Optional[str]]
 
+    # Name of the station (telegraph) that claimed the message to print it. Until the claim expires, no other station
+    # will get the message.
+    claimed_by: Mapped[Optional[str]]
+    claim_expires: Mapped[Optional[datetime]]
+
+    # Name of the station that prints this message (see Station). Picked by the target of the message, when it's sent
+    # and again whenever the stations change. None if no station has the target; Any station can print those.
+    station: Mapped[Optional[str]] = mapped_column(index=True)
+
+    # For grid messages; The keys (other than the ones used to encode it) that decode something readable from the
+    # grid. See LeakageAuditor.audit
+    leakage_audit: Mapped[Optional[dict]] = mapped_column(JSON)
+
+    # Id that the telegraph gave the message when it was typed. When the telegraph sends the message again (because it
+    # didn't get the response the first time), it's recognised by this instead of stored twice.
+    client_id: Mapped[Optional[str]] = mapped_column(index=True, unique=True)
+
+    @property
+    def encoded_text(self) -> str:
+        if self.grid is not None:
+            return GridCodec.toText(self.grid)
+        return self.stored_encoded_text
+
+
+class Message(MessageColumns, Base):
+    __tablename__ = "messages"
+    # Ids of deleted (and archived) messages are never handed out again, so an id is unique over both tables
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+class ArchivedMessage(MessageColumns, Base):
+    """
+    A message that was printed a while ago (see crud.archiveMessages). Old messages are only ever looked at in the
+    listing, so they are moved here to keep the messages table (which the telegraphs poll) small. An archived message
+    keeps its id.
+    """
+    __tablename__ = "archived_messages"
+
+    archived_at: Mapped[datetime]
+
+
+class Station(Base):
+    """
+    A telegraph that prints messages. Messages for the targets of a station are only handed out to that station, so
+    that several telegraphs (eg; in different rooms) can run against the same server without printing each other's
+    messages.
+    """
+    __tablename__ = "stations"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    name: Mapped[str] = mapped_column(String, unique=True)
+
+    # The targets (see schemas.Target) of which this station prints the messages. A target belongs to one station at
+    # most.
+    targets: Mapped[List[str]] = mapped_column(JSON)
+
+    # When the station last registered itself (which it does every time it starts)
+    registered_at: Mapped[datetime]
+
 
 class EncryptionGroup(Base):
     """
@@ -52,8 +125,9 @@ class EncryptionGroup(Base):
     name: Mapped[str] = mapped_column(String, unique=True) # Human-readable name of the group (eg: "Spies", "Double-agents")
 
     # Link to a list of EncryptionKeys that belong to this group.
+    # Never lazy loaded; Queries that need the keys must load them explicitly (so we don't end up with a query per group)
     encryption_keys: Mapped[List["EncryptionKey"]] = relationship(
-        "EncryptionKey", back_populates="group", cascade="all, delete-orphan"
+        "EncryptionKey", back_populates="group", cascade="all, delete-orphan", lazy="raise_on_sql"
     )
 
 
@@ -62,6 +136,9 @@ class EncryptionKey(Base):
     A single encryption key.
     """
     __tablename__ = "encryption_keys"
+    __table_args__ = (
+        Index("ix_encryption_keys_type_fingerprint", "encryption_type", "fingerprint", unique=True),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
 
@@ -71,8 +148,13 @@ class EncryptionKey(Base):
     # What is the actual key
     key: Mapped[List[int]] = mapped_column(JSON)
 
+    # Normalised version of the key (see crud.getKeyFingerprint). Two keys of the same type that encode the same way
+    # have the same fingerprint, which the unique index below prevents.
+    fingerprint: Mapped[Optional[str]] = mapped_column(String)
+
     # Foreign key linking this key to a specific encryption group.
     group_id: Mapped[int] = mapped_column(Integer, ForeignKey("encryption_groups.id"))
 
-    # Link back to the parent group.
-    group: Mapped["EncryptionGroup"] = relationship("EncryptionGroup", back_populates="encryption_keys")
\ No newline at end of file
+    # Link back to the parent group. Same as above, this has to be loaded explicitly.
+    group: Mapped["EncryptionGroup"] = relationship("EncryptionGroup", back_populates="encryption_keys",
+                                                    lazy="raise_on_sql")
\ No newline at end of file
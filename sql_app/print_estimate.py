@@ -0,0 +1,67 @@
+"""
+Estimates of how long the telegraph takes to print a message, so the GM can see when a queued message will come out.
+
+The telegraph prints a morse message symbol by symbol and a grid row by row, with a sound and a pause (see PygameWrapper
+in main.py) after each of them. Every printer call also checks for paper, which is slow. The defaults are rough
+measurements of that; They can be tuned with environment variables, just like the database settings.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from GridCodec import GridCodec
+
+# Printing a dot or dash (an image), its click and the pause after it
+SECONDS_PER_MORSE_SYMBOL = float(os.environ.get("TELEGRAPH_ETA_MORSE_SYMBOL", 1.0))
+# A space between words is a line feed and a longer pause
+SECONDS_PER_MORSE_SPACE = float(os.environ.get("TELEGRAPH_ETA_MORSE_SPACE", 0.9))
+# Printing a row of a grid, its click and the pause after it
+SECONDS_PER_GRID_ROW = float(os.environ.get("TELEGRAPH_ETA_GRID_ROW", 1.3))
+# The header and footer of a grid message
+SECONDS_PER_GRID_MESSAGE = float(os.environ.get("TELEGRAPH_ETA_GRID_MESSAGE", 6.0))
+# Feeding the paper and the bell at the end of every printed message
+SECONDS_PER_PRINTED_MESSAGE = float(os.environ.get("TELEGRAPH_ETA_PRINTED_MESSAGE", 3.0))
+# Outgoing messages aren't printed; The telegraph only rings its bell
+SECONDS_PER_OUTGOING_MESSAGE = float(os.environ.get("TELEGRAPH_ETA_OUTGOING_MESSAGE", 2.0))
+# The pause between two printed messages (PygameWrapper.MIN_TIME_BETWEEN_MESSAGES), plus the next poll. Urgent
+# messages skip the pause.
+SECONDS_BETWEEN_MESSAGES = float(os.environ.get("TELEGRAPH_ETA_BETWEEN_MESSAGES", 12.0))
+
+
+def getPrintDuration(message_type: str, direction: str, encoded_text: Optional[str], grid: Optional[bytes]) -> float:
+    """
+    :param encoded_text: The stored encoded text (see models.Message.stored_encoded_text)
+    :param grid: The packed grid, if any
+    :return: Estimated seconds from claiming the message until it's printed
+    """
+    if direction == "Outgoing":
+        return SECONDS_PER_OUTGOING_MESSAGE
+    if message_type == "grid":
+        if grid is not None:
+            _, num_rows = GridCodec.getSize(grid)
+        else:
+            # Grid messages from before the grids were packed
+            num_rows = len(encoded_text.split("\n")) if encoded_text else 0
+        return SECONDS_PER_GRID_MESSAGE + num_rows * SECONDS_PER_GRID_ROW + SECONDS_PER_PRINTED_MESSAGE
+    encoded_text = encoded_text or ""
+    num_spaces = encoded_text.count(" ")
+    return ((len(encoded_text) - num_spaces) * SECONDS_PER_MORSE_SYMBOL + num_spaces * SECONDS_PER_MORSE_SPACE
+            + SECONDS_PER_PRINTED_MESSAGE)
+
+
+def addEstimates(queue: List[Dict[str, Any]], now: datetime, urgent_priority: int) -> List[Dict[str, Any]]:
+    """
+    Work out when every message of a single queue (in the order in which they will be printed) starts and is done
+    printing.
+    :param queue: Messages with at least the priority and print_duration (in seconds)
+    :return: The same messages, with their position in the queue, estimated_start and estimated_done added
+    """
+    start_time = now
+    for position, message in enumerate(queue):
+        if position > 0 and message["priority"] < urgent_priority:
+            start_time += timedelta(seconds=SECONDS_BETWEEN_MESSAGES)
+        message["position"] = position
+        message["estimated_start"] = start_time
+        start_time += timedelta(seconds=message["print_duration"])
+        message["estimated_done"] = start_time
+    return queue
@@ -0,0 +1,47 @@
+"""
+Version of the queue of unprinted messages, so the telegraphs can poll for it with a conditional GET.
+
+Everything that changes which messages are unprinted (or what they look like) must bump the version. Just like the key
+cache, this is per process. The ETag includes a token that is picked when the process starts, so that the tag of a
+previous run of the server never matches.
+
+Every station has a queue of its own (the messages routed to it, see models.Station, and those that aren't routed to any
+station), so there is a version per station as well. A change to a message of one station doesn't make the others get
+their queue again.
+"""
+import os
+from typing import Dict, Optional
+
+_epoch = os.urandom(4).hex()
+# Bumped for every change
+_version = 0
+# Bumped for changes to messages that aren't routed to a station (or that affect the queue of every station)
+_unrouted_version = 0
+# Station name -> bumped for changes to the messages routed to that station
+_station_versions: Dict[str, int] = {}
+
+
+def getVersion(station: Optional[str] = None) -> str:
+    """
+    :param station: Get the version of the queue of this station. If None, the version of all unprinted messages.
+    """
+    if station is None:
+        return str(_version)
+    return f"{_unrouted_version}.{_station_versions.get(station, 0)}"
+
+
+def bump(station: Optional[str] = None) -> None:
+    """
+    :param station: The station that the changed message is routed to. None if it isn't routed to a station, or if the
+    queue of every station changed (eg; because the routes changed).
+    """
+    global _version, _unrouted_version
+    _version += 1
+    if station is None:
+        _unrouted_version += 1
+    else:
+        _station_versions[station] = _station_versions.get(station, 0) + 1
+
+
+def getETag(version: str) -> str:
+    return f'"{_epoch}-{version}"'
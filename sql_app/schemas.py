@@ -1,8 +1,9 @@
+import base64
 from datetime import datetime
 from enum import Enum
 from typing import Optional, List, Literal, Union
 
-from pydantic import BaseModel, Field, computed_field
+from pydantic import BaseModel, Field, computed_field, field_validator, model_validator
 
 
 class Direction(str, Enum):
@@ -13,6 +14,12 @@ class MessageType(str, Enum):
     morse: str = "morse"
     grid: str = "grid"
 
+class Priority(int, Enum):
+    normal: int = 0
+    high: int = 1
+    # Urgent messages are printed right after the message that is printing, without the usual pause between messages
+    urgent: int = 2
+
 class EncryptionType(str, Enum):
     row: str = "row"
     row_plow: str = "row-plow"
@@ -42,12 +49,16 @@ class Target(str, Enum):
 class MessageBase(BaseModel):
     direction: Direction
     target: Target
+    priority: Priority = Field(Priority.normal, description="Messages with a higher priority are printed first")
     author: Optional[str] = Field(None, description="If a message is sent by GM, this should be filled in. Just there"
                                                     "for bookkeeping!")
 
 class MorseMessage(MessageBase):
     type: Literal[MessageType.morse] = MessageType.morse
     text: str
+    client_id: Optional[str] = Field(None, max_length=64,
+                                     description="Set by the telegraph. A message with an id that was sent before isn't"
+                                                 " stored again, the earlier one is returned instead")
 
 
 # Message intended for grid (encrypted) messages
@@ -82,6 +93,24 @@ class createEncryptedMessage(BaseModel):
     author: Optional[str] = Field(None, description="If a message is sent by GM, this should be filled in. Just there"
                                                     "for bookkeeping!")
 
+class LeakedKey(BaseModel):
+    key_id: int
+    group: str
+    encryption_type: EncryptionType
+    score: int = Field(description="How many characters of the decoded text are part of a word")
+    words: List[str]
+
+
+class LeakageAudit(BaseModel):
+    keys_checked: int
+    leaks: List[LeakedKey]
+
+
+class GridKey(BaseModel):
+    key_id: int
+    encryption_type: EncryptionType
+
+
 class Message(MessageBase):
     id: int
     time_sent: datetime
@@ -90,6 +119,118 @@ class Message(MessageBase):
     text: str
     secondary_text: Optional[str]
     type: str
+    grid: Optional[str] = Field(None, description="Base64 of the grid as packed by GridCodec (grid messages only)")
+    grid_keys: Optional[List[GridKey]] = None
+    leakage_audit: Optional[LeakageAudit] = None
+    station: Optional[str] = Field(None, description="The station that prints the message. If not set, any station can")
+
+    @field_validator("grid", mode="before")
+    @classmethod
+    def encodeGrid(cls, grid):
+        if isinstance(grid, bytes):
+            return base64.b64encode(grid).decode("ascii")
+        return grid
+
+
+class PrintableMessage(MessageBase):
+    """
+    A message as it is handed out to the telegraphs. A grid message that has its grid packed comes without the encoded
+    text; The telegraph prints the grid from the packed version, so the text would only make the response bigger.
+    """
+    id: int
+    time_sent: datetime
+    time_printed: Optional[datetime] = None
+    type: str
+    text: str
+    encoded_text: Optional[str] = Field(None, description="Not set if the message has a grid")
+    grid: Optional[str] = Field(None, description="Base64 of the grid as packed by GridCodec (grid messages only)")
+    grid_keys: Optional[List[GridKey]] = None
+    station: Optional[str] = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def leaveOutGridText(cls, message):
+        if isinstance(message, dict):
+            if message.get("grid") is not None:
+                return {key: value for key, value in message.items() if key != "encoded_text"}
+            return message
+        if getattr(message, "grid", None) is None:
+            return message
+        # Don't even read the encoded text of the model; That renders the whole grid.
+        return {name: getattr(message, name) for name in cls.model_fields if name != "encoded_text"}
+
+    @field_validator("grid", mode="before")
+    @classmethod
+    def encodeGrid(cls, grid):
+        if isinstance(grid, bytes):
+            return base64.b64encode(grid).decode("ascii")
+        return grid
+
+
+class MessageSummary(MessageBase):
+    """
+    A message as it is shown in listings. The encoded text (which can be a sizeable grid) is only filled in if it was
+    asked for.
+    """
+    id: int
+    time_sent: datetime
+    time_printed: Optional[datetime]
+    text: str
+    secondary_text: Optional[str]
+    type: str
+    station: Optional[str] = None
+    encoded_text: Optional[str] = None
+
+
+class QueuedMessage(MessageSummary):
+    station: Optional[str] = Field(None, description="The station whose queue the message is in. If not set, any "
+                                                     "station can print it")
+    claimed_by: Optional[str]
+    position: int = Field(description="Number of messages before this one in the queue of its station")
+    print_duration: float = Field(description="Estimated seconds it takes to print the message")
+    estimated_start: datetime
+    estimated_done: datetime
+
+
+class MessageFilter(BaseModel):
+    direction: Optional[Direction] = None
+    target: Optional[Target] = None
+    type: Optional[MessageType] = None
+    sent_after: Optional[datetime] = Field(None, description="Only messages sent at or after this time")
+    sent_before: Optional[datetime] = Field(None, description="Only messages sent before this time")
+    printed: Optional[bool] = Field(None, description="Only messages that have (or haven't) been printed")
+    station: Optional[str] = Field(None, description="Only messages that are routed to this station")
+
+
+class ClaimRequest(BaseModel):
+    station: str = Field(description="Name of the station (telegraph) that is going to print the messages")
+    count: int = Field(1, ge=1, le=50, description="Maximum number of messages to claim")
+    lease_seconds: int = Field(300, ge=1, description="How long the messages are reserved for this station. If "
+                                                     "they haven't been acknowledged by then, any station can claim "
+                                                     "them again")
+
+
+class AckRequest(BaseModel):
+    ids: List[int]
+
+
+class AckResponse(BaseModel):
+    acknowledged: int = Field(description="Number of messages that were marked as printed")
+
+
+class StationRegistration(BaseModel):
+    name: str = Field(description="Name of the station (telegraph), the same one that it claims messages with")
+    targets: List[Target] = Field(description="The targets of which this station prints the messages. A target "
+                                              "belongs to one station at most; Registering it takes it away from the "
+                                              "station that had it")
+
+
+class Station(StationRegistration):
+    id: int
+    registered_at: datetime
+
+    class Config:
+        orm_mode = True
 
 
 class GroupBase(BaseModel):
@@ -123,6 +264,24 @@ class EncryptionKeyCreate(BaseModel):
     group_name: str
 
 
+class EncryptionKeyBatch(BaseModel):
+    group_name: str
+    encryption_type: EncryptionType
+    count: int = Field(ge=1, le=1000, description="How many keys to create for this group and encryption type")
+
+
+class BulkEncryptionKeyCreate(BaseModel):
+    batches: List[EncryptionKeyBatch] = Field(min_length=1)
+
+
+class GridProfilingUpdate(BaseModel):
+    enabled: bool = Field(description="Profile composing every grid message")
+
+
+class GridProfiling(GridProfilingUpdate):
+    directory: str = Field(description="Where the profiles are stored")
+
+
 class BadRequestError(BaseModel):
     detail: str
 
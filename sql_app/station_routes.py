@@ -0,0 +1,37 @@
+"""
+Process-local cache of the routes; Which station prints the messages of which target (see models.Station).
+
+Every new message is routed, so the routes are cached instead of asking the database for every message. Registering
+(or removing) a station must invalidate the cache. Just like the key cache, this is per process.
+"""
+from typing import Dict, Optional
+
+# Target -> station name. None if the routes aren't loaded (yet).
+_routes: Optional[Dict[str, str]] = None
+
+# Increased on every invalidation. Used to prevent storing routes that were loaded before the invalidation.
+_generation = 0
+
+
+def getGeneration() -> int:
+    return _generation
+
+
+def getRoutes() -> Optional[Dict[str, str]]:
+    return _routes
+
+
+def storeRoutes(routes: Dict[str, str], generation: int) -> None:
+    """
+    :param generation: The generation (see getGeneration) from before the routes were loaded. If the cache was
+    invalidated since, the routes might be outdated already, so they are not stored.
+    """
+    global _routes
+    if generation == _generation:
+        _routes = routes
+
+
+def invalidate() -> None:
+    global _routes, _generation
+    _routes = None
+    _generation += 1
@@ -0,0 +1,142 @@
+import pytest
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Never touch the actual database
+os.environ.setdefault("TELEGRAPH_DATABASE_URL", "sqlite:///:memory:")
+
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, delete, insert, inspect, select, text
+from sqlalchemy.schema import CreateTable
+
+from sql_app import crud, models
+from sql_app.database import AsyncSessionLocal, upgradeSchema
+from sql_app.main import app
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as client:
+        # Start every test without any messages
+        for message in client.get("/messages/", params={"limit": 1000}).json():
+            client.delete(f"/messages/{message['id']}/")
+        yield client
+
+
+def postMorseMessage(client, text):
+    response = client.post("/messages/", json={"text": text, "direction": "Incoming", "target": "Relay"})
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def archivePrintedMessages(client, batch_size=2):
+    async def archive():
+        async with AsyncSessionLocal() as db:
+            return await crud.archiveMessages(datetime.now() + timedelta(seconds=1), batch_size, db)
+    return client.portal.call(archive)
+
+
+def getListedIds(client, **params):
+    return [message["id"] for message in client.get("/messages/", params=params).json()]
+
+
+def test_printed_messages_are_archived(client):
+    message_ids = [postMorseMessage(client, f"message {index}") for index in range(6)]
+    for message_id in message_ids[:2] + message_ids[3:]:
+        client.post(f"/messages/{message_id}/mark_as_printed")
+
+    # Only the unprinted message stays
+    assert archivePrintedMessages(client) == 5
+    assert archivePrintedMessages(client) == 0
+    assert getListedIds(client, printed=False) == [message_ids[2]]
+    assert client.get("/messages/unprinted/").json()[0]["id"] == message_ids[2]
+
+    # Archived messages are listed (and paged through) as if they were never moved
+    newest_first = message_ids[::-1]
+    assert getListedIds(client) == newest_first
+    assert getListedIds(client, printed=True) == newest_first[:3] + newest_first[4:]
+    assert getListedIds(client, limit=2) == newest_first[:2]
+    assert getListedIds(client, limit=2, before_id=newest_first[1]) == newest_first[2:4]
+    assert getListedIds(client, limit=2, before_id=newest_first[3]) == newest_first[4:]
+    assert getListedIds(client, after_id=message_ids[3]) == newest_first[:2]
+
+    archived = client.get(f"/messages/{message_ids[0]}/")
+    assert archived.status_code == 200
+    assert archived.json()["text"] == "message 0"
+    assert archived.json()["time_printed"] is not None
+
+
+def test_archived_messages_can_be_reprinted_and_deleted(client):
+    message_ids = [postMorseMessage(client, f"message {index}") for index in range(3)]
+    for message_id in message_ids:
+        client.post(f"/messages/{message_id}/mark_as_printed")
+    assert archivePrintedMessages(client) == 3
+
+    assert client.post(f"/messages/{message_ids[0]}/reprint").status_code == 200
+    assert [message["id"] for message in client.get("/messages/unprinted/").json()] == [message_ids[0]]
+
+    assert client.delete(f"/messages/{message_ids[1]}/").status_code == 200
+    assert client.get(f"/messages/{message_ids[1]}/").status_code == 404
+    assert getListedIds(client) == [message_ids[2], message_ids[0]]
+
+
+def test_ids_of_archived_messages_are_not_handed_out_again(client):
+    message_ids = [postMorseMessage(client, f"message {index}") for index in range(3)]
+    for message_id in message_ids:
+        client.post(f"/messages/{message_id}/mark_as_printed")
+    assert archivePrintedMessages(client) == 3
+
+    new_id = postMorseMessage(client, "new")
+    assert new_id > message_ids[2]
+    # Not even the id of a deleted message is handed out again
+    client.delete(f"/messages/{new_id}/")
+    newer_id = postMorseMessage(client, "newer")
+    assert newer_id > new_id
+    assert client.get(f"/messages/{message_ids[2]}/").json()["text"] == "message 2"
+    assert getListedIds(client) == [newer_id] + message_ids[::-1]
+
+
+def test_messages_table_is_rebuilt_with_autoincrement():
+    engine = create_engine("sqlite://")
+    messages = models.Message.__table__
+    with engine.begin() as connection:
+        # The messages table as it was before AUTOINCREMENT
+        table_sql = str(CreateTable(messages).compile(dialect=engine.dialect)).replace("AUTOINCREMENT", "")
+        connection.execute(text(table_sql))
+        connection.execute(insert(messages).values(id=7, text="old", encoded_text="---", time_sent=datetime.now(),
+                                                   direction="Incoming", type="morse", target="Relay"))
+        upgradeSchema(connection)
+        upgradeSchema(connection)
+
+        table_sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'messages'")).scalar()
+        assert "AUTOINCREMENT" in table_sql
+        assert connection.execute(select(messages.c.text)).scalars().all() == ["old"]
+        assert inspect(connection).get_indexes("messages")
+        # The ids continue after the copied messages, even if those are gone
+        connection.execute(delete(messages))
+        new_id = connection.execute(insert(messages).values(
+            text="new", encoded_text="-", time_sent=datetime.now(), direction="Incoming", type="morse",
+            target="Relay")).inserted_primary_key[0]
+        assert new_id == 8
+
+
+def test_message_sent_again_by_the_telegraph_is_stored_once(client):
+    message = {"text": "hello", "direction": "Outgoing", "target": "Relay", "client_id": os.urandom(8).hex()}
+    message_id = client.post("/messages/", json=message).json()["id"]
+    assert client.post("/messages/", json=message).json()["id"] == message_id
+
+    # Even once it's archived
+    client.post(f"/messages/{message_id}/mark_as_printed")
+    assert archivePrintedMessages(client) == 1
+    assert client.post("/messages/", json=message).json()["id"] == message_id
+    assert getListedIds(client) == [message_id]
+
+    # Messages without an id are never the same message
+    del message["client_id"]
+    assert client.post("/messages/", json=message).json()["id"] != client.post("/messages/", json=message).json()["id"]
@@ -0,0 +1,293 @@
+import base64
+import json
+import pytest
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Never touch the actual database
+os.environ.setdefault("TELEGRAPH_DATABASE_URL", "sqlite:///:memory:")
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from GridCodec import GridCodec
+from sql_app.database import engine
+from sql_app import crud, key_cache, station_routes
+from sql_app.main import app
+
+encryption_types = ["row", "row-plow", "skip", "skip-plow"]
+
+
+class QueryCounter:
+    """
+    Count the SELECT statements that are sent to the database while it's active.
+    """
+    def __init__(self):
+        self.statements = []
+
+    def _onExecute(self, connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(engine.sync_engine, "before_cursor_execute", self._onExecute)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(engine.sync_engine, "before_cursor_execute", self._onExecute)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def groups(client):
+    # Groups can't be deleted, so use names that are unique for this test
+    names = [f"group_{os.urandom(4).hex()}" for _ in range(3)]
+    for name in names:
+        assert client.post("/groups/", json={"name": name}).status_code == 200
+        for encryption_type in encryption_types:
+            assert client.post(f"/groups/{name}/encryption_key/{encryption_type}").status_code == 200
+    return names
+
+
+def test_listing_keys_is_a_single_query(client, groups):
+    with QueryCounter() as counter:
+        keys = client.get("/encryption_keys/").json()
+    assert len(keys) >= len(groups) * len(encryption_types)
+    assert {key["group"]["name"] for key in keys} >= set(groups)
+    assert counter.count == 1, counter.statements
+
+
+def postGridMessage(client, primary_group, secondary_group=None):
+    message = {"type": "grid", "direction": "Incoming", "target": "Relay",
+               "primary_message": "hello", "primary_group": primary_group}
+    if secondary_group:
+        message.update({"secondary_message": "hi", "secondary_group": secondary_group})
+    return client.post("/messages/", json=message)
+
+
+def test_grid_message_loads_key_rings_once(client, groups):
+    station_routes.invalidate()
+    with QueryCounter() as counter:
+        assert postGridMessage(client, groups[0], groups[1]).status_code == 200
+    # One for both key rings, one for the keys to audit the grid with, one for the routes of the stations, one to
+    # refresh the created message.
+    assert counter.count == 4, counter.statements
+
+    # The second time around, the key rings (and the auditor and the routes) come from the cache.
+    with QueryCounter() as counter:
+        assert postGridMessage(client, groups[0], groups[1]).status_code == 200
+    assert counter.count == 1, counter.statements
+
+
+def test_key_cache_is_invalidated(client, groups):
+    assert postGridMessage(client, groups[0], groups[1]).status_code == 200
+    client.post(f"/groups/{groups[1]}/encryption_key/row")
+
+    with QueryCounter() as counter:
+        assert postGridMessage(client, groups[0], groups[1]).status_code == 200
+    # Only the secondary group (and the keys to audit with) need to be loaded again.
+    assert counter.count == 3, counter.statements
+
+    key_id = client.get("/encryption_keys/").json()[-1]["id"]
+    assert client.delete(f"/encryption_keys/{key_id}/").status_code == 200
+    with QueryCounter() as counter:
+        assert postGridMessage(client, groups[0], groups[1]).status_code == 200
+    assert counter.count == 3, counter.statements
+
+
+def test_group_created_after_it_was_asked_for(client, groups):
+    group_name = f"group_{os.urandom(4).hex()}"
+    assert postGridMessage(client, groups[0], group_name).status_code == 404
+
+    client.post("/groups/", json={"name": group_name})
+    for encryption_type in encryption_types:
+        client.post(f"/groups/{group_name}/encryption_key/{encryption_type}")
+    assert postGridMessage(client, groups[0], group_name).status_code == 200
+
+
+def test_creating_key_looks_up_group_once(client, groups):
+    with QueryCounter() as counter:
+        response = client.post("/encryption_keys", json={"group_name": groups[2], "encryption_type": "row",
+                                                         "key": [1, 2, 3, 4, 5, 6]})
+    assert response.status_code == 200
+    assert response.json()["group"]["name"] == groups[2]
+    assert counter.count == 1, counter.statements
+
+
+def test_unknown_group_for_grid_message(client, groups):
+    response = client.post("/messages/", json={
+        "type": "grid", "direction": "Incoming", "target": "Relay",
+        "primary_message": "hello", "primary_group": groups[0],
+        "secondary_message": "hi", "secondary_group": "does not exist"
+    })
+    assert response.status_code == 404
+
+
+def test_key_fingerprint_ignores_repetition():
+    assert crud.getKeyFingerprint([1, 2, 3]) == "1,2,3"
+    assert crud.getKeyFingerprint([1, 2, 3, 1, 2, 3]) == "1,2,3"
+    assert crud.getKeyFingerprint([4, 4, 4, 4]) == "4"
+    assert crud.getKeyFingerprint([1, 2, 1, 3]) == "1,2,1,3"
+
+
+def test_duplicate_keys_are_refused(client, groups):
+    key = [7, 1, 7, 2, 7, 3]
+    response = client.post("/encryption_keys", json={"group_name": groups[0], "encryption_type": "skip", "key": key})
+    assert response.status_code == 200
+
+    # Same key for another group, and the same key repeated (which encodes the exact same way)
+    for group_name, duplicate_key in [(groups[1], key), (groups[0], key + key)]:
+        response = client.post("/encryption_keys", json={"group_name": group_name, "encryption_type": "skip",
+                                                         "key": duplicate_key})
+        assert response.status_code == 409
+
+    # A different encryption type is fine though
+    response = client.post("/encryption_keys", json={"group_name": groups[1], "encryption_type": "row", "key": key})
+    assert response.status_code == 200
+    # And the group still works after a refused key
+    assert client.post(f"/groups/{groups[0]}/encryption_key/skip").status_code == 200
+
+
+def test_generated_key_is_retried_when_taken(client, groups, monkeypatch):
+    taken_key = client.post(f"/groups/{groups[0]}/encryption_key/row").json()["key"]
+    generated_keys = [taken_key, [9, 8, 7, 6, 5, 4, 3]]
+    monkeypatch.setattr(crud, "generateKey", lambda encryption_type, group_keys: generated_keys.pop(0))
+
+    response = client.post(f"/groups/{groups[1]}/encryption_key/row")
+    assert response.status_code == 200
+    assert response.json()["key"] == [9, 8, 7, 6, 5, 4, 3]
+    assert response.json()["group"]["name"] == groups[1]
+
+    monkeypatch.setattr(crud, "generateKey", lambda encryption_type, group_keys: taken_key)
+    assert client.post(f"/groups/{groups[1]}/encryption_key/row").status_code == 409
+
+
+def test_bulk_key_creation(client, groups):
+    batches = [{"group_name": groups[0], "encryption_type": "skip", "count": 20},
+               {"group_name": groups[1], "encryption_type": "row-plow", "count": 5}]
+    with QueryCounter() as counter:
+        response = client.post("/encryption_keys/bulk", json={"batches": batches})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    # Key rings of the groups, existing fingerprints and reading back the created keys
+    assert counter.count == 3, counter.statements
+
+    keys = [json.loads(line) for line in response.text.splitlines()]
+    assert len(keys) == 25
+    assert sum(1 for key in keys if key["group"]["name"] == groups[0] and key["encryption_type"] == "skip") == 20
+    assert len({crud.getKeyFingerprint(key["key"]) for key in keys if key["encryption_type"] == "skip"}) == 20
+
+    # The new keys are used for grid messages right away
+    assert len(client.get("/encryption_keys/").json()) >= 25
+    assert postGridMessage(client, groups[0], groups[1]).status_code == 200
+
+
+def test_bulk_created_keys_are_read_back_in_chunks(client, groups, monkeypatch):
+    monkeypatch.setattr(crud, "max_query_parameters", 2)
+    batches = [{"group_name": groups[2], "encryption_type": "row", "count": 5}]
+    with QueryCounter() as counter:
+        response = client.post("/encryption_keys/bulk", json={"batches": batches})
+    assert response.status_code == 200
+    assert counter.count == 2 + 3, counter.statements
+
+    key_ids = [json.loads(line)["id"] for line in response.text.splitlines()]
+    assert len(key_ids) == 5
+    assert key_ids == sorted(key_ids)
+
+
+def test_bulk_key_creation_for_unknown_group(client, groups):
+    batches = [{"group_name": groups[0], "encryption_type": "skip", "count": 1},
+               {"group_name": "does not exist", "encryption_type": "skip", "count": 1}]
+    assert client.post("/encryption_keys/bulk", json={"batches": batches}).status_code == 404
+
+
+def test_compatibility_matrix():
+    key_ring = key_cache.KeyRing(1, {"row": [(1, "row", (1,)), (2, "row", (2,))]}, {})
+    other_key_ring = key_cache.KeyRing(2, {"row": [(3, "row", (2,))], "skip": [(4, "skip", (0,))]}, {})
+    pairs = key_cache.computeCompatibility(key_ring, other_key_ring, 10, 10, 10)
+    # Row key 1 and row key 2 never share a field, skip key 0 only uses the first row
+    assert pairs[0] == (0, 0, 0)
+    assert pairs[-1] == (10, 1, 0)
+    assert sorted(pairs) == pairs
+    assert key_cache.getLengthBucket(1) == 10
+    assert key_cache.getLengthBucket(10) == 10
+    assert key_cache.getLengthBucket(11) == 20
+
+
+def test_compatibility_matrix_is_outdated_when_keys_change(client, groups):
+    assert postGridMessage(client, groups[0], groups[1]).status_code == 200
+    assert not any(key[:2] == (groups[0], groups[1]) for key in key_cache.getOutdatedCompatibility())
+    client.post(f"/groups/{groups[1]}/encryption_key/skip")
+    assert any(key[:2] == (groups[0], groups[1]) for key in key_cache.getOutdatedCompatibility())
+
+
+def test_grid_message_without_secondary_message(client, groups):
+    response = postGridMessage(client, groups[0])
+    assert response.status_code == 200
+    assert response.json()["secondary_text"] is None
+
+
+def test_grid_is_sized_to_the_keys(client):
+    group_name = f"group_{os.urandom(4).hex()}"
+    client.post("/groups/", json={"name": group_name})
+    client.post("/encryption_keys", json={"group_name": group_name, "encryption_type": "row", "key": [1, 0]})
+
+    response = postGridMessage(client, group_name)
+    assert response.status_code == 200
+    # Every other row is skipped, so "HELLO" needs 9 rows
+    assert len(response.json()["encoded_text"].splitlines()) == 9
+
+
+def test_grid_message_is_audited(client, groups):
+    response = postGridMessage(client, groups[0], groups[1])
+    assert response.status_code == 200
+    leakage_audit = response.json()["leakage_audit"]
+    # Every key but the two that were used
+    assert leakage_audit["keys_checked"] == len(client.get("/encryption_keys/").json()) - 2
+
+
+def test_grid_message_is_stored_packed(client, groups):
+    message = postGridMessage(client, groups[0], groups[1]).json()
+    grid = GridCodec.decode(base64.b64decode(message["grid"]))
+    assert message["encoded_text"] == "\n".join(" ".join(row) for row in grid.getRawGrid())
+
+    keys = {key["id"]: key for key in client.get("/encryption_keys/").json()}
+    primary_key, secondary_key = [keys[grid_key["key_id"]] for grid_key in message["grid_keys"]]
+    assert primary_key["group"]["name"] == groups[0]
+    assert grid.decodeMethod(primary_key["encryption_type"], primary_key["key"]).startswith("HELLO")
+    assert grid.decodeMethod(secondary_key["encryption_type"], secondary_key["key"]).startswith("HI")
+
+    listed = client.get("/messages/", params={"type": "grid", "include_encoded_text": True}).json()
+    assert [m["encoded_text"] for m in listed if m["id"] == message["id"]] == [message["encoded_text"]]
+
+
+def test_telegraph_gets_grid_without_encoded_text(client, groups):
+    grid_message = postGridMessage(client, groups[0], groups[1]).json()
+    morse_message = client.post("/messages/", json={"text": "sos", "direction": "Incoming", "target": "Relay"}).json()
+
+    unprinted = {message["id"]: message for message in client.get("/messages/unprinted/").json()}
+    # Other tests leave unprinted messages behind as well
+    claimed = {}
+    while grid_message["id"] not in claimed or morse_message["id"] not in claimed:
+        batch = client.post("/messages/claim", json={"station": "grid-test", "count": 50}).json()
+        assert batch
+        client.post("/messages/ack", json={"ids": [message["id"] for message in batch]})
+        claimed.update((message["id"], message) for message in batch)
+    for messages in (unprinted, claimed):
+        assert "encoded_text" not in messages[grid_message["id"]]
+        assert messages[grid_message["id"]]["grid"] == grid_message["grid"]
+        assert "secondary_text" not in messages[grid_message["id"]]
+        assert messages[morse_message["id"]]["encoded_text"] == morse_message["encoded_text"]
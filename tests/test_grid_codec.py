@@ -0,0 +1,43 @@
+import pytest
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from GridBasedEncryption import EncryptionGrid
+from GridCodec import GridCodec
+
+
+@pytest.mark.parametrize("num_columns, num_rows", [(10, 1), (10, 9), (7, 13), (10, 0)])
+def test_round_trip(num_columns, num_rows):
+    grid = EncryptionGrid(num_columns, num_rows)
+    if num_rows:
+        grid.addMessage("skip", "hi", [1])
+
+    decoded = GridCodec.decode(GridCodec.encode(grid))
+    assert decoded.getRawGrid() == grid.getRawGrid()
+    assert decoded.getLockedFields() == grid.getLockedFields()
+
+
+def test_decoded_grid_can_be_decoded():
+    grid = EncryptionGrid(10, 30)
+    key = grid.addMessage("skip-plow", "hello there", [3, 1, 4])
+    assert GridCodec.decode(GridCodec.encode(grid)).decodeMethod("skip-plow", key).startswith("HELLO.THERE.")
+
+
+def test_packed_grid_is_small():
+    grid = EncryptionGrid(10, 40)
+    text = "\n".join(" ".join(row) for row in grid.getRawGrid())
+    packed = GridCodec.encode(grid)
+    # 4 bytes header, 250 bytes for the cells and 50 for the locked fields
+    assert len(packed) == 304
+    assert len(packed) * 2 < len(text)
+    assert GridCodec.toText(packed) == text
+
+
+@pytest.mark.parametrize("data", [b"", b"\x02\x0a\x00\x01" + bytes(9), b"\x01\x0a\x00\x01" + bytes(3)])
+def test_invalid_data(data):
+    with pytest.raises(ValueError):
+        GridCodec.decodeRows(data)
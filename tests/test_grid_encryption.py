@@ -66,7 +66,7 @@ def test_add_message_row_method_with_preset_key(sample_grid, encryption_type, me
         decoded_message = sample_grid.decodeSkipPlowMethod(preset_key)
 
     # We can only encode message with capitals
-    assert decoded_message.startswith(EncryptionGrid._formatMessage(message))
+    assert decoded_message.startswith(EncryptionGrid.formatMessage(message))
     assert result_key == preset_key
 
 @pytest.mark.parametrize(
@@ -84,7 +84,7 @@ def test_add_message_skip_method_with_generated_key(sample_grid, message, max_sk
     key = grid.addMessageSkipMethod(message, max_skip=max_skip)
     decoded_message = grid.decodeSkipMethod(key)
     # We can only encode message with capitals
-    assert decoded_message.startswith(EncryptionGrid._formatMessage(message)), f"Failed to encode/decode {message} with skip method"
+    assert decoded_message.startswith(EncryptionGrid.formatMessage(message)), f"Failed to encode/decode {message} with skip method"
     assert all(skip <= max_skip for skip in key), "Key contains skips larger than max_skip"
 
 def test_multiple_encode_no_preset_row_first(sample_grid):
@@ -135,7 +135,7 @@ def test_encode_message(sample_grid, message, encryption_type):
         result_key = sample_grid.addMessageSkipPlowMethod(message)
         decoded_message = sample_grid.decodeSkipPlowMethod(result_key)
 
-    assert decoded_message.startswith(EncryptionGrid._formatMessage(message))
+    assert decoded_message.startswith(EncryptionGrid.formatMessage(message))
 
 @pytest.mark.parametrize("encryption_type", encryption_types)
 @pytest.mark.parametrize(
@@ -198,4 +198,57 @@ def test_encoding_row_fails_with_conflicting_preset_key(sample_grid):
 def test_negative_keys(sample_grid):
     # Technically possible, but likely to cause issues.
     key = sample_grid.addMessageSkipMethod("HELLO", preset_key = [1,2,3,-1])
-    assert sample_grid.decodeSkipMethod(key).startswith("HELLO")
\ No newline at end of file
+    assert sample_grid.decodeSkipMethod(key).startswith("HELLO")
+
+@pytest.mark.parametrize("encryption_type", encryption_types)
+@pytest.mark.parametrize("preset_key", [[1, 2, 3, 4, 5], [3, 0, 7], [0, 0, 1, 9], [6]])
+def test_footprint_matches_encoded_fields(encryption_type, preset_key):
+    grid = EncryptionGrid(10, 40)
+    message = "HELLO THERE"
+    grid.addMessage(encryption_type, message, preset_key)
+
+    message_length = len(EncryptionGrid.formatMessage(message))
+    footprint = EncryptionGrid.getFootprint(encryption_type, preset_key, message_length, 10)
+    assert set(footprint) == grid.getLockedFields()
+    assert "".join(grid.getRawGrid()[row][column] for row, column in footprint) == "HELLO.THERE."
+
+
+def test_footprint_mask():
+    assert EncryptionGrid.getFootprintMask("row", [1, 2], 3, 10) == 1 << 0 | 1 << 11 | 1 << 20
+    assert EncryptionGrid.getFootprintMask("skip", [0], 3, 10) == 0b111
+    assert EncryptionGrid.getFootprint("row", [0, 0], 3, 10) == []
+
+
+@pytest.mark.parametrize("encryption_type", encryption_types)
+@pytest.mark.parametrize("preset_key", [[1, 2, 3, 4, 5], [3, 0, 7], [0, 0, 1, 9], [6]])
+def test_rows_needed_is_exact(encryption_type, preset_key):
+    message = "HELLO THERE"
+    rows_needed = EncryptionGrid.getRowsNeeded(encryption_type, preset_key, len(EncryptionGrid.formatMessage(message)), 10)
+
+    grid = EncryptionGrid(10, rows_needed)
+    key = grid.addMessage(encryption_type, message, preset_key)
+    assert grid.decodeMethod(encryption_type, key).startswith("HELLO.THERE.")
+
+    too_small_grid = EncryptionGrid(10, rows_needed - 1)
+    assert not too_small_grid.canEncodeMethod(encryption_type, EncryptionGrid.formatMessage(message), preset_key)
+
+
+def test_rows_needed_without_usable_key():
+    assert EncryptionGrid.getRowsNeeded("row", [0, 0], 5, 10) is None
+    assert EncryptionGrid.getRowsNeeded("row", [0, 0], 0, 10) == 0
+
+
+def test_row_key_with_zeroes_is_checked_on_the_right_rows():
+    grid = EncryptionGrid(10, 10)
+    grid.addMessageRowMethod("AB", preset_key=[1, 1])  # Fields (0, 0) and (1, 0)
+    # With this key, the "B" skips row 1 and ends up in (2, 0), so it doesn't conflict with the "B" that is there.
+    assert grid.canEncodeRowMethod("AC", [1, 0, 1])
+    assert not grid.canEncodeRowMethod("AC", [1, 1])
+
+
+def test_can_share_grid():
+    # Both use the first field of the first row
+    assert EncryptionGrid.canShareGrid("row", [1], "HI", "skip", [0], "HA", 10)
+    assert not EncryptionGrid.canShareGrid("row", [1], "HI", "skip", [0], "YO", 10)
+    # No fields in common at all
+    assert EncryptionGrid.canShareGrid("row", [1], "HI", "row", [2], "YO", 10)
@@ -0,0 +1,77 @@
+import pytest
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Never touch the actual database
+os.environ.setdefault("TELEGRAPH_DATABASE_URL", "sqlite:///:memory:")
+
+import pstats
+
+from fastapi.testclient import TestClient
+
+from GridProfileReplay import replay
+from sql_app import grid_profiler
+from sql_app.main import app
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(grid_profiler, "PROFILE_DIRECTORY", str(tmp_path))
+    with TestClient(app) as client:
+        yield client
+    grid_profiler.setEnabled(False)
+
+
+@pytest.fixture
+def groups(client):
+    # Groups can't be deleted, so use names that are unique for this test
+    names = [f"group_{os.urandom(4).hex()}" for _ in range(2)]
+    for name in names:
+        assert client.post("/groups/", json={"name": name}).status_code == 200
+        for encryption_type in ("row", "row-plow", "skip"):
+            assert client.post(f"/groups/{name}/encryption_key/{encryption_type}").status_code == 200
+    return names
+
+
+def postGridMessage(client, groups, headers=None):
+    return client.post("/messages/", headers=headers, json={
+        "type": "grid", "direction": "Incoming", "target": "Relay", "primary_message": "hello",
+        "primary_group": groups[0], "secondary_message": "hi", "secondary_group": groups[1]
+    })
+
+
+def test_grid_message_is_only_profiled_when_asked(client, groups, tmp_path):
+    response = postGridMessage(client, groups)
+    assert response.status_code == 200
+    assert "X-Grid-Profile" not in response.headers
+    assert list(tmp_path.iterdir()) == []
+
+    response = postGridMessage(client, groups, headers={"X-Profile-Grid": "true"})
+    assert response.status_code == 200
+    profile_id = response.headers["X-Grid-Profile"]
+    assert pstats.Stats(str(tmp_path / f"{profile_id}.prof")).total_calls > 0
+
+    details = grid_profiler.loadDetails(str(tmp_path / f"{profile_id}.json"))
+    assert details["grid"]["keys"] == response.json()["grid_keys"]
+    assert details["grid"]["num_columns"] == 10
+    assert set(details["durations"]) == {"composition", "audit"}
+    assert set(details["key_rings"]) == set(groups)
+
+
+def test_profiling_can_be_toggled(client, groups, tmp_path):
+    response = client.post("/admin/grid_profiling", json={"enabled": True})
+    assert response.json() == {"enabled": True, "directory": str(tmp_path)}
+    assert "X-Grid-Profile" in postGridMessage(client, groups).headers
+
+    client.post("/admin/grid_profiling", json={"enabled": False})
+    assert client.get("/admin/grid_profiling").json()["enabled"] is False
+    assert "X-Grid-Profile" not in postGridMessage(client, groups).headers
+
+
+def test_replay_composes_the_same_grid(client, groups, tmp_path):
+    profile_id = postGridMessage(client, groups, headers={"X-Profile-Grid": "true"}).headers["X-Grid-Profile"]
+    assert replay(str(tmp_path / f"{profile_id}.json"), num_lines=0)
@@ -0,0 +1,59 @@
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from KeyGenerator import KeyGenerator
+
+encryption_types = ["row", "row-plow", "skip", "skip-plow"]
+
+
+def test_rows_per_character():
+    generator = KeyGenerator(reference_message_length=10)
+    assert generator.getRowsPerCharacter("row", [1, 2, 3]) == 1
+    # Every other row is skipped
+    assert generator.getRowsPerCharacter("row-plow", [1, 0]) == 1.9
+    # 10 characters, one field apart, fit in 2 rows of 10
+    assert generator.getRowsPerCharacter("skip", [1]) == 0.2
+    assert generator.getRowsPerCharacter("row", [0, 0]) == float("inf")
+
+
+def test_success_rate():
+    generator = KeyGenerator(reference_message_length=5)
+    assert generator.getSuccessRate("row", [1], []) == 1
+    # Same column, so every field collides
+    assert generator.getSuccessRate("row", [1], [("row", [1])]) < 0.001
+    # Different columns never collide
+    assert generator.getSuccessRate("row", [1], [("row", [2]), ("row-plow", [3])]) == 1
+    assert 0.4 < generator.getSuccessRate("row", [1], [("row", [1]), ("row", [2])]) < 0.6
+
+
+def test_generated_keys_fit():
+    generator = KeyGenerator()
+    group_keys = []
+    for i in range(12):
+        encryption_type = encryption_types[i % len(encryption_types)]
+        key = generator.generateKey(encryption_type, group_keys)
+        assert 6 <= len(key) <= 10
+        assert generator.getRowsPerCharacter(encryption_type, key) <= 1.25
+        assert generator.getZeroFraction(key) <= 0.34
+        group_keys.append((encryption_type, key))
+
+
+def test_generated_keys_avoid_existing_keys():
+    generator = KeyGenerator(min_success_rate=1)
+    # Column 1 to 5 of every row are taken, so a good row key uses the other ones.
+    group_keys = [("row", [column]) for column in range(1, 6)]
+    key = generator.generateKey("row", group_keys)
+    assert generator.getSuccessRate("row", key, group_keys) > 0.5
+
+
+def test_best_key_is_used_if_none_is_good_enough(caplog):
+    generator = KeyGenerator(min_success_rate=0.75, max_candidates=20)
+    # Every column of every row is taken
+    group_keys = [("row", [column]) for column in range(1, 11)]
+    key = generator.generateKey("row", group_keys)
+    assert 6 <= len(key) <= 10
+    assert generator.getRowsPerCharacter("row", key) <= 1.25
+    assert "None of 20 row keys is good enough" in caplog.text
@@ -0,0 +1,31 @@
+import io
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pygame
+
+from KeyboardInput import StdinKeyboard
+
+
+def readLine(monkeypatch, line):
+    keys = []
+    monkeypatch.setattr(sys, "stdin", io.StringIO(line))
+    StdinKeyboard(lambda key, unicode: keys.append((key, unicode)))._onReadable()
+    return keys
+
+
+def test_typed_line_is_replayed_as_key_presses(monkeypatch):
+    assert readLine(monkeypatch, "sos 2\n") == [(0, "s"), (0, "o"), (0, "s"), (0, " "), (0, "2"),
+                                                (pygame.K_RETURN, "\r")]
+
+
+def test_empty_line_only_presses_return(monkeypatch):
+    assert readLine(monkeypatch, "\n") == [(pygame.K_RETURN, "\r")]
+
+
+def test_closed_stdin_presses_nothing(monkeypatch):
+    assert readLine(monkeypatch, "") == []
@@ -0,0 +1,51 @@
+import pytest
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from GridBasedEncryption import EncryptionGrid
+from LeakageAuditor import AuditedKey, LeakageAuditor
+
+keys = [
+    AuditedKey(1, "spies", "row", [1, 2, 3, 4, 5]),
+    AuditedKey(2, "spies", "row-plow", [3, 0, 7]),
+    AuditedKey(3, "smugglers", "skip", [0, 0, 1, 9]),
+    AuditedKey(4, "smugglers", "skip-plow", [6]),
+    AuditedKey(5, "rebels", "row", [0, 0, 10, 1]),
+]
+
+
+@pytest.mark.parametrize("num_rows", [1, 7, 30])
+def test_decode_all_matches_decode_method(num_rows):
+    grid = EncryptionGrid(10, num_rows)
+    auditor = LeakageAuditor(keys, [])
+    assert auditor.decodeAllAsText(grid) == [grid.decodeMethod(key.encryption_type, list(key.key)) for key in keys]
+
+
+def test_leaked_message_is_found():
+    grid = EncryptionGrid(10, 30)
+    grid.addMessage("row", "meet at the harbour", [1, 2, 3, 4, 5])
+
+    # Row key 1 is as good as the same key as the one used for the message
+    auditor = LeakageAuditor(keys + [AuditedKey(6, "rebels", "row", [1, 2, 3, 4, 5, 1, 2, 3, 4, 5])], ["harbour"])
+    result = auditor.audit(grid, ["meet at the harbour"], skip_key_ids=[1])
+    assert result["keys_checked"] == 5
+    assert [leak["key_id"] for leak in result["leaks"]] == [6]
+    assert result["leaks"][0]["group"] == "rebels"
+    assert result["leaks"][0]["words"] == ["HARBOUR", "MEET"]
+    assert result["leaks"][0]["score"] == 11
+
+
+def test_short_words_are_ignored():
+    grid = EncryptionGrid(10, 10)
+    grid.addMessage("row", "cat dog", [1])
+    auditor = LeakageAuditor([AuditedKey(1, "spies", "row", [1])], ["cat", "dog"], min_score=1)
+    assert auditor.audit(grid, ["cat dog"])["leaks"] == []
+
+
+def test_word_list_is_shipped():
+    words = LeakageAuditor.loadWords()
+    assert "TELEGRAPH" in {word.upper() for word in words}
@@ -0,0 +1,98 @@
+import pytest
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Never touch the actual database
+os.environ.setdefault("TELEGRAPH_DATABASE_URL", "sqlite:///:memory:")
+
+from fastapi.testclient import TestClient
+
+from sql_app.main import app
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as client:
+        # Start every test without any messages
+        for message in client.get("/messages/", params={"limit": 1000}).json():
+            client.delete(f"/messages/{message['id']}/")
+        yield client
+
+
+def postMorseMessage(client, text, direction="Incoming", target="Relay"):
+    response = client.post("/messages/", json={"text": text, "direction": direction, "target": target})
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def test_messages_are_paged_newest_first(client):
+    message_ids = [postMorseMessage(client, f"message {i}") for i in range(5)]
+
+    first_page = client.get("/messages/", params={"limit": 2})
+    assert [message["id"] for message in first_page.json()] == message_ids[:2:-1]
+    before_id = first_page.headers["X-Next-Before-Id"]
+
+    second_page = client.get("/messages/", params={"limit": 2, "before_id": before_id})
+    assert [message["id"] for message in second_page.json()] == message_ids[2:0:-1]
+
+    last_page = client.get("/messages/", params={"limit": 2, "before_id": second_page.headers["X-Next-Before-Id"]})
+    assert [message["id"] for message in last_page.json()] == message_ids[:1]
+    assert "X-Next-Before-Id" not in last_page.headers
+
+
+def test_only_newer_messages(client):
+    first_id = postMorseMessage(client, "old")
+    second_id = postMorseMessage(client, "new")
+
+    messages = client.get("/messages/", params={"after_id": first_id}).json()
+    assert [message["id"] for message in messages] == [second_id]
+
+
+def test_messages_are_filtered(client):
+    relay_id = postMorseMessage(client, "to the relay", target="Relay")
+    outgoing_id = postMorseMessage(client, "from the players", direction="Outgoing", target="Logistics")
+    client.post(f"/messages/{relay_id}/mark_as_printed")
+
+    assert [m["id"] for m in client.get("/messages/", params={"target": "Relay"}).json()] == [relay_id]
+    assert [m["id"] for m in client.get("/messages/", params={"direction": "Outgoing"}).json()] == [outgoing_id]
+    assert [m["id"] for m in client.get("/messages/", params={"printed": True}).json()] == [relay_id]
+    assert [m["id"] for m in client.get("/messages/", params={"printed": False}).json()] == [outgoing_id]
+    assert client.get("/messages/", params={"type": "grid"}).json() == []
+    assert client.get("/messages/", params={"sent_after": "2999-01-01T00:00:00"}).json() == []
+    assert len(client.get("/messages/", params={"sent_before": "2999-01-01T00:00:00"}).json()) == 2
+
+
+def test_encoded_text_only_when_asked_for(client):
+    postMorseMessage(client, "SOS")
+
+    assert client.get("/messages/").json()[0]["encoded_text"] is None
+    messages = client.get("/messages/", params={"include_encoded_text": True}).json()
+    assert messages[0]["encoded_text"].strip() == "... --- ..."
+
+
+def test_unprinted_messages_are_only_sent_when_changed(client):
+    response = client.get("/messages/unprinted/")
+    etag = response.headers["ETag"]
+    assert response.json() == []
+
+    not_modified = client.get("/messages/unprinted/", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["ETag"] == etag
+
+    message_id = postMorseMessage(client, "new")
+    response = client.get("/messages/unprinted/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert [message["id"] for message in response.json()] == [message_id]
+    etag = response.headers["ETag"]
+
+    # Claiming doesn't change the queue, printing does.
+    client.post("/messages/claim", json={"station": "test", "count": 1})
+    assert client.get("/messages/unprinted/", headers={"If-None-Match": etag}).status_code == 304
+    client.post("/messages/ack", json={"ids": [message_id]})
+    response = client.get("/messages/unprinted/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json() == []
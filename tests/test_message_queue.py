@@ -0,0 +1,98 @@
+import pytest
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Never touch the actual database
+os.environ.setdefault("TELEGRAPH_DATABASE_URL", "sqlite:///:memory:")
+
+from datetime import datetime
+
+from fastapi.testclient import TestClient
+
+from sql_app import print_estimate
+from sql_app.main import app
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as client:
+        # Start every test without any messages
+        for message in client.get("/messages/", params={"limit": 1000}).json():
+            client.delete(f"/messages/{message['id']}/")
+        yield client
+
+
+def postMorseMessage(client, text, priority=None):
+    message = {"text": text, "direction": "Incoming", "target": "Relay"}
+    if priority is not None:
+        message["priority"] = priority
+    response = client.post("/messages/", json=message)
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def test_messages_are_handed_out_by_priority(client):
+    normal_id = postMorseMessage(client, "normal")
+    urgent_id = postMorseMessage(client, "urgent", priority=2)
+    high_id = postMorseMessage(client, "high", priority=1)
+    second_urgent_id = postMorseMessage(client, "also urgent", priority=2)
+
+    expected_order = [urgent_id, second_urgent_id, high_id, normal_id]
+    assert [message["id"] for message in client.get("/messages/unprinted/").json()] == expected_order
+    claimed = client.post("/messages/claim", json={"station": "test", "count": 2}).json()
+    assert [message["id"] for message in claimed] == expected_order[:2]
+    assert claimed[0]["priority"] == 2
+
+
+def test_unknown_priority_is_refused(client):
+    response = client.post("/messages/", json={"text": "?", "direction": "Incoming", "target": "Relay", "priority": 7})
+    assert response.status_code == 422
+
+
+def test_queue_has_estimates(client):
+    normal_id = postMorseMessage(client, "sos")
+    long_id = postMorseMessage(client, "a much longer message")
+    urgent_id = postMorseMessage(client, "now", priority=2)
+    before = datetime.now()
+
+    queue = client.get("/messages/queue/").json()
+    assert [message["id"] for message in queue] == [urgent_id, normal_id, long_id]
+    assert [message["position"] for message in queue] == [0, 1, 2]
+    assert queue[2]["print_duration"] > queue[1]["print_duration"]
+    for message in queue:
+        assert datetime.fromisoformat(message["estimated_done"]) > datetime.fromisoformat(message["estimated_start"])
+    # Every message starts after the one before it, with a pause in between
+    for previous, message in zip(queue, queue[1:]):
+        assert (datetime.fromisoformat(message["estimated_start"])
+                - datetime.fromisoformat(previous["estimated_done"])).total_seconds() == pytest.approx(
+            print_estimate.SECONDS_BETWEEN_MESSAGES)
+    assert datetime.fromisoformat(queue[0]["estimated_start"]) >= before
+
+    # The message that is being printed goes first
+    client.post("/messages/claim", json={"station": "test", "count": 1})
+    client.post("/messages/", json={"text": "another", "direction": "Incoming", "target": "Relay", "priority": 2})
+    assert client.get("/messages/queue/").json()[0]["id"] == urgent_id
+
+
+def test_print_duration():
+    morse = print_estimate.getPrintDuration("morse", "Incoming", ".... ..  - .... . .-. . ", None)
+    assert morse == pytest.approx(16 * print_estimate.SECONDS_PER_MORSE_SYMBOL
+                                  + 8 * print_estimate.SECONDS_PER_MORSE_SPACE
+                                  + print_estimate.SECONDS_PER_PRINTED_MESSAGE)
+    legacy_grid = print_estimate.getPrintDuration("grid", "Incoming", "A B\nC D\nE F", None)
+    assert legacy_grid == pytest.approx(print_estimate.SECONDS_PER_GRID_MESSAGE
+                                        + 3 * print_estimate.SECONDS_PER_GRID_ROW
+                                        + print_estimate.SECONDS_PER_PRINTED_MESSAGE)
+    assert print_estimate.getPrintDuration("morse", "Outgoing", "...", None) == \
+        print_estimate.SECONDS_PER_OUTGOING_MESSAGE
+
+
+def test_urgent_messages_skip_the_pause():
+    now = datetime.now()
+    queue = print_estimate.addEstimates([{"priority": 0, "print_duration": 5}, {"priority": 2, "print_duration": 5}],
+                                        now, 2)
+    assert queue[1]["estimated_start"] == queue[0]["estimated_done"]
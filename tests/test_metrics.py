@@ -0,0 +1,61 @@
+import pytest
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Never touch the actual database
+os.environ.setdefault("TELEGRAPH_DATABASE_URL", "sqlite:///:memory:")
+
+from fastapi.testclient import TestClient
+
+from sql_app import metrics
+from sql_app.main import app
+
+
+def test_histogram_is_rendered_cumulative():
+    histogram = metrics.Histogram("test_seconds", "A test", ["route"], buckets=(1, 5))
+    histogram.observe(0.5, route="/a")
+    histogram.observe(3, route="/a")
+    histogram.observe(7, route="/a")
+    assert histogram.render() == [
+        "# HELP test_seconds A test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a",le="1"} 1',
+        'test_seconds_bucket{route="/a",le="5"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 3',
+        'test_seconds_sum{route="/a"} 10.5',
+        'test_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_labels_are_checked_and_escaped():
+    counter = metrics.Counter("test_total", "A test", ["name"])
+    counter.inc(name='say "hi"\n')
+    assert counter.render()[-1] == 'test_total{name="say \\"hi\\"\\n"} 1'
+    with pytest.raises(ValueError):
+        counter.inc(other="label")
+
+
+def test_metrics_endpoint():
+    with TestClient(app) as client:
+        group_name = f"group_{os.urandom(4).hex()}"
+        client.post("/groups/", json={"name": group_name})
+        client.post(f"/groups/{group_name}/encryption_key/skip")
+        composed_before = metrics.grid_key_pairs_tried.getCount()
+        assert client.post("/messages/", json={"type": "grid", "direction": "Incoming", "target": "Relay",
+                                               "primary_message": "hello", "primary_group": group_name}).status_code == 200
+        assert metrics.grid_key_pairs_tried.getCount() == composed_before + 1
+
+        client.get("/messages/1/")
+        response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert any(line.startswith('telegraph_http_request_duration_seconds_count{method="GET",route="/messages/{message_id}/"}')
+               for line in lines)
+    assert any(line.startswith('telegraph_grid_composition_duration_seconds_count{method="skip"}') for line in lines)
+    assert any(line.startswith("telegraph_unprinted_messages ") for line in lines)
+    assert any(line.startswith("telegraph_oldest_unprinted_message_age_seconds ") for line in lines)
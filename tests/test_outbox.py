@@ -0,0 +1,58 @@
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Outbox import Outbox
+
+
+def test_entries_are_kept_in_order():
+    outbox = Outbox(":memory:")
+    outbox.addMessage("first", "Relay")
+    outbox.addMessage("second", "Logistics")
+
+    pending = outbox.getPendingMessages(10)
+    assert [message["text"] for _, message in pending] == ["first", "second"]
+    assert pending[1][1]["target"] == "Logistics"
+
+
+def test_batches_are_limited():
+    outbox = Outbox(":memory:")
+    for message_id in range(5):
+        outbox.addPrintAck(message_id)
+
+    assert [message_id for _, message_id in outbox.getPendingPrintAcks(3)] == [0, 1, 2]
+
+
+def test_removed_print_ack_is_no_longer_pending():
+    outbox = Outbox(":memory:")
+    outbox.addPrintAck(12)
+    assert outbox.hasPendingPrintAck(12)
+
+    outbox.remove([entry_id for entry_id, _ in outbox.getPendingPrintAcks(10)])
+    assert not outbox.hasPendingPrintAck(12)
+    assert outbox.getNumPending() == 0
+
+
+def test_outbox_survives_restart(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = Outbox(path)
+    outbox.addMessage("hello", "Relay")
+    outbox.addPrintAck(3)
+    outbox.close()
+
+    outbox = Outbox(path)
+    assert outbox.getNumPending() == 2
+    assert outbox.hasPendingPrintAck(3)
+
+
+def test_messages_get_a_client_id():
+    outbox = Outbox(":memory:")
+    outbox.addMessage("same", "Relay")
+    outbox.addMessage("same", "Relay")
+
+    client_ids = [message["client_id"] for _, message in outbox.getPendingMessages(10)]
+    assert len(set(client_ids)) == 2
+    # And they keep it, so it's the same every time the message is sent
+    assert [message["client_id"] for _, message in outbox.getPendingMessages(10)] == client_ids
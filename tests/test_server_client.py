@@ -0,0 +1,125 @@
+import asyncio
+import json
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import httpx
+
+from ServerClient import SendResult, ServerClient
+
+
+def runWithServer(handler, coroutine_function):
+    """
+    Run coroutine_function(client) against a fake server, which answers every request with handler(request).
+    """
+    async def run():
+        client = ServerClient("http://server", retry_backoff=0)
+        client._client = httpx.AsyncClient(base_url="http://server", transport=httpx.MockTransport(handler))
+        async with client._client:
+            return await coroutine_function(client)
+    return asyncio.run(run())
+
+
+def test_sent_message_is_not_retried_after_reaching_the_server():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        raise httpx.ReadTimeout("no response", request=request)
+
+    assert runWithServer(handler, lambda client: client.sendMessage("hello", "Relay")) == SendResult.FAILED
+    assert len(requests) == 1
+
+
+def test_sent_message_is_retried_if_it_never_reached_the_server():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if len(requests) == 1:
+            raise httpx.ConnectError("no connection", request=request)
+        return httpx.Response(200, json={})
+
+    assert runWithServer(handler, lambda client: client.sendMessage("hello", "Relay")) == SendResult.SENT
+    assert len(requests) == 2
+
+
+def test_refused_message_is_rejected():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(422, json={"detail": "unknown target"})
+
+    assert runWithServer(handler, lambda client: client.sendMessage("hello", "Nowhere")) == SendResult.REJECTED
+    assert len(requests) == 1
+
+
+def test_acknowledgements_are_retried():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if len(requests) == 1:
+            return httpx.Response(503)
+        return httpx.Response(200, json={})
+
+    assert runWithServer(handler, lambda client: client.acknowledgePrinted([1, 2]))
+    assert len(requests) == 2
+
+
+def test_claim_is_not_retried():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(503)
+
+    assert runWithServer(handler, lambda client: client.claimMessages("station", 1)) is None
+    assert len(requests) == 1
+
+
+def test_unchanged_unprinted_messages_are_not_sent_again():
+    def handler(request):
+        if request.headers.get("If-None-Match") == '"1"':
+            return httpx.Response(304)
+        return httpx.Response(200, json=[], headers={"ETag": '"1"'})
+
+    async def getTwice(client):
+        etag, messages = await client.getUnprintedMessages()
+        return (etag, messages), await client.getUnprintedMessages(etag)
+
+    assert runWithServer(handler, getTwice) == (('"1"', []), ('"1"', None))
+
+
+def test_statistics_count_retries_and_failures():
+    def handler(request):
+        return httpx.Response(503)
+
+    async def acknowledge(client):
+        await client.acknowledgePrinted([1])
+        return client.getStatistics()["ack"]
+
+    statistics = runWithServer(handler, acknowledge)
+    assert statistics.num_requests == 1
+    assert statistics.num_retries == 3
+    assert statistics.num_failures == 1
+    assert statistics.num_responses == 4
+
+
+def test_sent_message_with_client_id_is_retried():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if len(requests) == 1:
+            raise httpx.ReadTimeout("no response", request=request)
+        return httpx.Response(200, json={})
+
+    assert runWithServer(handler, lambda client: client.sendMessage("hello", "Relay", "abc")) == SendResult.SENT
+    # The server only stores it once, as it's sent with the same id both times
+    assert [json.loads(request.content)["client_id"] for request in requests] == ["abc", "abc"]
@@ -0,0 +1,37 @@
+import threading
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from StartupTimer import StartupTimer
+from Tracer import Tracer
+
+
+def test_startup_is_finished_once():
+    startup_timer = StartupTimer()
+    with startup_timer.measure("import.pygame"):
+        pass
+
+    def initSound():
+        with startup_timer.measure("init.sound"):
+            pass
+
+    thread = threading.Thread(target=initSound)
+    thread.start()
+    thread.join()
+
+    tracer = Tracer()
+    durations = startup_timer.finish("first poll", tracer)
+    assert list(durations) == ["first poll", "import.pygame", "init.sound"]
+    assert durations["first poll"] >= durations["import.pygame"]
+    assert startup_timer.isFinished()
+    assert [event["name"] for event in tracer.getEvents() if event["ph"] == "X"] == [
+        "startup.first poll", "startup.import.pygame", "startup.init.sound"]
+
+    # Components that are done later (eg; hardware that took longer than the first poll) don't change anything
+    with startup_timer.measure("init.printer"):
+        pass
+    assert startup_timer.finish("first poll") is None
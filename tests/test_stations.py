@@ -0,0 +1,148 @@
+import pytest
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Never touch the actual database
+os.environ.setdefault("TELEGRAPH_DATABASE_URL", "sqlite:///:memory:")
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from sql_app.database import engine
+from sql_app.main import app
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as client:
+        # Start every test without any messages
+        for message in client.get("/messages/", params={"limit": 1000}).json():
+            client.delete(f"/messages/{message['id']}/")
+        yield client
+        # The other tests expect every station to get every message
+        for station in client.get("/stations/").json():
+            client.delete(f"/stations/{station['name']}")
+
+
+def postMorseMessage(client, text, target):
+    response = client.post("/messages/", json={"text": text, "direction": "Incoming", "target": target})
+    assert response.status_code == 200
+    return response.json()
+
+
+def registerStation(client, name, targets):
+    response = client.post("/stations/", json={"name": name, "targets": targets})
+    assert response.status_code == 200
+    return response.json()
+
+
+def getUnprintedIds(client, station=None):
+    params = {"station": station} if station is not None else {}
+    return [message["id"] for message in client.get("/messages/unprinted/", params=params).json()]
+
+
+def test_messages_are_routed_to_the_station_of_their_target(client):
+    registerStation(client, "attic", ["Relay", "Logistics"])
+    registerStation(client, "cellar", ["LongRange"])
+
+    relay = postMorseMessage(client, "to the attic", "Relay")
+    long_range = postMorseMessage(client, "to the cellar", "LongRange")
+    university = postMorseMessage(client, "to anyone", "University")
+    assert (relay["station"], long_range["station"], university["station"]) == ("attic", "cellar", None)
+
+    assert getUnprintedIds(client, "attic") == [relay["id"], university["id"]]
+    assert getUnprintedIds(client, "cellar") == [long_range["id"], university["id"]]
+    assert getUnprintedIds(client) == [relay["id"], long_range["id"], university["id"]]
+
+    claimed = client.post("/messages/claim", json={"station": "cellar", "count": 5}).json()
+    assert [message["id"] for message in claimed] == [long_range["id"], university["id"]]
+    claimed = client.post("/messages/claim", json={"station": "attic", "count": 5}).json()
+    assert [message["id"] for message in claimed] == [relay["id"]]
+
+
+def test_queues_of_other_stations_are_not_changed(client):
+    registerStation(client, "attic", ["Relay"])
+    registerStation(client, "cellar", ["LongRange"])
+    attic_etag = client.get("/messages/unprinted/", params={"station": "attic"}).headers["ETag"]
+    cellar_etag = client.get("/messages/unprinted/", params={"station": "cellar"}).headers["ETag"]
+
+    message = postMorseMessage(client, "to the cellar", "LongRange")
+    assert client.get("/messages/unprinted/", params={"station": "attic"},
+                      headers={"If-None-Match": attic_etag}).status_code == 304
+    assert client.get("/messages/unprinted/", params={"station": "cellar"},
+                      headers={"If-None-Match": cellar_etag}).status_code == 200
+
+    # Messages without a station are in every queue
+    postMorseMessage(client, "to anyone", "University")
+    assert client.get("/messages/unprinted/", params={"station": "attic"},
+                      headers={"If-None-Match": attic_etag}).status_code == 200
+
+    attic_etag = client.get("/messages/unprinted/", params={"station": "attic"}).headers["ETag"]
+    client.post("/messages/ack", json={"ids": [message["id"]]})
+    assert client.get("/messages/unprinted/", params={"station": "attic"},
+                      headers={"If-None-Match": attic_etag}).status_code == 304
+
+
+def test_queue_of_a_station_includes_unrouted_messages(client):
+    registerStation(client, "attic", ["Relay"])
+    relay = postMorseMessage(client, "relay", "Relay")
+    university = postMorseMessage(client, "to anyone", "University")
+    postMorseMessage(client, "elsewhere", "LongRange")
+    registerStation(client, "cellar", ["LongRange"])
+
+    queue = client.get("/messages/queue/", params={"station": "attic"}).json()
+    assert [message["id"] for message in queue] == [relay["id"], university["id"]]
+    # A single queue; The unrouted message is printed after the one of the station
+    assert [message["position"] for message in queue] == [0, 1]
+    assert queue[1]["estimated_start"] >= queue[0]["estimated_done"]
+
+
+def test_waiting_messages_follow_their_target(client):
+    registerStation(client, "attic", ["Relay", "Logistics"])
+    relay = postMorseMessage(client, "relay", "Relay")
+    logistics = postMorseMessage(client, "logistics", "Logistics")
+
+    # Taking a target away from a station
+    station = registerStation(client, "cellar", ["Logistics"])
+    assert station["targets"] == ["Logistics"]
+    assert {station["name"]: station["targets"] for station in client.get("/stations/").json()} == {
+        "attic": ["Relay"], "cellar": ["Logistics"]}
+    assert getUnprintedIds(client, "attic") == [relay["id"]]
+    assert getUnprintedIds(client, "cellar") == [logistics["id"]]
+
+    # A station that stops handling a target
+    registerStation(client, "attic", [])
+    assert getUnprintedIds(client, "cellar") == [relay["id"], logistics["id"]]
+
+    assert client.delete("/stations/cellar").status_code == 200
+    assert client.delete("/stations/cellar").status_code == 404
+    assert client.get(f"/messages/{logistics['id']}/").json()["station"] is None
+    assert getUnprintedIds(client, "attic") == [relay["id"], logistics["id"]]
+
+
+def test_printing_does_not_need_returning(client):
+    # The sqlite on the server might be too old for UPDATE ... RETURNING
+    statements = []
+
+    def onExecute(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    registerStation(client, "attic", ["Relay"])
+    first = postMorseMessage(client, "first", "Relay")
+    second = postMorseMessage(client, "second", "Relay")
+    etag = client.get("/messages/unprinted/", params={"station": "attic"}).headers["ETag"]
+    event.listen(engine.sync_engine, "before_cursor_execute", onExecute)
+    try:
+        assert client.post(f"/messages/{first['id']}/mark_as_printed").status_code == 200
+        assert client.post("/messages/9999999/mark_as_printed").status_code == 404
+        assert client.post("/messages/ack", json={"ids": [first["id"], second["id"]]}).json()["acknowledged"] == 1
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", onExecute)
+    assert not [statement for statement in statements if "RETURNING" in statement.upper()]
+    assert client.get("/messages/unprinted/", params={"station": "attic"},
+                      headers={"If-None-Match": etag}).status_code == 200
+    assert getUnprintedIds(client, "attic") == []
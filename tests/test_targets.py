@@ -0,0 +1,18 @@
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Targets import Targets
+from sql_app.schemas import Target
+
+
+def test_targets_match_the_server():
+    assert Targets.NAMES == tuple(target.value for target in Target)
+    for target in Target:
+        assert Targets.getIndex(target.value) == Target.getIndex(target)
+
+
+def test_unknown_target_turns_the_leds_off():
+    assert Targets.getIndex("Narnia") == -1
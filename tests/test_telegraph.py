@@ -0,0 +1,107 @@
+import asyncio
+import threading
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from main import PygameWrapper, request_update_server_event, sound_completed_event
+from Outbox import Outbox
+from ServerClient import ServerClient
+
+
+class FakeSound:
+    def __init__(self, checks_until_completed):
+        self.num_checks = 0
+        self._checks_until_completed = checks_until_completed
+
+    def hasClickCompleted(self):
+        self.num_checks += 1
+        return self.num_checks == self._checks_until_completed
+
+
+def runTelegraph(coroutine_function):
+    """
+    Run coroutine_function(telegraph) on a headless telegraph that has the loop set up, but isn't running.
+    """
+    async def run():
+        telegraph = PygameWrapper(headless=True, server_client=ServerClient("http://server"), outbox=Outbox(":memory:"))
+        telegraph._loop = asyncio.get_running_loop()
+        telegraph._event_queue = asyncio.Queue()
+        try:
+            return await coroutine_function(telegraph)
+        finally:
+            telegraph._outbox.close()
+            telegraph._printer_executor.shutdown(wait=False)
+    return asyncio.run(run())
+
+
+def test_headless_click_is_checked_until_it_completes():
+    sound = FakeSound(checks_until_completed=3)
+
+    async def playClick(telegraph):
+        telegraph._sound = sound
+        telegraph._startSound()
+        # Starting a sound while the previous one is still checked doesn't check twice as often
+        telegraph._startSound()
+        event = await asyncio.wait_for(telegraph._event_queue.get(), 1)
+        # Give an extra check the chance to run, if there was one
+        await asyncio.sleep(5 * telegraph.CLICK_CHECK_TIME)
+        return event, telegraph._event_queue.empty(), telegraph._click_check
+
+    event, no_other_events, click_check = runTelegraph(playClick)
+    assert event.type == sound_completed_event
+    assert no_other_events
+    assert click_check is None
+    assert sound.num_checks == 3
+
+
+class FakeServer:
+    def __init__(self, claimed_messages):
+        self._claimed_messages = claimed_messages
+
+    async def getUnprintedMessages(self, etag, station):
+        return None
+
+    async def claimMessages(self, station, count):
+        return self._claimed_messages
+
+
+def test_failed_request_asks_the_server_again():
+    async def request(telegraph):
+        # Not a message the telegraph can do anything with
+        telegraph._server = FakeServer([{"id": 1, "direction": "Incoming"}])
+        telegraph._hardware_ready = asyncio.Event()
+        telegraph._hardware_ready.set()
+        telegraph._request_message_pending = True
+        await telegraph._doServerRequest()
+        return telegraph._request_message_pending, set(telegraph._timers)
+
+    request_message_pending, timers = runTelegraph(request)
+    # Waiting for the next request, instead of for this one forever
+    assert request_message_pending
+    assert timers == {request_update_server_event}
+
+
+def test_printer_that_does_not_respond_fails():
+    printer_released = threading.Event()
+
+    def printImage(image):
+        printer_released.wait()
+        return True
+
+    async def printDot(telegraph):
+        telegraph.PRINTER_TIMEOUT = 0.05
+        try:
+            return await telegraph._runOnPrinter(printImage, "dot.png")
+        finally:
+            printer_released.set()
+
+    assert runTelegraph(printDot) is False
+
+
+def test_urgent_priority_matches_the_server():
+    from sql_app.schemas import Priority
+    assert PygameWrapper.URGENT_PRIORITY == Priority.urgent
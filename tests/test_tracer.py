@@ -0,0 +1,59 @@
+import json
+import threading
+
+import sys
+import os
+
+# Make python shut up about packages
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Tracer import Tracer
+
+
+def test_message_summary():
+    tracer = Tracer()
+    start_time = Tracer.now()
+    tracer.startMessage(12, start_time)
+    tracer.addSpan("server_fetch", start_time, start_time + 2_000_000_000)
+    for _ in range(3):
+        tracer.addSpan("pause", start_time, start_time + 500_000_000)
+    with tracer.span("printer.printGridTextLine"):
+        pass
+
+    summary = tracer.finishMessage()
+    assert summary["message_id"] == 12
+    assert list(summary["stages"]) == ["server_fetch", "pause", "printer.printGridTextLine"]
+    assert summary["stages"]["pause"] == {"count": 3, "duration": 1.5}
+    assert summary["duration"] >= 0
+    # Nothing to finish anymore
+    assert tracer.finishMessage() is None
+
+
+def test_spans_outside_of_a_message_are_not_summarised():
+    tracer = Tracer()
+    with tracer.span("printer.feedPaper"):
+        pass
+    tracer.startMessage(1)
+    assert tracer.finishMessage()["stages"] == {}
+
+
+def test_rolling_trace_file(tmp_path):
+    path = str(tmp_path / "trace.json")
+    tracer = Tracer(path, max_events=5)
+    tracer.startMessage(3)
+    for index in range(10):
+        with tracer.span("pause", index=index):
+            pass
+    thread = threading.Thread(target=lambda: tracer.addSpan("printer.hasPaper", Tracer.now()), name="printer")
+    thread.start()
+    thread.join()
+    tracer.finishMessage()
+    tracer.write()
+
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+    spans = [event for event in events if event["ph"] == "X"]
+    assert len(spans) == 5
+    assert spans[-1]["name"] == "message"
+    assert all(span["args"]["message_id"] == 3 for span in spans)
+    assert "printer" in [event["args"]["name"] for event in events if event["ph"] == "M"]